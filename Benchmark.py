@@ -0,0 +1,781 @@
+
+import asyncio
+import io
+import multiprocessing
+import os
+import socket
+import struct
+import tempfile
+import time
+import tracemalloc
+
+from hmac import compare_digest
+
+from SPM import _msg_size, _hash_size, _data_size, _bulk_block_size
+from SPM import _xfer_window, _xfer_workers, _read_ahead_size, _write_high_water
+from SPM.Messages import MessageStrategy, BlockStrategy, MessageClass, MessageType, strategies
+from SPM.Messages import FRAMING_FIXED, FRAMING_BULK
+from SPM.Stream import RC4, make_hmacf
+from SPM.Client import Client
+from SPM.Transfer import TransferPool, DURABILITY_FINAL
+
+#Throughput benchmarks for the SPM library
+
+class LegacyRC4:
+  """The original per-byte RC4-DROP-2048 implementation, kept as a reference"""
+
+  def __init__(self,key):
+    self.key = bytearray(key)
+    self.s = [i for i in range(0,256)]
+    j = 0
+    for i in range(0,256):
+      j = (j + self.s[i] + self.key[i % 256]) % 256
+      self.s[i], self.s[j] = self.s[j], self.s[i]
+    self.getBytes(2048)
+
+  def getBytes(self,bs):
+    i = 0
+    j = 0
+    stream = bytearray()
+    for _ in range(bs):
+      i = (i + 1) % 256
+      j = (j + self.s[i]) % 256
+      self.s[i], self.s[j] = self.s[j], self.s[i]
+      stream.append(self.s[(self.s[i]+self.s[j]) % 256])
+    return stream
+
+  def xor(self,data):
+    data = bytearray(data)
+    stream = self.getBytes(len(data))
+    return bytearray(map(lambda b: b[0]^b[1],zip(data,stream)))
+
+def throughput(cipher,block,count):
+  """Encrypt count blocks and report the rate in MB/s"""
+  start = time.perf_counter()
+  for _ in range(count):
+    cipher.xor(block)
+  return (len(block)*count)/(time.perf_counter()-start)/1e6
+
+def bench_stream(count=500):
+  """Compare the block RC4 engine against the per-byte reference"""
+  key = os.urandom(256)
+  old, new = LegacyRC4(key), RC4(key)
+  for size in (1, 2027, 4096, 65536):
+    block = os.urandom(size)
+    assert old.xor(block) == new.xor(block), "Keystream mismatch"
+  for size in (2027, 65536):
+    block = os.urandom(size)
+    n = max(1, count*2027//size)
+    old_rate = throughput(old,block,n)
+    new_rate = throughput(new,block,n)
+    print("RC4 {:>6} byte blocks: legacy {:6.2f} MB/s, block {:6.2f} MB/s ({:.1f}x)".format(
+      size,old_rate,new_rate,new_rate/old_rate))
+
+def legacy_build(strategy,args,stream,hmacf):
+  """The original concatenating frame assembly, kept as a reference"""
+  header_buf = struct.pack("!1s1s",strategy.msg_class.value,strategy.msg_type.value.bc)
+  if args:
+    body_buf = struct.pack(strategy.fmt_b,*tuple(strategy.msg_type.value.codec.enc(args)))
+  else:
+    body_buf = bytes([0])
+  body_buf += bytes([0])*(_msg_size-(len(body_buf)+len(header_buf)+_hash_size))
+  msg_buf = header_buf[1:2] + body_buf
+  msg_buf = stream.xor(msg_buf)
+  msg_buf += struct.pack("!{}s".format(_hash_size),hmacf(msg_buf))
+  return header_buf[0:1] + msg_buf
+
+def legacy_parse(msg_buf,stream,hmacf):
+  """The original slicing frame parser, kept as a reference"""
+  msg_class = MessageStrategy.detect_class(msg_buf)
+  assert compare_digest(hmacf(msg_buf[1:-_hash_size]),msg_buf[-_hash_size:])
+  msg_buf = msg_buf[0:1] + stream.xor(msg_buf[1:-_hash_size])
+  msg_type = MessageStrategy.detect_type(msg_buf)
+  assert (msg_class,msg_type) in strategies
+  msg_dict = dict()
+  if msg_type.value.fmt:
+    contents = tuple(msg_type.value.codec.dec(struct.unpack_from(msg_type.value.fmt,msg_buf,2)))
+    for i in range(len(msg_type.value.args)):
+      entry_title = msg_type.value.args[i]
+      if entry_title in msg_dict.keys():
+        try:
+          msg_dict[entry_title].append(contents[i])
+        except AttributeError:
+          msg_dict[entry_title] = [msg_dict[entry_title],contents[i]]
+      else:
+        msg_dict[entry_title] = contents[i]
+  msg_dict["MessageType"] = msg_type
+  return msg_dict
+
+def per_frame(fn,count):
+  """Report the time and peak transient allocation of one call to fn"""
+  tracemalloc.start()
+  tracemalloc.reset_peak()
+  base = tracemalloc.get_traced_memory()[0]
+  fn()
+  peak = tracemalloc.get_traced_memory()[1] - base
+  tracemalloc.stop()
+  start = time.perf_counter()
+  for _ in range(count):
+    fn()
+  return (time.perf_counter()-start)/count*1e6, peak
+
+class NullStream:
+  """Identity cipher so framing costs are not hidden behind the keystream"""
+
+  def xor(self,data):
+    return bytearray(data)
+
+def bench_messages(count=2000):
+  """Compare frame assembly and parsing against the original code"""
+  hmacf = make_hmacf(os.urandom(256))
+  stream = NullStream()
+  cases = [(MessageType.OKAY,None),(MessageType.XFER_FILE,[os.urandom(_data_size),_data_size])]
+  for msg_type,args in cases:
+    strategy = strategies[(MessageClass.PRIVATE_MSG,msg_type)]
+    frame = bytes(strategy.build(args,stream,hmacf))
+    assert bytes(legacy_build(strategy,args,stream,hmacf)) == frame
+    for name,build,parse in (("legacy",lambda: legacy_build(strategy,args,stream,hmacf),
+                                       lambda: legacy_parse(frame,stream,hmacf)),
+                             ("struct",lambda: strategy.build(args,stream,hmacf),
+                                       lambda: MessageStrategy.parse(frame,stream,hmacf))):
+      build_us, build_peak = per_frame(build,count)
+      parse_us, parse_peak = per_frame(parse,count)
+      print("{:>10} {}: build {:6.1f} us {:6} B peak, parse {:6.1f} us {:6} B peak".format(
+        msg_type.name,name,build_us,build_peak,parse_us,parse_peak))
+
+def legacy_detect_type(msg_buf):
+  """The original linear scan over MessageType, kept as a reference"""
+  for msg_type in MessageType:
+    if msg_buf[1:2] == msg_type.value.bc:
+      return msg_type
+
+def bench_parse(count=20000):
+  """Parse cost of an empty frame of each message type"""
+  hmacf = make_hmacf(os.urandom(256))
+  stream = NullStream()
+  for (msg_class,msg_type),strategy in strategies.items():
+    if isinstance(strategy,BlockStrategy):
+      #Bulk frames only exist under bulk framing and have no fixed template
+      frame = strategy.build([b""],stream,hmacf,FRAMING_BULK)
+      parse = lambda: MessageStrategy.parse(frame,stream,hmacf,FRAMING_BULK)
+    elif msg_class == MessageClass.PRIVATE_MSG:
+      frame = bytearray(strategy.template)
+      frame[-_hash_size:] = hmacf(frame[1:-_hash_size])
+      parse = lambda: MessageStrategy.parse(frame,stream,hmacf)
+    else:
+      frame = bytearray(strategy.template)
+      parse = lambda: MessageStrategy.parse(frame)
+    assert parse()["MessageType"] == msg_type
+    parse_us = per_frame(parse,count)[0]
+    scan_us = per_frame(lambda: legacy_detect_type(frame),count)[0]
+    print("{:>11} {:>20}: parse {:6.2f} us (legacy type scan {:5.2f} us)".format(
+      msg_class.name,msg_type.name,parse_us,scan_us))
+
+def bench_bulk(total=2**26):
+  """Framing cost per MB of file data for XFER_FILE and bulk XFER_BLOCK frames"""
+  hmacf = make_hmacf(os.urandom(256))
+  stream = NullStream()
+  data = os.urandom(2**20)
+  cases = [("XFER_FILE",MessageType.XFER_FILE,_data_size,FRAMING_FIXED)]
+  cases += [("XFER_BLOCK {}K".format(size//1024),MessageType.XFER_BLOCK,size,FRAMING_BULK)
+            for size in (2**16,2**18,2**20)]
+  base = None
+  for name,msg_type,size,framing in cases:
+    strategy = strategies[(MessageClass.PRIVATE_MSG,msg_type)]
+    block = data[:size]
+    args = [block] if framing else [block,len(block)]
+    start = time.perf_counter()
+    for _ in range(total//size):
+      frame = strategy.build(args,stream,hmacf,framing)
+      MessageStrategy.parse(frame,stream,hmacf,framing)
+    cost = (time.perf_counter()-start)/(total/2**20)*1e3
+    base = base or cost
+    print("{:>16}: {:7.2f} ms per MB ({:.1f}x)".format(name,cost,base/cost))
+
+async def loop_stall(name,total,fn,*args):
+  """Coroutine to run fn and report throughput and the longest event loop stall meanwhile"""
+  stall = 0
+  done = asyncio.get_running_loop().create_future()
+  async def ticker():
+    nonlocal stall
+    last = time.perf_counter()
+    while not done.done():
+      await asyncio.sleep(0.001)
+      now = time.perf_counter()
+      stall = max(stall,now-last)
+      last = now
+  tick = asyncio.ensure_future(ticker())
+  start = time.perf_counter()
+  await fn(*args)
+  elapsed = time.perf_counter()-start
+  done.set_result(None)
+  await tick
+  print("{:>8}: {:6.1f} MB/s, longest loop stall {:6.2f} ms".format(
+    name,total/elapsed/2**20,stall*1e3))
+
+def bench_pipeline(total=2**26):
+  """Longest event loop stall while serving a download inline and through the pipeline"""
+  strategy = strategies[(MessageClass.PRIVATE_MSG,MessageType.XFER_BLOCK)]
+  hmacf = make_hmacf(os.urandom(256))
+  stream = RC4(os.urandom(256))
+  build = lambda data: strategy.build([data],stream,hmacf,FRAMING_BULK)
+  data = os.urandom(2**20)*(total//2**20)
+  async def drop(out_data):
+    await asyncio.sleep(0)
+  async def inline(fd):
+    block = fd.read(_bulk_block_size)
+    while block:
+      await drop(build(block))
+      block = fd.read(_bulk_block_size)
+  pool = TransferPool()
+  async def piped(fd):
+    await pool.download(fd,_bulk_block_size,build,drop)
+  async def run():
+    await loop_stall("inline",total,inline,io.BytesIO(data))
+    await loop_stall("pipeline",total,piped,io.BytesIO(data))
+  asyncio.run(run())
+  pool.close()
+
+def bench_upload(total=2**27):
+  """Longest event loop stall while receiving an upload inline and through write-behind"""
+  chunk = os.urandom(_data_size)
+  scratch = tempfile.mkdtemp()
+  async def inline(path):
+    with open(path,"wb") as fd:
+      for _ in range(total//len(chunk)):
+        fd.write(chunk)
+        await asyncio.sleep(0)
+      fd.flush()
+      os.fsync(fd.fileno())
+  pool = TransferPool(durability=DURABILITY_FINAL)
+  async def behind(path):
+    upload = pool.upload(open(path+".part","xb"),path+".part",path)
+    for _ in range(total//len(chunk)):
+      await upload.write(chunk)
+      await asyncio.sleep(0)
+    await pool.finish(upload)
+  async def run():
+    await loop_stall("inline",total,inline,os.path.join(scratch,"inline"))
+    await loop_stall("behind",total,behind,os.path.join(scratch,"behind"))
+  asyncio.run(run())
+  pool.close()
+
+def bench_database(subjects=2000,clients=200):
+  """Concurrent LIST_SUBJECT lookups run inline and through the coalescing database worker"""
+  from SPM.Database import Database, AsyncDatabase
+  scratch = tempfile.mkdtemp()
+  path = os.path.join(scratch,"sys.db")
+  root = os.path.join(scratch,"fileroot")
+  with Database(path,root) as db:
+    for i in range(subjects):
+      db.insertSubject("subject%d" % i,"bench","password")
+    start = time.perf_counter()
+    for _ in range(clients):
+      db.getSubjectNames()
+    inline = time.perf_counter()-start
+  async def run():
+    adb = AsyncDatabase(path,root)
+    start = time.perf_counter()
+    await asyncio.gather(*(adb.getSubjectNames() for _ in range(clients)))
+    elapsed = time.perf_counter()-start
+    adb.close()
+    return elapsed, adb.stats()
+  elapsed, stats = asyncio.run(run())
+  print("{} subject listings: inline {:.1f} ms, worker {:.1f} ms ({} of {} calls coalesced)".format(
+    clients,inline*1e3,elapsed*1e3,stats["coalesced"],stats["calls"]))
+
+def bench_profiles(count=2000):
+  """Inserts and lookups per second for subjects, objects and rights under each database profile"""
+  from SPM.Database import Database, profiles
+  for name in profiles:
+    scratch = tempfile.mkdtemp()
+    with Database(os.path.join(scratch,"sys.db"),os.path.join(scratch,"fileroot"),
+                  profile=name) as db:
+      subjects = ["subject%d" % i for i in range(count)]
+      objects = ["/object%d" % i for i in range(count)]
+      cases = [("subjects",lambda i: db.insertSubject(subjects[i],"bench","password"),
+                lambda i: db.getSubject(subjects[i])),
+               ("objects",lambda i: db.insertObject(objects[i]),
+                lambda i: db.getObject(objects[i])),
+               ("rights",lambda i: db.insertRight(subjects[i],"T/r",objects[i],True),
+                lambda i: db.getRight(subjects[i],"T/r",objects[i],True))]
+      results = []
+      for table,insert,lookup in cases:
+        start = time.perf_counter()
+        for i in range(count):
+          insert(i)
+        inserted = count/(time.perf_counter()-start)
+        start = time.perf_counter()
+        for i in range(count):
+          lookup(i)
+        looked = count/(time.perf_counter()-start)
+        results.append("{} {:7.0f}/{:7.0f}".format(table,inserted,looked))
+    print("{:>6} (insert/lookup per s): {}".format(name,", ".join(results)))
+
+def check_query_plans():
+  """Confirm the hot statements are served by the schema's secondary indexes"""
+  from SPM.Database import Database
+  scratch = tempfile.mkdtemp()
+  with Database(os.path.join(scratch,"sys.db"),os.path.join(scratch,"fileroot")) as db:
+    cases = [("delete from links where subject1=? or subject2=?",("a","a"),"links_subject2"),
+             ("delete from rights where target=? and isobject=1",("/a",),"rights_target"),
+             ("delete from rights where target=? and isobject=0",("a",),"rights_target"),
+             ("select subject,mask from rights where target=? and isobject=? and subject>? and mask&?!=0 order by subject limit ?",
+              ("a",0,"",1,31),"rights_target"),
+             ("select target,isobject,mask from rights where subject=? and (target,isobject)>(?,?) order by target,isobject limit ?",
+              ("a","",0,31),"sqlite_autoindex_rights"),
+             ("delete from objects where localpath=? or (localpath>=? and localpath<?)",
+              ("/a","/a/","/a0"),"sqlite_autoindex_objects"),
+             ("delete from rights where isobject=1 and (target=? or (target>=? and target<?))",
+              ("/a","/a/","/a0"),"rights_target"),
+             ("select hash from object_chunks where localpath=? order by seq",("/a",),
+              "sqlite_autoindex_object_chunks"),
+             ("update object_chunks set localpath=?||substr(localpath,?) where localpath=? or (localpath>=? and localpath<?)",
+              ("/b",3,"/a","/a/","/a0"),"sqlite_autoindex_object_chunks"),
+             ("delete from chunks where refs<=0 and hash in (select hash from object_chunks where localpath=? or (localpath>=? and localpath<?))",
+              ("/a","/a/","/a0"),"sqlite_autoindex_chunks"),
+             ("select * from filters where type2=?",("a",),"filters_type2"),
+             ("select localpath from objects where parent=? and localpath not in (?,?) order by localpath",("/","/.partial","/.chunks"),
+              "objects_parent")]
+    for statement,args,index in cases:
+      plan = db.queryPlan(statement,args)
+      print("{:>50}: {}".format(statement,"; ".join(plan)))
+      assert any(index in step for step in plan), "%s does not use %s" % (statement,index)
+      assert not any(step.startswith("SCAN") for step in plan), "%s scans a table" % statement
+      assert not any("TEMP B-TREE" in step for step in plan), "%s sorts its results" % statement
+
+def bench_listing(dirs=1000,files=100):
+  """Cost of listing the root of a large tree through the parent index and the old LIKE scan"""
+  from SPM.Database import Database
+  scratch = tempfile.mkdtemp()
+  with Database(os.path.join(scratch,"sys.db"),os.path.join(scratch,"fileroot"),
+                profile="fast") as db:
+    rows = [("/dir%d" % d,True,"/") for d in range(dirs)]
+    rows += [("/dir%d/file%d" % (d,f),False,"/dir%d" % d) for d in range(dirs) for f in range(files)]
+    db.c.execute("begin immediate transaction")
+    db.c.executemany("insert into objects(localpath,dir,parent) values(?,?,?)",rows)
+    db.c.execute("end transaction")
+    def legacy(cd):
+      cd_e = cd.replace("_","\\_").replace("%","\\%") + "%"
+      return [o[0] for o in db.c.execute("select localpath from objects where localpath like ? escape ?",
+                                         (cd_e,"\\")) if len(o[0].split(os.sep)) == len(cd.split(os.sep))]
+    assert sorted(legacy("/")) == db.getObjectNames("/")
+    indexed = per_frame(lambda: db.getObjectNames("/"),20)[0]
+    scanned = per_frame(lambda: legacy("/"),20)[0]
+    print("List / of {} objects: indexed {:.2f} ms, LIKE scan {:.2f} ms".format(
+      len(rows),indexed/1e3,scanned/1e3))
+
+def bench_cache(count=20000):
+  """Subject, link and filter lookups per second with and without the read cache"""
+  from SPM.Database import Database
+  scratch = tempfile.mkdtemp()
+  path = os.path.join(scratch,"sys.db")
+  root = os.path.join(scratch,"fileroot")
+  with Database(path,root) as db:
+    for i in range(100):
+      db.insertSubject("subject%d" % i,"bench","password")
+    db.insertLink("subject0","subject1")
+    db.insertFilter("bench","bench","T/r")
+  for cache_size in (0,4096):
+    with Database(path,root,cache_size=cache_size) as db:
+      start = time.perf_counter()
+      for i in range(count):
+        db.getSubject("subject%d" % (i%100))
+        db.getLink("subject%d" % (i%100),"subject1")
+        db.getFilter("bench","bench","T/r")
+      rate = 3*count/(time.perf_counter()-start)
+      print("cache {:>5}: {:8.0f} lookups/s {}".format(cache_size,rate,db.cacheStats()))
+
+def bench_batch(count=3000):
+  """Provisioning subjects, links and rights one call at a time and in batches"""
+  from SPM.Database import Database
+  for batched in (False,True):
+    scratch = tempfile.mkdtemp()
+    with Database(os.path.join(scratch,"sys.db"),os.path.join(scratch,"fileroot")) as db:
+      subjects = [("user%d" % i,"bench","password") for i in range(count)]
+      links = [("user%d" % i,"user%d" % (i+1)) for i in range(count-1)]
+      rights = [("user%d" % i,"T/r","user%d" % (i+1),False) for i in range(count-1)]
+      start = time.perf_counter()
+      if batched:
+        db.insertSubjects(subjects)
+        db.insertLinks(links)
+        db.insertRights(rights)
+      else:
+        [db.insertSubject(*record) for record in subjects]
+        [db.insertLink(*record) for record in links]
+        [db.insertRight(*record) for record in rights]
+      print("{:>7}: {} records in {:.2f} s".format("batched" if batched else "single",
+        len(subjects)+len(links)+len(rights),time.perf_counter()-start))
+
+def bench_authorization(count=2000,checks=20000):
+  """Transfer checks against the tables with SQL and against the compiled engine"""
+  from SPM.Database import Database
+  scratch = tempfile.mkdtemp()
+  with Database(os.path.join(scratch,"sys.db"),os.path.join(scratch,"fileroot")) as db:
+    db.insertSubjects([("user%d" % i,"type%d" % (i%8),"password") for i in range(count)])
+    db.insertLinks([("user%d" % i,"user%d" % (i+1)) for i in range(count-1)])
+    for i in range(8):
+      db.insertFilter("type%d" % i,"type%d" % ((i+1)%8),"T/r")
+    pairs = [("user%d" % (i%(count-1)),"user%d" % (i%(count-1)+1)) for i in range(checks)]
+    def sql(subject1,subject2,ticket):
+      s1 = db.selectSubject(subject1)
+      s2 = db.selectSubject(subject2)
+      return bool(s1 and s2 and db.selectLink(subject1,subject2)
+                  and db.selectFilter(s1.type,s2.type,ticket))
+    for name,check in (("sql",sql),("compiled",db.mayTransfer)):
+      start = time.perf_counter()
+      assert all(check(subject1,subject2,"T/r") for subject1,subject2 in pairs)
+      elapsed = time.perf_counter()-start
+      print("{:>8}: {:.1f} us per check".format(name,elapsed/checks*1e6))
+    #Changes made here and by other connections must both be seen
+    assert not db.mayTransfer("user1","user2","T/w")
+    db.deleteFilter("type1","type2","T/r")
+    assert not db.mayTransfer("user1","user2","T/r")
+    with Database(os.path.join(scratch,"sys.db"),os.path.join(scratch,"fileroot")) as other:
+      other.insertFilter("type1","type2","T/r")
+      other.clearLinks("user3")
+    assert db.mayTransfer("user1","user2","T/r")
+    assert not db.mayTransfer("user3","user4","T/r")
+    db.insertRight("user1","T/r","user0")
+    db.transferRight("user1","user2","T/r","user0")
+    assert db.getRight("user2","T/r","user0") and not db.getRight("user1","T/r","user0")
+    print(db.authzStats())
+
+def bench_rights(subjects=10000,objects=10):
+  """Rights rows before and after packing, and paging through them"""
+  import sqlite3
+  from SPM.Database import Database
+  from SPM.Tickets import Right
+  scratch = tempfile.mkdtemp()
+  path = os.path.join(scratch,"sys.db")
+  #Write a database as the schema stood before rights were packed
+  conn = sqlite3.connect(path,isolation_level=None)
+  [conn.execute(s) for s in Database.tables]
+  [conn.execute(s) if isinstance(s,str) else s(conn.cursor()) for m in Database.migrations[:3] for s in m]
+  conn.execute("pragma user_version=3")
+  conn.execute("begin")
+  conn.executemany("insert into subjects values(?,?,?,?)",
+                   [("user%d" % i,"password","bench",0) for i in range(subjects)])
+  conn.executemany("insert into objects(localpath,dir,parent) values(?,0,'/')",
+                   [("/file%d" % i,) for i in range(objects)])
+  conn.executemany("insert into rights values(?,?,?,1)",
+                   [("user%d" % i,"T/%s" % right.name,"/file%d" % j)
+                    for i in range(subjects) for j in range(objects) for right in Right])
+  conn.execute("commit")
+  before = conn.execute("select count(*) from rights").fetchone()[0]
+  conn.close()
+  start = time.perf_counter()
+  with Database(path,os.path.join(scratch,"fileroot")) as db:
+    migrated = time.perf_counter()-start
+    after = db.c.execute("select count(*) from rights").fetchone()[0]
+    print("rights rows: {} -> {} (migrated in {:.2f} s), file {:.1f} MB".format(before,after,migrated,
+          os.path.getsize(path)/2**20))
+    assert db.getRight("user7","T/w","/file3",True)
+    db.deleteRight("user7","T/w","/file3",True)
+    assert not db.getRight("user7","T/w","/file3",True) and db.getRight("user7","T/g","/file3",True)
+    start = time.perf_counter()
+    holders, last = [], ""
+    while True:
+      page = db.getRightHolders("T/r","/file3",True,last,31)
+      holders += page[:30]
+      if len(page) <= 30:
+        break
+      last = page[29][0]
+    print("{} holders of T/r on /file3 paged in {:.2f} s".format(len(holders),time.perf_counter()-start))
+    assert len(holders) == subjects and len(set(h[0] for h in holders)) == subjects
+    assert len(db.getRightsHeld("user7")) == objects
+
+def bench_share(count=100000,degree=3,types=8,queries=2000):
+  """Can-share queries and incremental updates on a large random links graph"""
+  import random
+  from SPM.Database import Database
+  rng = random.Random(22)
+  scratch = tempfile.mkdtemp()
+  path = os.path.join(scratch,"sys.db")
+  names = ["user%d" % i for i in range(count)]
+  with Database(path,os.path.join(scratch,"fileroot"),profile="fast") as db:
+    start = time.perf_counter()
+    db.insertSubjects([(name,"type%d" % rng.randrange(types),"password") for name in names])
+    db.insertLinks([(name,rng.choice(names)) for name in names for _ in range(degree)])
+    for i in range(types):
+      for j in rng.sample(range(types),types//2):
+        db.insertFilter("type%d" % i,"type%d" % j,"T/r")
+    print("{} subjects, {} links built in {:.1f} s".format(count,count*degree,time.perf_counter()-start))
+    sources = rng.sample(names,20)
+    pairs = [(rng.choice(sources),rng.choice(names)) for _ in range(queries)]
+    start = time.perf_counter()
+    [db.canShare(source,source,"T/r") for source in sources]
+    first = (time.perf_counter()-start)/len(sources)
+    start = time.perf_counter()
+    shared = sum(db.canShare(subject1,subject2,"T/r") for subject1,subject2 in pairs)
+    cached = (time.perf_counter()-start)/queries
+    print("can-share: first {:.1f} ms per source, then {:.1f} us per query ({} of {} shareable)".format(
+          first*1e3,cached*1e6,shared,queries))
+    updates = [("insertLink",lambda: db.insertLink(rng.choice(names),rng.choice(names))),
+               ("deleteLink",lambda: db.deleteLink(*rng.choice(tuple(
+                   (s1,s2) for s1 in rng.sample(names,10) for s2 in db.authz.links.get(s1,()))))),
+               ("insertFilter",lambda: db.insertFilter("type%d" % rng.randrange(types),
+                                                      "type%d" % rng.randrange(types),"T/r")),
+               ("deleteFilter",lambda: db.deleteFilter("type%d" % rng.randrange(types),
+                                                      "type%d" % rng.randrange(types),"T/r")),
+               ("deleteSubject",lambda: db.deleteSubject(rng.choice(names)))]
+    for name,update in updates:
+      [db.canShare(source,source,"T/r") for source in sources]
+      start = time.perf_counter()
+      for _ in range(5):
+        try:
+          update()
+        except Exception:
+          pass
+      print("{:>13}: {:.1f} ms each with {} sets kept".format(name,(time.perf_counter()-start)/5*1e3,
+            db.authz.shares.stats()["sets"]))
+    #The incrementally kept sets must agree with a fresh load
+    with Database(path,os.path.join(scratch,"fileroot")) as fresh:
+      for right in ("T/r","T/w"):
+        for subject1,subject2 in pairs[:200]:
+          assert db.canShare(subject1,subject2,right) == fresh.canShare(subject1,subject2,right)
+    print(db.authzStats()["shares"])
+
+def bench_subtree(dirs=200,files=50,size=2**16):
+  """Copying, moving and deleting a large directory tree with its rights"""
+  from SPM.Database import Database
+  scratch = tempfile.mkdtemp()
+  with Database(os.path.join(scratch,"sys.db"),os.path.join(scratch,"fileroot"),profile="fast") as db:
+    db.insertSubjects([("user%d" % i,"bench","password") for i in range(10)])
+    db.insertObject("/tree",True)
+    data = os.urandom(size)
+    paths = []
+    for i in range(dirs):
+      db.insertObject("/tree/d%d" % i,True)
+      for j in range(files):
+        path = "/tree/d%d/f%d" % (i,j)
+        db.insertObject(path)
+        with db.writeObject(path) as fd:
+          fd.write(data)
+        paths.append(path)
+    db.insertRights([("user%d" % (k%10),"T/r",path,True) for k,path in enumerate(paths)])
+    total = len(paths)+dirs+1
+    count = lambda prefix: db.c.execute("select count(*) from objects where localpath=? or localpath like ?",
+                                        (prefix,prefix+"/%")).fetchone()[0]
+    start = time.perf_counter()
+    db.copyObject("/tree","/copy")
+    copied = time.perf_counter()-start
+    start = time.perf_counter()
+    db.moveObject("/copy","/moved")
+    moved = time.perf_counter()-start
+    assert count("/moved") == total and count("/copy") == 0
+    assert db.getRight("user3","T/r","/moved/d0/f3",True)
+    with db.readObject("/moved/d%d/f%d" % (dirs-1,files-1)) as fd:
+      assert fd.read() == data
+    start = time.perf_counter()
+    db.deleteObject("/moved")
+    deleted = time.perf_counter()-start
+    assert count("/moved") == 0 and not db.getRight("user3","T/r","/moved/d0/f3",True)
+    #As a client had to before: one delete per path, deepest first
+    start = time.perf_counter()
+    for path in reversed(["/tree"]+["/tree/d%d" % i for i in range(dirs)]+paths):
+      db.deleteObject(path)
+    single = time.perf_counter()-start
+    print("{} objects, {:.0f} MB: copy {:.2f} s, move {:.3f} s, delete {:.2f} s, delete per path {:.2f} s".format(
+          total,len(paths)*size/2**20,copied,moved,deleted,single))
+
+def bench_metadata(files=2000,size=2**16):
+  """Comparing a directory's content by recorded metadata versus hashing every file"""
+  import hashlib
+  from SPM.Database import Database
+  scratch = tempfile.mkdtemp()
+  with Database(os.path.join(scratch,"sys.db"),os.path.join(scratch,"fileroot"),profile="fast") as db:
+    for i in range(files):
+      path = "/f%d" % i
+      data = os.urandom(size)
+      db.insertObject(path)
+      with db.writeObject(path) as fd:
+        fd.write(data)
+      db.updateObject(path,size,os.path.getmtime(os.path.join(db.root,path[1:])),hashlib.md5(data).digest())
+    start = time.perf_counter()
+    digests = dict()
+    for name in os.listdir(db.root):
+      if "/" + name in db.reserved:
+        continue
+      with open(os.path.join(db.root,name),"rb") as fd:
+        digests[name] = hashlib.md5(fd.read()).digest()
+    hashed = time.perf_counter()-start
+    start = time.perf_counter()
+    recorded = {os.path.basename(o.localpath): o.hash for o in db.getObjectDetails("/")}
+    listed = time.perf_counter()-start
+    assert recorded == digests
+    print("{} files: hashing {:.2f} s, detailed listing {:.1f} ms".format(files,hashed,listed*1e3))
+
+def disk_usage(path):
+  """Bytes allocated on disk to the files below a directory"""
+  total = 0
+  for folder,dirs,files in os.walk(path):
+    total += sum(os.stat(os.path.join(folder,name)).st_blocks*512 for name in files)
+  return total
+
+def snapshots(versions=8,files=24,size=2**20,image=2**25,seed=1):
+  """Nightly snapshots of a project folder: each night edits a few files and patches a disk image
+
+  Yields (path,data) for every file of every snapshot. Edits insert, overwrite
+    and append small runs of bytes, so most content repeats at shifted offsets"""
+  import random
+  rng = random.Random(seed)
+  current = {"/image.bin": bytearray(os.urandom(image))}
+  for i in range(files):
+    current["/src%d.dat" % i] = bytearray(os.urandom(rng.randrange(size//4,size*2)))
+  for version in range(versions):
+    if version:
+      for name in rng.sample(sorted(current),max(1,files//6)):
+        data = current[name]
+        at = rng.randrange(len(data))
+        edit = rng.choice(("insert","overwrite","append"))
+        patch = os.urandom(rng.randrange(1,4096))
+        if edit == "insert":
+          data[at:at] = patch
+        elif edit == "overwrite":
+          data[at:at+len(patch)] = patch
+        else:
+          data += patch
+      image = current["/image.bin"]
+      for _ in range(16):
+        at = rng.randrange(0,len(image)-4096)
+        image[at:at+4096] = os.urandom(4096)
+    for name,data in sorted(current.items()):
+      yield "/v%d%s" % (version,name), bytes(data)
+
+def bench_dedup(versions=8):
+  """Disk usage and ingest rate of duplicate-heavy snapshots, in plain files versus the chunk store"""
+  import hashlib
+  from SPM.Database import Database
+  for chunked in (False,True):
+    scratch = tempfile.mkdtemp()
+    with Database(os.path.join(scratch,"sys.db"),os.path.join(scratch,"fileroot"),profile="fast",
+                  chunked=chunked) as db:
+      logical = 0
+      elapsed = 0.0
+      last = dict()
+      last_bytes = 0
+      for version in range(versions):
+        db.insertObject("/v%d" % version,True)
+      for path,data in snapshots(versions):
+        db.insertObject(path)
+        start = time.perf_counter()
+        with db.writeObject(path) as fd:
+          fd.write(data)
+        elapsed += time.perf_counter()-start
+        logical += len(data)
+        if path.startswith("/v%d/" % (versions-1)):
+          last[path] = hashlib.md5(data).digest()
+          last_bytes += len(data)
+      start = time.perf_counter()
+      for path,digest in last.items():
+        with db.readObject(path) as fd:
+          assert hashlib.md5(fd.read()).digest() == digest
+      read = time.perf_counter()-start
+      used = disk_usage(db.root)
+      start = time.perf_counter()
+      db.copyObject("/v%d" % (versions-1),"/copy")
+      copied = time.perf_counter()-start
+      copy_used = disk_usage(db.root) - used
+      for version in range(versions-1):
+        db.deleteObject("/v%d" % version)
+      db.collectChunks(0)
+      kept = disk_usage(db.root)
+      print("{:>7}: {:.0f} MB in {:.0f} MB on disk ({:.1f}x), ingest {:.0f} MB/s, read {:.0f} MB/s, copy {:.2f} s (+{:.0f} MB), after pruning {:.0f} MB".format(
+            "chunks" if chunked else "files",logical/2**20,used/2**20,logical/used,logical/elapsed/2**20,
+            last_bytes/read/2**20,copied,copy_used/2**20,kept/2**20))
+
+def rss_kb(pid):
+  """Resident set size of a process in KiB (Linux only)"""
+  with open("/proc/%d/status" % pid) as f:
+    for line in f:
+      if line.startswith("VmRSS:"):
+        return int(line.split()[1])
+
+def serve_object(port,size):
+  """Serve a single sparse object of the given size from a scratch directory"""
+  os.chdir(tempfile.mkdtemp())
+  from SPM.Database import Database
+  from SPM.Server import Server
+  with Database() as db:
+    db.insertSubject("bench","bench","password",True)
+    db.insertObject("/large")
+    with db.writeObject("/large") as fd:
+      fd.truncate(size)
+  Server("localhost",port).mainloop()
+
+def bench_slow_reader(size=2**30,rate=2**22,port=5155):
+  """Server memory while a reader slower than the server downloads a large object"""
+  server = multiprocessing.Process(target=serve_object,args=(port,size),daemon=True)
+  server.start()
+  try:
+    client = Client("localhost",port)
+    for _ in range(100):
+      try:
+        client.greetServer()
+        break
+      except ConnectionRefusedError:
+        client.socket.close()
+        client.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        time.sleep(0.1)
+    assert client.authenticate("bench","password")
+    base = peak = rss_kb(server.pid)
+    client.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.PULL_FILE)].build(
+                          ["/large"],client.stream,client.hmacf,client.framing))
+    #Read the raw frames at a fixed rate without decrypting them
+    received = 0
+    throttled = 0
+    early = None
+    start = time.perf_counter()
+    while received < size:
+      chunk = client.socket.recv(65536)
+      assert chunk, "Server closed the connection"
+      received += len(chunk)
+      peak = max(peak,rss_kb(server.pid))
+      if early is None and received >= size//4:
+        early = peak
+      lag = received/rate - (time.perf_counter()-start)
+      if lag > 0:
+        time.sleep(lag)
+        throttled += 1
+    client.socket.close()
+    #A server slower than the rate never fills its buffers, which would prove nothing
+    assert throttled, "The reader was never slower than the server"
+    #Every block alive at once with its encoded copy: the read-ahead window, the
+    #  one the reader holds, the one being encoded and the one being sent. Then
+    #  the transport buffer, and a freed block and copy kept by the allocator of
+    #  each pool thread. None of it depends on the object size
+    limit = (_xfer_window+3)*_read_ahead_size*2 + _write_high_water + _xfer_workers*_read_ahead_size*2
+    print("Slow reader {} MB at {} MB/s: server RSS {} KiB before, {} KiB after a quarter, {} KiB peak (+{} KiB, limit {} KiB)".format(
+      size//2**20,rate//2**20,base,early,peak,peak-base,limit//1024))
+    assert (peak-base)*1024 < limit, "Server memory exceeds what the pipeline settings allow"
+    assert (peak-early)*1024 < _xfer_workers*_read_ahead_size, "Server memory grew with the object size"
+  finally:
+    server.terminate()
+    server.join()
+
+def main():
+  """Run every benchmark"""
+  bench_stream()
+  bench_messages()
+  bench_parse()
+  bench_bulk()
+  bench_pipeline()
+  bench_upload()
+  bench_database()
+  bench_profiles()
+  check_query_plans()
+  bench_listing()
+  bench_cache()
+  bench_batch()
+  bench_authorization()
+  bench_rights()
+  bench_share()
+  bench_subtree()
+  bench_metadata()
+  bench_dedup()
+  bench_slow_reader()
+
+if __name__=='__main__':
+  print("I'm main!")
+  main()
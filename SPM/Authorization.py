@@ -0,0 +1,270 @@
+
+from collections import OrderedDict
+
+from SPM.Tickets import Right
+
+from . import _share_cache_size
+
+#Authorization
+#
+#A ticket may move from one subject to another only when a link runs from the
+#  first subject to the second and a filter allows the ticket between their
+#  types. Rather than asking SQLite for the subjects, the link and the filter on
+#  every transfer, the tables are compiled once into memory: each subject type
+#  gets a bit position, each right keeps one bitset of allowed second types per
+#  first type, and links become adjacency sets in both directions. A check is
+#  then a few dictionary lookups and a bit test however large the tables grow.
+#  The owner applies every change to the tables here as it commits them, and
+#  loads everything again when another process has changed them
+#
+#Whether a right can ever flow from one subject to another is reachability in
+#  the graph of links whose filters allow that right. The share index answers it
+#  from the set of subjects reachable from the source, found by one search the
+#  first time the source is asked about and kept afterwards. A new link or
+#  filter only adds edges, so every kept set that reaches the new edge grows by
+#  a search from its far end. A removed link or filter can only shrink the sets
+#  that passed through it, and just those are dropped to be searched again
+
+class Authorization:
+  """Compiled links and type filters answering whether a ticket may be transferred"""
+
+  def __init__(self):
+    self.types = dict() #Type name to bit position
+    self.subjects = dict() #Subject name to (type bit position, super)
+    self.links = dict() #Subject to the subjects it links to
+    self.linked = dict() #Subject to the subjects linking to it
+    self.members = dict() #Type bit position to the subjects of that type
+    self.filters = {right: dict() for right in Right} #Type position to bitset of second types
+    self.loads = 0
+    self.updates = 0
+    self.checks = 0
+    self.denied = 0
+    self.shares = ShareIndex(self)
+
+  def load(self,c):
+    """Compile the subjects, links and filters tables read through a cursor"""
+    self.types.clear()
+    self.subjects.clear()
+    self.links.clear()
+    self.linked.clear()
+    self.members.clear()
+    self.shares.clear()
+    for bitsets in self.filters.values():
+      bitsets.clear()
+    for subject,stype,super in c.execute("select subject,type,super from subjects").fetchall():
+      self.subjects[subject] = (self.position(stype),bool(super))
+      self.members.setdefault(self.subjects[subject][0],set()).add(subject)
+    for subject1,subject2 in c.execute("select subject1,subject2 from links").fetchall():
+      self.links.setdefault(subject1,set()).add(subject2)
+      self.linked.setdefault(subject2,set()).add(subject1)
+    for type1,type2,ticket in c.execute("select type1,type2,ticket from filters").fetchall():
+      bitsets = self.filters[ticket.right]
+      type1 = self.position(type1)
+      bitsets[type1] = bitsets.get(type1,0) | 1 << self.position(type2)
+    self.loads += 1
+
+  def position(self,stype):
+    """Bit position of a subject type, assigning the next free one to a new type"""
+    return self.types.setdefault(stype,len(self.types))
+
+  def addSubject(self,name,stype,super=False):
+    """Record a new subject and its type"""
+    self.subjects[name] = (self.position(stype),bool(super))
+    self.members.setdefault(self.subjects[name][0],set()).add(name)
+    self.updates += 1
+
+  def removeSubject(self,name):
+    """Forget a subject and every link to or from it"""
+    self.clearLinks(name)
+    if name in self.subjects:
+      self.members[self.subjects.pop(name)[0]].discard(name)
+    self.shares.removed(name)
+
+  def addLink(self,subject1,subject2):
+    """Record a link from one subject to another"""
+    self.links.setdefault(subject1,set()).add(subject2)
+    self.linked.setdefault(subject2,set()).add(subject1)
+    self.updates += 1
+    for right in Right:
+      if self.allows(right,subject1,subject2):
+        self.shares.added(right,subject1,subject2)
+
+  def removeLink(self,subject1,subject2):
+    """Forget a link from one subject to another"""
+    if subject2 in self.links.get(subject1,()):
+      self.links[subject1].discard(subject2)
+      self.linked[subject2].discard(subject1)
+      self.shares.cut(subject1,subject2)
+    self.updates += 1
+
+  def clearLinks(self,name):
+    """Forget every link to or from a subject"""
+    for subject2 in self.links.pop(name,()):
+      self.linked[subject2].discard(name)
+      self.shares.cut(name,subject2)
+    for subject1 in self.linked.pop(name,()):
+      self.links[subject1].discard(name)
+      self.shares.cut(subject1,name)
+    self.updates += 1
+
+  def addFilter(self,type1,type2,ticket):
+    """Allow a ticket to move from subjects of one type to subjects of another"""
+    bitsets = self.filters[ticket.right]
+    type1 = self.position(type1)
+    type2 = self.position(type2)
+    if bitsets.get(type1,0) >> type2 & 1:
+      return
+    bitsets[type1] = bitsets.get(type1,0) | 1 << type2
+    self.updates += 1
+    self.shares.widened(ticket.right,type1,type2)
+
+  def removeFilter(self,type1,type2,ticket):
+    """Stop a ticket moving from subjects of one type to subjects of another"""
+    if type1 in self.types and type2 in self.types:
+      bitsets = self.filters[ticket.right]
+      type1 = self.types[type1]
+      bitsets[type1] = bitsets.get(type1,0) & ~(1 << self.types[type2])
+      self.shares.filtered(ticket.right,type1,self.types[type2])
+    self.updates += 1
+
+  def isSuper(self,name):
+    """Check whether a subject is a superuser, who is not held to the model"""
+    return name in self.subjects and self.subjects[name][1]
+
+  def allows(self,right,subject1,subject2):
+    """Check whether the filters let a right pass between the types of two subjects"""
+    type1 = self.subjects[subject1][0]
+    type2 = self.subjects[subject2][0]
+    return bool(self.filters[right].get(type1,0) >> type2 & 1)
+
+  def mayTransfer(self,subject1,subject2,ticket):
+    """Check whether subject1 may pass a ticket to subject2"""
+    self.checks += 1
+    if subject1 in self.subjects and subject2 in self.subjects \
+       and subject2 in self.links.get(subject1,()) \
+       and self.allows(ticket.right,subject1,subject2):
+      return True
+    self.denied += 1
+    return False
+
+  def canShare(self,subject1,subject2,ticket):
+    """Check whether a ticket could ever flow from subject1 to subject2 through links and filters"""
+    if subject1 not in self.subjects or subject2 not in self.subjects:
+      return False
+    return subject2 in self.shares.reach(ticket.right,subject1)
+
+  def stats(self):
+    """Snapshot of the compiled tables and counters"""
+    return {"types": len(self.types), "subjects": len(self.subjects),
+            "links": sum(len(s) for s in self.links.values()), "loads": self.loads,
+            "updates": self.updates, "checks": self.checks, "denied": self.denied,
+            "shares": self.shares.stats()}
+
+class ShareIndex:
+  """Subjects reachable from each recently asked source, per right, kept current as links and filters change"""
+
+  def __init__(self,authz,size=_share_cache_size):
+    assert size > 0
+    self.authz = authz
+    self.size = size
+    self.sets = OrderedDict() #(right,source) to the subjects reachable from it, source included
+    self.entries = 0
+    self.hits = 0
+    self.searches = 0
+    self.extended = 0
+    self.dropped = 0
+
+  def search(self,right,start,reach,shortcut=False):
+    """Add every subject reachable from start over edges allowing a right to reach
+
+    With shortcut, a subject whose own set is kept contributes that set
+      instead of being searched again. Only safe while every kept set is
+      complete, which is not so in the middle of growing them"""
+    authz = self.authz
+    bitsets = authz.filters[right]
+    subjects = authz.subjects
+    links = authz.links
+    sets = self.sets
+    size = len(reach)
+    stack = [start]
+    reach.add(start)
+    while stack:
+      subject1 = stack.pop()
+      allowed = bitsets.get(subjects[subject1][0],0)
+      for subject2 in links.get(subject1,()):
+        if subject2 not in reach and allowed >> subjects[subject2][0] & 1:
+          known = sets.get((right,subject2)) if shortcut else None
+          if known is not None:
+            reach |= known
+          else:
+            reach.add(subject2)
+            stack.append(subject2)
+    return len(reach)-size
+
+  def reach(self,right,source):
+    """Set of subjects a right can flow to from a source, searching on a miss"""
+    key = (right,source)
+    reach = self.sets.get(key)
+    if reach is not None:
+      self.sets.move_to_end(key)
+      self.hits += 1
+      return reach
+    reach = set()
+    self.search(right,source,reach,shortcut=True)
+    self.searches += 1
+    self.sets[key] = reach
+    self.entries += len(reach)
+    #Keep the most recent set even when it alone is over the limit
+    while self.entries > self.size and len(self.sets) > 1:
+      self.entries -= len(self.sets.popitem(last=False)[1])
+    return reach
+
+  def added(self,right,subject1,subject2):
+    """A new edge lets a right pass from subject1 to subject2; grow the sets that reach it"""
+    for (r,source),reach in self.sets.items():
+      if r is right and subject1 in reach and subject2 not in reach:
+        self.entries += self.search(right,subject2,reach)
+        self.extended += 1
+
+  def widened(self,right,type1,type2):
+    """A new filter lets a right pass between two types; grow the sets holding subjects of the first"""
+    authz = self.authz
+    for (r,source),reach in self.sets.items():
+      if r is not right:
+        continue
+      for subject1 in reach & authz.members.get(type1,set()):
+        for subject2 in authz.links.get(subject1,()):
+          if subject2 not in reach and authz.subjects[subject2][0] == type2:
+            self.entries += self.search(right,subject2,reach)
+            self.extended += 1
+
+  def drop(self,keys):
+    """Forget the given sets"""
+    for key in keys:
+      self.entries -= len(self.sets.pop(key))
+      self.dropped += 1
+
+  def cut(self,subject1,subject2):
+    """A link is gone; forget the sets that may have crossed it"""
+    self.drop([key for key,reach in self.sets.items() if subject1 in reach and subject2 in reach])
+
+  def filtered(self,right,type1,type2):
+    """A filter is gone; forget the sets for its right that hold subjects of both types"""
+    members = self.authz.members
+    self.drop([key for key,reach in self.sets.items() if key[0] is right
+               and not reach.isdisjoint(members.get(type1,()))
+               and not reach.isdisjoint(members.get(type2,()))])
+
+  def removed(self,name):
+    """A subject is gone; forget the sets searched from it"""
+    self.drop([key for key in self.sets if key[1] == name])
+
+  def clear(self):
+    """Forget every set"""
+    self.sets.clear()
+    self.entries = 0
+
+  def stats(self):
+    """Snapshot of the index counters"""
+    return {"sets": len(self.sets), "entries": self.entries, "hits": self.hits,
+            "searches": self.searches, "extended": self.extended, "dropped": self.dropped}
@@ -0,0 +1,240 @@
+
+import hashlib
+import os
+import time
+
+from . import _chunk_min, _chunk_max, _chunk_bits, _chunk_grace
+
+#Chunk Store
+#
+#Chunked objects are split where their content says so rather than at fixed
+#  offsets, so an insertion early in a large file only changes the chunks
+#  around it and the rest are found again in the store. Each byte is mapped to
+#  two pseudo-random bits, one letter of ACGT, with bytes.translate, and a chunk
+#  ends where the last letters spell a fixed pattern of _chunk_bits bits, found
+#  with bytearray.find. Both run at C speed, with no per-byte Python loop; two
+#  bits a byte keeps the window to eight bytes while giving find enough of an
+#  alphabet to skip ahead quickly. Chunks are at least _chunk_min
+#  bytes and cut at _chunk_max bytes when no pattern turns up, which is what
+#  happens for runs of identical bytes
+#
+#Each chunk is stored once under the hex SHA-256 of its content, fanned out by
+#  the first byte. The database keeps the chunk list of every object and a
+#  reference count per chunk, dropping the count row when no object uses the
+#  chunk any more. Files with no row are garbage, removed by a sweep once they
+#  have not been touched for a grace period. Writers touch a chunk they find
+#  already stored, and the sweep moves a chunk aside before its last look at
+#  the time: a touch that came first puts the chunk back, and a writer coming
+#  later no longer finds it and stores it again. Either way a chunk an upload
+#  still needs is not lost, as long as the upload is shorter than the grace
+
+_letters = bytes(b"ACGT"[hashlib.sha256(bytes([b])).digest()[0] & 3] for b in range(256))
+_pattern = b"GATTACACTGCAGTCA"[:_chunk_bits//2]
+
+def chunk_path(store,digest):
+  """Path of a chunk in a store directory"""
+  name = digest.hex()
+  return os.path.join(store,name[:2],name)
+
+def collect_chunks(store,referenced,grace=_chunk_grace):
+  """Remove the chunks of a store no object refers to, once untouched for grace seconds
+
+  Referenced is called with a set of digests and returns those still in use.
+    Returns the number of files and bytes removed"""
+  removed = 0
+  freed = 0
+  cutoff = time.time()-grace
+  if not os.path.isdir(store):
+    return {"removed": removed, "freed": freed}
+  for fanout in os.scandir(store):
+    if not fanout.is_dir():
+      continue
+    old = dict()
+    for entry in os.scandir(fanout.path):
+      if entry.stat().st_mtime < cutoff:
+        old[entry.name] = entry.path
+    digests = dict()
+    for name in old:
+      try:
+        digests[bytes.fromhex(name)] = name
+      except ValueError:
+        pass #A partial chunk left by a failed writer
+    kept = {digests[h] for h in referenced(set(digests))}
+    for name,path in old.items():
+      if name in kept:
+        continue
+      aside = "%s.%s" % (path,os.urandom(8).hex())
+      try:
+        os.rename(path,aside)
+      except FileNotFoundError:
+        continue
+      stat = os.stat(aside)
+      if stat.st_mtime >= cutoff:
+        #A writer touched it since the scan; any copy it stored since is identical
+        os.replace(aside,path)
+        continue
+      os.remove(aside)
+      removed += 1
+      freed += stat.st_size
+  return {"removed": removed, "freed": freed}
+
+class Chunker:
+  """Split a stream of data into content-defined chunks"""
+
+  def __init__(self,minimum=_chunk_min,maximum=_chunk_max):
+    assert len(_pattern) <= minimum <= maximum
+    self.minimum = minimum
+    self.maximum = maximum
+    self.pending = bytearray()
+    self.letters = bytearray()
+    self.scanned = 0
+
+  def feed(self,data):
+    """Add data, returning every chunk it completes"""
+    self.pending += data
+    self.letters += bytes(data).translate(_letters)
+    chunks = []
+    start = 0
+    size = len(_pattern)
+    while True:
+      found = self.letters.find(_pattern,start+max(self.scanned,self.minimum-size),start+self.maximum)
+      if found >= 0:
+        end = found+size
+      elif len(self.pending)-start >= self.maximum:
+        end = start+self.maximum
+      else:
+        #A pattern may still finish in data not received yet
+        self.scanned = max(len(self.letters)-start-size+1,0)
+        break
+      chunks.append(bytes(self.pending[start:end]))
+      start = end
+      self.scanned = 0
+    del self.pending[:start]
+    del self.letters[:start]
+    return chunks
+
+  def finish(self):
+    """Return the last chunk, if any data is left"""
+    chunk = bytes(self.pending)
+    self.pending = bytearray()
+    self.letters = bytearray()
+    self.scanned = 0
+    return [chunk] if chunk else []
+
+class ChunkWriter:
+  """File-like sink storing what is written to it as chunks, keeping the list of chunks written"""
+
+  def __init__(self,store,on_close=None):
+    self.store = store
+    self.on_close = on_close
+    self.chunker = Chunker()
+    self.chunks = [] #(digest,size) in order
+    self.created = []
+    self.synced = 0
+    self.size = 0
+    self.stored = 0
+    self.closed = False
+
+  def write(self,data):
+    """Chunk and store data"""
+    assert not self.closed
+    for chunk in self.chunker.feed(data):
+      self.put(chunk)
+    return len(data)
+
+  def put(self,chunk):
+    """Store one chunk unless the store already has it"""
+    digest = hashlib.sha256(chunk).digest()
+    path = chunk_path(self.store,digest)
+    try:
+      #Touch it so a sweep does not take it before the object is linked to it
+      os.utime(path)
+    except FileNotFoundError:
+      os.makedirs(os.path.dirname(path),exist_ok=True)
+      partial = "%s.%s" % (path,os.urandom(8).hex())
+      with open(partial,'xb') as fd:
+        fd.write(chunk)
+      os.replace(partial,path)
+      self.created.append(path)
+      self.stored += len(chunk)
+    self.chunks.append((digest,len(chunk)))
+    self.size += len(chunk)
+
+  def flush(self):
+    """Chunks are written whole, nothing is buffered in files"""
+
+  def sync(self):
+    """Make the chunks stored by this writer since the last sync durable"""
+    folders = set()
+    for path in self.created[self.synced:]:
+      fd = os.open(path,os.O_RDONLY)
+      try:
+        os.fsync(fd)
+      finally:
+        os.close(fd)
+      folders.add(os.path.dirname(path))
+    for folder in folders:
+      fd = os.open(folder,os.O_RDONLY)
+      try:
+        os.fsync(fd)
+      finally:
+        os.close(fd)
+    self.synced = len(self.created)
+
+  def close(self):
+    """Store the last chunk and hand the chunk list to the owner"""
+    if self.closed:
+      return
+    for chunk in self.chunker.finish():
+      self.put(chunk)
+    self.closed = True
+    if self.on_close:
+      self.on_close(self)
+
+  def abort(self):
+    """Stop without linking anything; stored chunks are left for the sweep"""
+    self.closed = True
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,exc_type,exc_value,traceback):
+    if exc_type:
+      self.abort()
+    else:
+      self.close()
+
+class ChunkReader:
+  """File-like reader returning the content of a chunked object"""
+
+  def __init__(self,paths):
+    self.paths = list(reversed(paths))
+    self.buffer = b""
+    self.closed = False
+
+  def read(self,size=-1):
+    """Read up to size bytes, or everything left"""
+    parts = [self.buffer]
+    have = len(self.buffer)
+    while self.paths and (size < 0 or have < size):
+      with open(self.paths.pop(),'rb') as fd:
+        data = fd.read()
+      parts.append(data)
+      have += len(data)
+    data = b"".join(parts)
+    if size < 0 or size >= len(data):
+      self.buffer = b""
+      return data
+    self.buffer = data[size:]
+    return data[:size]
+
+  def close(self):
+    self.paths = []
+    self.buffer = b""
+    self.closed = True
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,exc_type,exc_value,traceback):
+    self.close()
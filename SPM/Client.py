@@ -1,14 +1,20 @@
 
 import socket
-import hashlib
+import time
 import os
 
-from . import __version__, _msg_size, _hash_rounds, _data_size
+from . import __version__, _data_size, _salt_size
+from . import _bulk_block_size, _bulk_block_max, _batch_max
+from . import _batch_subjects, _batch_links, _batch_rights
 
 from SPM.Messages import MessageStrategy, MessageClass, MessageType, BadMessageError
-from SPM.Stream import getBestCipherObject, make_hmacf
-from SPM.Tickets import Ticket, BadTicketError
-from SPM.Util import log
+from SPM.Messages import FRAMING_FIXED, FRAMING_BULK, FRAMING_ACKED, FRAMING_DEFAULT
+from SPM.Stream import getCipherObject, make_hmacf, suites
+from SPM.Derivation import derive_key, derive_resume_secret, derive_resumed_key
+from SPM.Session import SessionTicket
+from SPM.Tickets import Ticket, BadTicketError, unpack_rights
+from SPM.Object import Object
+from SPM.Util import log, chunks
 
 strategies = MessageStrategy.strategies
 
@@ -22,24 +28,33 @@ class ClientError(RuntimeError):
 class Client():
   """Client library interface object"""
 
-  def __init__(self,addr,port):
+  def __init__(self,addr,port,framing=FRAMING_DEFAULT,block_size=_bulk_block_size):
+    assert 0 < block_size <= _bulk_block_max
     self.addr = addr
     self.port = port
+    self.offer = framing
+    self.block_size = block_size
+    self.framing = FRAMING_FIXED
     self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     self.connected = False
     self.key = None
     self.stream = None
     self.hmacf = None
     self.subject = None
+    self.suite = suites.default
     self.buf = bytearray()
 
   def readMessage(self):
     """Perform a buffered read from the socket"""
-    while len(self.buf) < _msg_size:
-      self.buf.extend(self.socket.recv(4096))
-    msg_dict = MessageStrategy.parse(self.buf[0:_msg_size],self.stream,self.hmacf)
-    self.buf = self.buf[_msg_size:]
-    return msg_dict
+    while not self.buf:
+      self.buf.extend(self.socket.recv(65536))
+    size = MessageStrategy.frame_size(self.buf,self.framing)
+    while not size or len(self.buf) < size:
+      self.buf.extend(self.socket.recv(65536))
+      size = MessageStrategy.frame_size(self.buf,self.framing)
+    msg_block = bytes(memoryview(self.buf)[0:size])
+    del self.buf[0:size]
+    return MessageStrategy.parse(msg_block,self.stream,self.hmacf,self.framing)
 
   def checkOkay(self):
     """Check for confirmation. If no confirmation, throw the error message"""
@@ -54,7 +69,8 @@ class Client():
   def greetServer(self):
     """Send the server greeting and establish compatible client and server versions"""
     self.socket.connect((self.addr,self.port))
-    self.socket.sendall(strategies[(MessageClass.PUBLIC_MSG,MessageType.HELLO_CLIENT)].build([__version__]))
+    self.socket.sendall(strategies[(MessageClass.PUBLIC_MSG,MessageType.HELLO_CLIENT)].build(
+                        [__version__,suites.offer(),self.offer]))
     msg_dict = self.readMessage()
     if msg_dict["MessageType"] != MessageType.HELLO_SERVER:
       self.socket.close()
@@ -63,7 +79,15 @@ class Client():
       if msg_dict["Version"] != __version__:
         self.socket.close()
         raise ClientError("Server version mismatch")
-    log("Successfully opened a new unauthenticated connection.")
+    if not msg_dict["Suites"]:
+      self.suite = suites.default #Older servers do not negotiate
+    elif msg_dict["Suites"][0] in suites.offer():
+      self.suite = msg_dict["Suites"][0]
+    else:
+      self.socket.close()
+      raise ClientError("Server chose an unsupported cipher suite")
+    self.framing = msg_dict["Framing"] & self.offer
+    log("Successfully opened a new unauthenticated connection (%s)." % suites.name(self.suite))
     self.connected = True
 
   def authenticate(self,subject,password):
@@ -72,11 +96,11 @@ class Client():
     if not self.connected:
       raise ClientError("Not connected to a server")
     salt = os.urandom(32)
-    self.key = hashlib.pbkdf2_hmac("sha1",password.encode("UTF-8"),salt,_hash_rounds,dklen=256)
+    self.key = derive_key(password,salt)
     self.hmacf = make_hmacf(self.key)
-    self.stream = getBestCipherObject(self.key)
+    self.stream = getCipherObject(self.suite,self.key)
     self.subject = subject
-    self.socket.sendall(strategies[(MessageClass.PUBLIC_MSG,MessageType.AUTH_SUBJECT)].build([subject,salt]))
+    self.socket.sendall(strategies[(MessageClass.PUBLIC_MSG,MessageType.AUTH_SUBJECT)].build([subject,salt],framing=self.framing))
     try:
       msg_dict = self.readMessage()
       msg_type = msg_dict["MessageType"]
@@ -93,6 +117,52 @@ class Client():
       self.resetConnection()
       return False
 
+  def requestSessionTicket(self):
+    """Ask the server for a ticket that can resume this session later"""
+    if not self.connected:
+      raise ClientError("Not connected to a server")
+    if not self.subject or not self.stream:
+      raise ClientError("Must be authenticated")
+    self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.GET_SESSION_TICKET)].build(
+                        None,self.stream,self.hmacf,self.framing))
+    msg_dict = self.readMessage()
+    if msg_dict["MessageType"] == MessageType.ERROR_SERVER:
+      raise ClientError("ServerError: %s" % msg_dict["Error Message"])
+    elif msg_dict["MessageType"] != MessageType.SESSION_TICKET:
+      raise ClientError("Unexpected message sequence")
+    return SessionTicket(self.subject,msg_dict["Ticket"],derive_resume_secret(self.key),
+                         time.time()+msg_dict["Lifetime"])
+
+  def resume(self,session):
+    """Authenticate with a session ticket, skipping key derivation and login delay"""
+    log("Resuming session...")
+    if not self.connected:
+      raise ClientError("Not connected to a server")
+    if session.expires <= time.time():
+      log("Session ticket has expired.")
+      return False
+    nonce = os.urandom(_salt_size)
+    self.key = derive_resumed_key(session.secret,nonce)
+    self.hmacf = make_hmacf(self.key)
+    self.stream = getCipherObject(self.suite,self.key)
+    self.subject = session.subject
+    self.socket.sendall(strategies[(MessageClass.PUBLIC_MSG,MessageType.RESUME_SUBJECT)].build(
+                        [session.ticket,nonce],framing=self.framing))
+    try:
+      msg_dict = self.readMessage()
+    except BadMessageError as e:
+      log(str(e))
+      log("Probably the session ticket was not accepted.")
+      self.resetConnection()
+      return False
+    if msg_dict["MessageType"] == MessageType.CONFIRM_AUTH:
+      log("Session resumed.")
+      return True
+    else:
+      log("Unexpected message from the server (session not resumed)")
+      self.resetConnection()
+      return False
+
   def listSubjects(self):
     """List all valid subjects on the server (requires authentication)"""
     if not self.connected:
@@ -100,7 +170,7 @@ class Client():
     if not self.stream:
       raise ClientError("Cannot list subjects unless authenticated")
     self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.LIST_SUBJECT_CLIENT)].build(
-                        None,self.stream,self.hmacf))
+                        None,self.stream,self.hmacf,self.framing))
     subjects = []
     msg_dict = self.readMessage()
     while msg_dict["MessageType"] == MessageType.LIST_SUBJECT_SERVER:
@@ -119,7 +189,7 @@ class Client():
     if not self.stream:
       raise ClientError("Cannot list objects unless authenticated")
     self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.LIST_OBJECT_CLIENT)].build(
-                        None,self.stream,self.hmacf))
+                        None,self.stream,self.hmacf,self.framing))
     objects = []
     msg_dict = self.readMessage()
     while msg_dict["MessageType"] == MessageType.LIST_OBJECT_SERVER:
@@ -138,7 +208,7 @@ class Client():
     if not self.stream:
       raise ClientError("Must be authenticated")
     self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.CD)].build(
-                        [remotepath],self.stream,self.hmacf))
+                        [remotepath],self.stream,self.hmacf,self.framing))
     msg_dict = self.readMessage()
     if msg_dict["MessageType"] == MessageType.ERROR_SERVER:
       raise ClientError("ServerError: %s" % msg_dict["Error Message"])
@@ -150,7 +220,7 @@ class Client():
     if not self.stream:
       raise ClientError("Must be authenticated")
     self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.GET_CD)].build(
-                        None,self.stream,self.hmacf))
+                        None,self.stream,self.hmacf,self.framing))
     msg_dict = self.readMessage()
     if msg_dict["MessageType"] == MessageType.CD:
       return msg_dict["Path"]
@@ -171,7 +241,7 @@ class Client():
       except BadTicketError:
         raise ClientError("Bad ticket")
     self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.GIVE_TICKET_SUBJECT)]
-                        .build([subject,repr(ticket),target,isObject],self.stream,self.hmacf))
+                        .build([subject,repr(ticket),target,isObject],self.stream,self.hmacf,self.framing))
     msg_dict = self.readMessage()
     if msg_dict["MessageType"] == MessageType.ERROR_SERVER:
       raise ClientError("ServerError: %s" % msg_dict["Error Message"])
@@ -190,7 +260,7 @@ class Client():
       except BadTicketError:
         raise ClientError("Bad ticket")
     self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.TAKE_TICKET_SUBJECT)]
-                        .build([subject,repr(ticket),target,isObject],self.stream,self.hmacf))
+                        .build([subject,repr(ticket),target,isObject],self.stream,self.hmacf,self.framing))
     msg_dict = self.readMessage()
     if msg_dict["MessageType"] == MessageType.ERROR_SERVER:
       raise ClientError("ServerError: %s" % msg_dict["Error Message"])
@@ -208,8 +278,8 @@ class Client():
         ticket = Ticket(ticket)
       except BadTicketError:
         raise ClientError("Bad ticket")
-    self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.XFER_TICKET_SUBJECT)]
-                        .build([subject1,subject2,repr(ticket),target,isObject],self.stream,self.hmacf))
+    self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.XFER_TICKET)]
+                        .build([subject1,subject2,repr(ticket),target,isObject],self.stream,self.hmacf,self.framing))
     msg_dict = self.readMessage()
     if msg_dict["MessageType"] == MessageType.ERROR_SERVER:
       raise ClientError("ServerError: %s" % msg_dict["Error Message"])
@@ -223,16 +293,25 @@ class Client():
     if not self.subject or not self.stream:
       raise ClientError("Not authenticated")
     self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.PUSH_FILE)].build(
-                        [remotename],self.stream,self.hmacf))
+                        [remotename],self.stream,self.hmacf,self.framing))
     self.checkOkay()
     with open(localpath,"rb") as fd:
-      data = fd.read(_data_size)
-      while data:
-        self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.XFER_FILE)].build(
-          [data,len(data)],self.stream,self.hmacf))
+      if self.framing & FRAMING_BULK:
+        data = fd.read(self.block_size)
+        while data:
+          self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.XFER_BLOCK)].build(
+            [data],self.stream,self.hmacf,self.framing))
+          data = fd.read(self.block_size)
+      else:
         data = fd.read(_data_size)
+        while data:
+          self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.XFER_FILE)].build(
+            [data,len(data)],self.stream,self.hmacf,self.framing))
+          data = fd.read(_data_size)
     self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.OKAY)].build(
-          None,self.stream,self.hmacf))
+          None,self.stream,self.hmacf,self.framing))
+    if self.framing & FRAMING_ACKED:
+      self.checkOkay()
 
   def getFile(self,remotename,localpath):
     """Download a file from a remote to a local path"""
@@ -243,11 +322,11 @@ class Client():
     if not self.subject or not self.stream:
       raise ClientError("Not authenticated")
     self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.PULL_FILE)].build(
-                        [remotename],self.stream,self.hmacf))
+                        [remotename],self.stream,self.hmacf,self.framing))
     self.checkOkay()
     with open(localpath,"wb") as fd:
       msg_dict = self.readMessage()
-      while msg_dict["MessageType"] == MessageType.XFER_FILE:
+      while msg_dict["MessageType"] in (MessageType.XFER_FILE,MessageType.XFER_BLOCK):
         fd.write(msg_dict["Data"][:msg_dict["BSize"]])
         msg_dict = self.readMessage()
       if msg_dict["MessageType"] == MessageType.ERROR_SERVER:
@@ -256,13 +335,77 @@ class Client():
         raise ClientError("Unexpected message sequence")
 
   def deleteFile(self,remotename):
-    """Delete a file from a remote path"""
+    """Delete a file or directory tree from a remote path"""
     if not self.connected:
       raise ClientError("No active connection")
     if not self.subject or not self.stream:
       raise ClientError("Not authenticated")
     self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.DELETE_PATH)].build(
-                        [remotename],self.stream,self.hmacf))
+                        [remotename],self.stream,self.hmacf,self.framing))
+    self.checkOkay()
+
+  def readObjectPage(self):
+    """Read one OBJECT_PAGE, returning its objects and whether more follow"""
+    msg_dict = self.readMessage()
+    if msg_dict["MessageType"] == MessageType.ERROR_SERVER:
+      raise ClientError("ServerError: %s" % msg_dict["Error Message"])
+    if msg_dict["MessageType"] != MessageType.OBJECT_PAGE:
+      raise ClientError("Unexpected message from the server")
+    objects = []
+    for name,isDir,size,mtime,digest in tuple(zip(msg_dict["Name"],msg_dict["Dir"],msg_dict["Size"],
+                                                  msg_dict["Mtime"],msg_dict["Hash"]))[:msg_dict["Count"]]:
+      if any(digest):
+        objects.append(Object(name,bool(isDir),size,mtime,digest.hex()))
+      else:
+        objects.append(Object(name,bool(isDir),None,None,None))
+    return objects, msg_dict["More"]
+
+  def stat(self,remotename):
+    """Fetch the size, modification time and MD5 hex digest of a remote object, None where unknown"""
+    if not self.connected:
+      raise ClientError("No active connection")
+    if not self.subject or not self.stream:
+      raise ClientError("Not authenticated")
+    self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.STAT_PATH)].build(
+                        [remotename],self.stream,self.hmacf,self.framing))
+    return self.readObjectPage()[0][0]
+
+  def listDetailed(self):
+    """List the objects in the current remote directory with their metadata"""
+    if not self.connected:
+      raise ClientError("No active connection")
+    if not self.subject or not self.stream:
+      raise ClientError("Not authenticated")
+    objects = []
+    after = ""
+    more = True
+    while more:
+      self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.LIST_DETAILED)].build(
+                          [after],self.stream,self.hmacf,self.framing))
+      page, more = self.readObjectPage()
+      objects += page
+      if page:
+        after = page[-1].localpath
+    return objects
+
+  def movePath(self,source,destination):
+    """Move or rename a remote file or directory tree"""
+    if not self.connected:
+      raise ClientError("No active connection")
+    if not self.subject or not self.stream:
+      raise ClientError("Not authenticated")
+    self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.MOVE_PATH)].build(
+                        [source,destination],self.stream,self.hmacf,self.framing))
+    self.checkOkay()
+
+  def copyPath(self,source,destination):
+    """Copy a remote file or directory tree on the server"""
+    if not self.connected:
+      raise ClientError("No active connection")
+    if not self.subject or not self.stream:
+      raise ClientError("Not authenticated")
+    self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.COPY_PATH)].build(
+                        [source,destination],self.stream,self.hmacf,self.framing))
     self.checkOkay()
 
   def makeDirectory(self,remotename):
@@ -272,7 +415,7 @@ class Client():
     if not self.subject or not self.stream:
       raise ClientError("Not authenticated")
     self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.MAKE_DIRECTORY)].build(
-                        [remotename],self.stream,self.hmacf))
+                        [remotename],self.stream,self.hmacf,self.framing))
     self.checkOkay()
 
   def makeSubject(self,subject,stype,password):
@@ -282,9 +425,130 @@ class Client():
     if not self.subject or not self.stream:
       raise ClientError("Not authenticated")
     self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.MAKE_SUBJECT)].build(
-                        [subject,stype,password],self.stream,self.hmacf))
+                        [subject,stype,password],self.stream,self.hmacf,self.framing))
     self.checkOkay()
 
+  def sendBatch(self,msg_type,per_frame,records,blank):
+    """Send records in batch frames and collect the per-record results"""
+    if not self.connected:
+      raise ClientError("No active connection")
+    if not self.subject or not self.stream:
+      raise ClientError("Not authenticated")
+    strategy = strategies[(MessageClass.PRIVATE_MSG,msg_type)]
+    results = []
+    for group in chunks(list(records),_batch_max):
+      #Send the whole group before reading, as both directions share one keystream
+      frames = chunks(group,per_frame)
+      for i,frame in enumerate(frames):
+        fields = [len(frame),int(i < len(frames)-1)]
+        fields += [field for record in frame+[blank]*(per_frame-len(frame)) for field in record]
+        self.socket.sendall(strategy.build(fields,self.stream,self.hmacf,self.framing))
+      more = True
+      while more:
+        msg_dict = self.readMessage()
+        if msg_dict["MessageType"] == MessageType.ERROR_SERVER:
+          raise ClientError("ServerError: %s" % msg_dict["Error Message"])
+        if msg_dict["MessageType"] != MessageType.BATCH_RESULT:
+          raise ClientError("Unexpected message from the server")
+        count = msg_dict["Count"]
+        for status,error in zip(msg_dict["Status"][:count],msg_dict["Error Message"][:count]):
+          results.append(error if status else None)
+        more = msg_dict["More"]
+    return results
+
+  def makeSubjects(self,records):
+    """Create many (subject,type,password) subjects, returning None or an error for each"""
+    return self.sendBatch(MessageType.MAKE_SUBJECTS,_batch_subjects,records,("","",""))
+
+  def makeLinks(self,pairs):
+    """Create many (subject1,subject2) links, returning None or an error for each"""
+    return self.sendBatch(MessageType.MAKE_LINKS,_batch_links,pairs,("",""))
+
+  def giveTickets(self,records):
+    """Give many (subject,ticket,target,isObject) tickets, returning None or an error for each"""
+    rows = []
+    for subject,ticket,target,isObject in records:
+      if not isinstance(ticket,Ticket):
+        try:
+          ticket = Ticket(ticket)
+        except BadTicketError:
+          raise ClientError("Bad ticket")
+      rows.append((subject,repr(ticket),target,int(isObject)))
+    return self.sendBatch(MessageType.GIVE_TICKETS,_batch_rights,rows,("","","",0))
+
+  def readRightsPage(self):
+    """Read one RIGHTS_PAGE, returning its (name,isObject,tickets) rows and whether more follow"""
+    msg_dict = self.readMessage()
+    if msg_dict["MessageType"] == MessageType.ERROR_SERVER:
+      raise ClientError("ServerError: %s" % msg_dict["Error Message"])
+    if msg_dict["MessageType"] != MessageType.RIGHTS_PAGE:
+      raise ClientError("Unexpected message from the server")
+    count = msg_dict["Count"]
+    rows = [(name,bool(isObject),unpack_rights(mask)) for name,isObject,mask in
+            tuple(zip(msg_dict["Name"],msg_dict["IsObject"],msg_dict["Rights"]))[:count]]
+    return rows, msg_dict["More"]
+
+  def listRightsHeld(self,subject):
+    """List (target,isObject,tickets) for every target a subject holds rights over"""
+    if not self.connected:
+      raise ClientError("No active connection")
+    if not self.subject or not self.stream:
+      raise ClientError("Not authenticated")
+    rights = []
+    after = ("",0)
+    more = True
+    while more:
+      self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.RIGHTS_HELD)].build(
+                          [subject,after[0],after[1]],self.stream,self.hmacf,self.framing))
+      rows, more = self.readRightsPage()
+      rights += rows
+      if rows:
+        after = (rows[-1][0],int(rows[-1][1]))
+    return rights
+
+  def listRightHolders(self,ticket,target,isObject):
+    """List (subject,tickets) for every subject holding a ticket over a target"""
+    if not self.connected:
+      raise ClientError("No active connection")
+    if not self.subject or not self.stream:
+      raise ClientError("Not authenticated")
+    if not isinstance(ticket,Ticket):
+      try:
+        ticket = Ticket(ticket)
+      except BadTicketError:
+        raise ClientError("Bad ticket")
+    holders = []
+    after = ""
+    more = True
+    while more:
+      self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.RIGHT_HOLDERS)].build(
+                          [repr(ticket),target,int(isObject),after],self.stream,self.hmacf,self.framing))
+      rows, more = self.readRightsPage()
+      holders += [(name,tickets) for name,isObject_,tickets in rows]
+      if rows:
+        after = rows[-1][0]
+    return holders
+
+  def canShare(self,ticket,subject1,subject2):
+    """Ask whether a ticket could ever flow from subject1 to subject2 through links and filters"""
+    if not self.connected:
+      raise ClientError("No active connection")
+    if not self.subject or not self.stream:
+      raise ClientError("Not authenticated")
+    if not isinstance(ticket,Ticket):
+      try:
+        ticket = Ticket(ticket)
+      except BadTicketError:
+        raise ClientError("Bad ticket")
+    self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.CAN_SHARE)].build(
+                        [repr(ticket),subject1,subject2],self.stream,self.hmacf,self.framing))
+    msg_dict = self.readMessage()
+    if msg_dict["MessageType"] == MessageType.ERROR_SERVER:
+      raise ClientError("ServerError: %s" % msg_dict["Error Message"])
+    if msg_dict["MessageType"] != MessageType.SHARE_RESULT:
+      raise ClientError("Unexpected message from the server")
+    return bool(msg_dict["Result"])
+
   def deleteSubject(self,subject):
     """Delete a subject from the server"""
     if not self.connected:
@@ -292,7 +556,7 @@ class Client():
     if not self.subject or not self.stream:
       raise ClientError("Not authenticated")
     self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.DELETE_SUBJECT)].build(
-                        [subject],self.stream,self.hmacf))
+                        [subject],self.stream,self.hmacf,self.framing))
     self.checkOkay()
 
   def makeLink(self,subject1,subject2):
@@ -302,7 +566,7 @@ class Client():
     if not self.subject or not self.stream:
       raise ClientError("Not authenticated")
     self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.MAKE_LINK)].build(
-                        [subject1,subject2],self.stream,self.hmacf))
+                        [subject1,subject2],self.stream,self.hmacf,self.framing))
     self.checkOkay()
 
   def makeFilter(self,type1,type2,ticket):
@@ -313,7 +577,7 @@ class Client():
       raise ClientError("Not authenticated")
     ticket = str(ticket)
     self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.MAKE_FILTER)].build(
-                        [type1,type2,ticket],self.stream,self.hmacf))
+                        [type1,type2,ticket],self.stream,self.hmacf,self.framing))
     self.checkOkay()
 
   def deleteFilter(self,type1,type2,ticket):
@@ -324,7 +588,7 @@ class Client():
       raise ClientError("Not authenticated")
     ticket = str(ticket)
     self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.DELETE_FILTER)].build(
-                        [type1,type2,ticket],self.stream,self.hmacf))
+                        [type1,type2,ticket],self.stream,self.hmacf,self.framing))
     self.checkOkay()
 
   def clearLinks(self,subject):
@@ -334,7 +598,7 @@ class Client():
     if not self.subject or not self.stream:
       raise ClientError("Not authenticated")
     self.socket.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.CLEAR_LINKS)].build(
-                        [subject],self.stream,self.hmacf))
+                        [subject],self.stream,self.hmacf,self.framing))
     self.checkOkay()
 
   def resetConnection(self):
@@ -342,7 +606,7 @@ class Client():
     self.stream = None
     self.hmacf = None
     self.leaveServer()
-    self.__init__(self.addr,self.port)
+    self.__init__(self.addr,self.port,self.offer,self.block_size)
     self.greetServer()
 
   def leaveServer(self):
@@ -350,12 +614,12 @@ class Client():
     if not self.connected:
       return
     self.close()
-    self.__init__(self.addr,self.port)
+    self.__init__(self.addr,self.port,self.offer,self.block_size)
 
   def close(self):
     """Disconnect from the server if connected. Do not re-initialize the Client"""
     if not self.connected:
       return
-    self.socket.sendall(strategies[(MessageClass.PUBLIC_MSG,MessageType.DIE)].build(None,self.stream,self.hmacf))
+    self.socket.sendall(strategies[(MessageClass.PUBLIC_MSG,MessageType.DIE)].build(None,self.stream,self.hmacf,self.framing))
     self.socket.close()
 
@@ -1,26 +1,127 @@
+import asyncio
 import sqlite3
-import shutil
 import os
 
-from SPM.Tickets import Ticket
+from collections import namedtuple, OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from SPM.Tickets import Ticket, BadTicketError
 from SPM.Subject import Subject
 from SPM.Link import Link
 from SPM.Filter import Filter
 from SPM.Right import Right
-from SPM.Util import expandPath
+from SPM.Object import Object
+from SPM.Authorization import Authorization
+from SPM.Util import expandPath, copy_tree, remove_tree
+from SPM.Chunks import ChunkReader, ChunkWriter, chunk_path, collect_chunks
 
-from . import _min_pass_len
+from . import _min_pass_len, _db_cache_size, _chunk_grace
 
 #Database
 #
 #The goal of the database is to enforce consistency and provide uniform storage,
 #  not to enforce the security model. Policy enforcement is delegated to the task handlers
+#  It does keep links and filters compiled in memory so handlers can check a transfer
+#  without querying them
+#
+#Objects may also be kept in a deduplicating chunk store inside the file root,
+#  see SPM.Chunks. The database then holds the chunk list of each object and a
+#  reference count per chunk, and readObject and writeObject hide which store
+#  an object lives in. Chunked is only the choice for new writes; objects
+#  written either way stay readable
 
 class DatabaseError(RuntimeError):
   """Simple DatabaseError type encapsulates an error message"""
   def __init__(self,msg):
     super().__init__(msg)
 
+#Performance profiles
+#
+#Each profile sets the journal mode, how often SQLite syncs, its page cache
+#  and memory map sizes, how long to wait on a lock held by another process,
+#  and how many prepared statements the connection keeps for reuse. Every query
+#  below is a constant string, so repeated calls hit the statement cache
+
+Profile = namedtuple("Profile",["journal_mode","synchronous","cache_size","mmap_size",
+                                "busy_timeout","statements"])
+
+profiles = {
+  #Rollback journal with a sync per transaction, as SQLite does out of the box
+  "legacy": Profile("delete","full",-2000,0,8,128),
+  #Write-ahead log that still syncs every commit
+  "safe": Profile("wal","full",-16384,2**26,8,256),
+  #Write-ahead log syncing only at checkpoints; a crash may lose the last commits
+  "fast": Profile("wal","normal",-65536,2**28,8,256),
+}
+PROFILE_DEFAULT = "safe"
+
+def backfill_parents(c):
+  """Migration step recording the parent directory of every existing object"""
+  rows = c.execute("select localpath from objects").fetchall()
+  c.executemany("update objects set parent=? where localpath=?",
+                [(os.path.dirname(localpath),localpath) for (localpath,) in rows])
+
+def pack_rights(c):
+  """Migration step folding the rights rows of each subject and target into one bitmask"""
+  masks = dict()
+  for subject,ticket,target,isobject in c.execute("select subject,ticket,target,isobject from rights").fetchall():
+    key = (subject,target,isobject)
+    masks[key] = masks.get(key,0) | Ticket.convert_ticket(ticket).mask()
+  c.execute("create table rights_packed(subject text not null, target text not null, isobject integer not null, mask integer not null, primary key (subject,target,isobject))")
+  c.executemany("insert into rights_packed values(?,?,?,?)",[key+(mask,) for key,mask in masks.items()])
+  c.execute("drop table rights")
+  c.execute("alter table rights_packed rename to rights")
+
+class ReadCache:
+  """Bounded cache of subject, link and filter lookups, evicting the least recently used"""
+
+  def __init__(self,size=_db_cache_size):
+    assert size > 0
+    self.size = size
+    self.rows = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+    self.flushes = 0
+
+  def get(self,key):
+    """Look up a key, returning whether it was cached and the cached value"""
+    try:
+      value = self.rows[key]
+    except KeyError:
+      self.misses += 1
+      return False, None
+    self.rows.move_to_end(key)
+    self.hits += 1
+    return True, value
+
+  def put(self,key,value):
+    """Cache the result of a lookup, which may be None"""
+    self.rows[key] = value
+    self.rows.move_to_end(key)
+    while len(self.rows) > self.size:
+      self.rows.popitem(last=False)
+
+  def drop(self,key):
+    """Forget one lookup"""
+    if self.rows.pop(key,self) is not self:
+      self.invalidations += 1
+
+  def dropLinks(self,subject):
+    """Forget every link lookup naming a subject on either side"""
+    for key in [k for k in self.rows if k[0] == "link" and subject in k[1:]]:
+      self.drop(key)
+
+  def clear(self):
+    """Forget everything after another process changed the cached tables"""
+    self.rows.clear()
+    self.flushes += 1
+
+  def stats(self):
+    """Snapshot of the cache counters"""
+    return {"cached": len(self.rows), "hits": self.hits, "misses": self.misses,
+            "invalidations": self.invalidations, "flushes": self.flushes}
+
 class Database:
   """Database interface object"""
 
@@ -31,44 +132,205 @@ class Database:
 	    "create table if not exists rights(subject text not null, ticket ticket not null, target text not null, isobject integer not null, primary key (subject,ticket,target,isobject))",
 	    "create table if not exists objects(localpath text primary key, dir integer not null)"]
 
+  #Schema changes, applied in order to bring older databases up to date. Steps
+  #  are statements or functions of the cursor. The position of the last
+  #  migration applied is kept in the user_version pragma
+  migrations = [["create index if not exists links_subject2 on links(subject2)",
+                 "create index if not exists rights_target on rights(target,isobject)",
+                 "create index if not exists filters_type2 on filters(type2)"],
+                ["alter table objects add column parent text",
+                 backfill_parents,
+                 "create index if not exists objects_parent on objects(parent,localpath)"],
+                ["create table if not exists generation(id integer primary key check (id=0), counter integer not null)",
+                 "insert or ignore into generation values(0,0)"],
+                [pack_rights,
+                 "create index if not exists rights_target on rights(target,isobject,subject)"],
+                [], #Left empty so later steps keep their numbers
+                ["alter table objects add column size integer",
+                 "alter table objects add column mtime real",
+                 "alter table objects add column hash blob"],
+                ["alter table objects add column chunked integer not null default 0",
+                 "create table if not exists chunks(hash blob primary key, size integer not null, refs integer not null)",
+                 "create table if not exists object_chunks(localpath text not null, seq integer not null, hash blob not null, primary key (localpath,seq))"]]
+
   #Setup automatic type conversions
   sqlite3.register_adapter(Ticket,Ticket.adapt_ticket)
   sqlite3.register_converter("Ticket",Ticket.convert_ticket)
 
-  def __init__(self,db="./sys.db",root="./fileroot"):
+  def __init__(self,db="./sys.db",root="./fileroot",staging=None,profile=PROFILE_DEFAULT,
+               cache_size=0,chunked=False):
+    if profile not in profiles:
+      raise DatabaseError("Unknown database profile")
     self.db = db
     self.root = root
-    self.conn = sqlite3.connect(db,8,sqlite3.PARSE_DECLTYPES)
+    #Staging and the chunk store sit inside the root, keeping every rename into
+    #  place on one filesystem and every object's content with the root. Their
+    #  paths are reserved so clients cannot reach them
+    self.staging = staging or os.path.join(root,".partial")
+    self.chunked = chunked
+    self.store = os.path.join(root,".chunks")
+    self.reserved = tuple("/" + inside if inside != os.curdir and not inside.startswith(os.pardir) else ""
+                          for inside in (os.path.relpath(path,root) for path in (self.staging,self.store)))
+    self.profile = profiles[profile]
+    self.conn = sqlite3.connect(db,self.profile.busy_timeout,sqlite3.PARSE_DECLTYPES,
+                                cached_statements=self.profile.statements)
     self.conn.isolation_level = None
     self.c = self.conn.cursor()
-    self.c.execute("begin transaction")
+    #Write-ahead logging lets server processes read while another one writes
+    self.c.execute("pragma journal_mode=%s" % self.profile.journal_mode)
+    self.c.execute("pragma synchronous=%s" % self.profile.synchronous)
+    self.c.execute("pragma cache_size=%d" % self.profile.cache_size)
+    self.c.execute("pragma mmap_size=%d" % self.profile.mmap_size)
+    self.c.execute("begin immediate transaction")
     [self.c.execute(s) for s in Database.tables]
     self.c.execute("end transaction")
-    if not os.path.exists(self.root):
-      os.mkdir(self.root)
+    self.migrate()
+    #Other connections bump the generation whenever they change a cached table
+    self.cache = ReadCache(cache_size) if cache_size else None
+    self.data_version = self.c.execute("pragma data_version").fetchone()[0]
+    self.generation = self.c.execute("select counter from generation").fetchone()[0]
+    self.authz = Authorization()
+    self.authz.load(self.c)
+    os.makedirs(self.root,exist_ok=True)
+    os.makedirs(self.staging,exist_ok=True)
+    #Chunk stores used to sit next to the root
+    legacy = os.path.normpath(root) + ".chunks"
+    if os.path.isdir(legacy) and not os.path.exists(self.store):
+      try:
+        os.rename(legacy,self.store)
+      except OSError as e:
+        raise DatabaseError("Cannot move the chunk store into the root: %s" % e.strerror)
+    if self.chunked:
+      os.makedirs(self.store,exist_ok=True)
 
   def __enter__(self):
     """Called when entering a use-with block. No initialization is required"""
     return self
 
+  def version(self):
+    """Schema version of the open database"""
+    self.c.execute("pragma user_version")
+    return self.c.fetchone()[0]
+
+  def migrate(self):
+    """Apply every migration the open database has not seen yet"""
+    self.c.execute("begin immediate transaction")
+    version = self.version()
+    if version > len(Database.migrations):
+      self.c.execute("end transaction")
+      raise DatabaseError("Database schema is newer than this server")
+    for migration in Database.migrations[version:]:
+      [self.c.execute(s) if isinstance(s,str) else s(self.c) for s in migration]
+    self.c.execute("pragma user_version=%d" % len(Database.migrations))
+    self.c.execute("end transaction")
+
+  def cached(self,key,fetch,*args):
+    """Answer a lookup from the cache, fetching and remembering it on a miss"""
+    if not self.cache:
+      return fetch(*args)
+    self.refresh()
+    found, value = self.cache.get(key)
+    if not found:
+      value = fetch(*args)
+      self.cache.put(key,value)
+    return value
+
+  def refresh(self):
+    """Drop cached lookups and recompile authorization if another process changed them"""
+    #data_version only moves when another connection commits
+    data_version = self.c.execute("pragma data_version").fetchone()[0]
+    if data_version != self.data_version:
+      self.data_version = data_version
+      generation = self.c.execute("select counter from generation").fetchone()[0]
+      if generation != self.generation:
+        self.generation = generation
+        if self.cache:
+          self.cache.clear()
+        self.authz.load(self.c)
+
+  def changed(self,*keys,links=None):
+    """Within a write transaction, invalidate cached lookups here and in other processes"""
+    self.c.execute("update generation set counter=counter+1")
+    self.generation = self.c.execute("select counter from generation").fetchone()[0]
+    if self.cache:
+      for key in keys:
+        self.cache.drop(key)
+      if links:
+        self.cache.dropLinks(links)
+
+  def cacheStats(self):
+    """Snapshot of the read cache counters, if caching is enabled"""
+    return self.cache.stats() if self.cache else dict()
+
+  def authzStats(self):
+    """Snapshot of the compiled authorization tables"""
+    return self.authz.stats()
+
+  def queryPlan(self,statement,args=()):
+    """Describe how SQLite will run a statement, one line per plan step"""
+    return [row[-1] for row in self.c.execute("explain query plan " + statement,args)]
+
   def insertSubject(self,name,stype,password,super=False):
     """Insert a subject into the database"""
     if not password or not name or not stype:
       raise DatabaseError("Name, password, and type are required")
     if len(password) <= _min_pass_len:
           raise DatabaseError("Password is way too short")
-    self.c.execute("begin transaction")
+    self.c.execute("begin immediate transaction")
     self.c.execute("select subject from subjects where subject=?",(name,))
     if self.c.fetchone():
       self.c.execute("end transaction")
       raise DatabaseError("The subject already exists")
     self.c.execute("insert into subjects values(?,?,?,?)", (name,password,stype,super))
+    self.changed(("subject",name))
+    self.authz.addSubject(name,stype,super)
+    self.c.execute("end transaction")
+
+  def insertSubjects(self,records):
+    """Insert many (name,stype,password) subjects in one transaction, returning None or an error per record"""
+    results = [None]*len(records)
+    for i,(name,stype,password) in enumerate(records):
+      if not password or not name or not stype:
+        results[i] = "Name, password, and type are required"
+      elif len(password) <= _min_pass_len:
+        results[i] = "Password is way too short"
+    self.c.execute("begin immediate transaction")
+    taken = self.existing("subjects","subject",[r[0] for i,r in enumerate(records) if not results[i]])
+    rows = []
+    for i,(name,stype,password) in enumerate(records):
+      if results[i]:
+        continue
+      if name in taken:
+        results[i] = "The subject already exists"
+        continue
+      taken.add(name)
+      rows.append((name,password,stype,False))
+    self.c.executemany("insert into subjects values(?,?,?,?)",rows)
+    self.changed(*[("subject",row[0]) for row in rows])
+    for name,password,stype,super in rows:
+      self.authz.addSubject(name,stype,super)
     self.c.execute("end transaction")
+    return results
+
+  def existing(self,table,column,values):
+    """Set of the given values present in a column, looked up in chunks"""
+    found = set()
+    values = list(set(values))
+    for i in range(0,len(values),500):
+      chunk = values[i:i+500]
+      self.c.execute("select %s from %s where %s in (%s)" % (column,table,column,",".join("?"*len(chunk))),
+                     chunk)
+      found.update(row[0] for row in self.c.fetchall())
+    return found
 
   def getSubject(self,name):
     """Fetch a subject from the database"""
     if not name:
       raise DatabaseError("Cannot fetch subject without a name")
+    return self.cached(("subject",name),self.selectSubject,name)
+
+  def selectSubject(self,name):
+    """Fetch a subject from the subjects table, bypassing the cache"""
     self.c.execute("select * from subjects where subject=?",(name,))
     t = self.c.fetchone()
     if t:
@@ -86,39 +348,68 @@ class Database:
     """Drop a subject, if he exists, from the database"""
     if not name:
       raise DatabaseError("Cannot delete subject without a name")
-    self.c.execute("begin transaction")
+    self.c.execute("begin immediate transaction")
     self.c.execute("delete from subjects where subject=?",(name,))
     self.c.execute("delete from links where subject1=? or subject2=?",(name,name))
     self.c.execute("delete from rights where subject=?",(name,))
+    self.c.execute("delete from rights where target=? and isobject=0",(name,))
+    self.changed(("subject",name),links=name)
+    self.authz.removeSubject(name)
     self.c.execute("end transaction")
 
   def clearLinks(self,name):
     """Remove all connections to or from this subject"""
     if not name:
       raise DatabaseError("Cannot clear subject links without a name")
-    self.c.execute("begin transaction")
+    self.c.execute("begin immediate transaction")
     self.c.execute("delete from links where subject1=? or subject2=?",(name,name))
+    self.changed(links=name)
+    self.authz.clearLinks(name)
     self.c.execute("end transaction")
 
   def insertLink(self,subject1,subject2):
     """Create a true link predecate between two subjects"""
     if not subject1 or not subject2:
       raise DatabaseError("Subject cannot be empty")
-      self.c.execute("begin transaction")
     if not self.getSubject(subject1) or not self.getSubject(subject2):
-      self.c.execute("end transaction")
       raise DatabaseError("One of the subjects does not exist in the subjects table")
     if self.getLink(subject1,subject2):
-      self.c.execute("end transaction")
       return #Link already exists
-    self.c.execute("insert into links values(?,?)",(subject1,subject2))
+    self.c.execute("begin immediate transaction")
+    self.c.execute("insert or ignore into links values(?,?)",(subject1,subject2))
+    self.changed(("link",subject1,subject2))
+    self.authz.addLink(subject1,subject2)
     self.c.execute("end transaction")
 
+  def insertLinks(self,pairs):
+    """Create many (subject1,subject2) links in one transaction, returning None or an error per link"""
+    results = [None]*len(pairs)
+    self.c.execute("begin immediate transaction")
+    known = self.existing("subjects","subject",[name for pair in pairs for name in pair if name])
+    rows = []
+    for i,(subject1,subject2) in enumerate(pairs):
+      if not subject1 or not subject2:
+        results[i] = "Subject cannot be empty"
+      elif subject1 not in known or subject2 not in known:
+        results[i] = "One of the subjects does not exist in the subjects table"
+      else:
+        rows.append((subject1,subject2))
+    self.c.executemany("insert or ignore into links values(?,?)",rows)
+    self.changed(*[("link",)+row for row in rows])
+    for subject1,subject2 in rows:
+      self.authz.addLink(subject1,subject2)
+    self.c.execute("end transaction")
+    return results
+
   def getLink(self,subject1,subject2):
     """Look for and return any link that exists between two subjects"""
     if not subject1 or not subject2:
       raise DatabaseError("Subject cannot be empty")
-    self.c.execute("select subject1,subject2 from from links if subject1=? and subject2=?",
+    return self.cached(("link",subject1,subject2),self.selectLink,subject1,subject2)
+
+  def selectLink(self,subject1,subject2):
+    """Look for a link in the links table, bypassing the cache"""
+    self.c.execute("select subject1,subject2 from links where subject1=? and subject2=?",
 	(subject1,subject2))
     t = self.c.fetchone()
     if t:
@@ -129,8 +420,10 @@ class Database:
     """Drop a link between two subjects if such a link exists"""
     if not subject1 or not subject2:
       raise DatabaseError("Subject cannot be empty")
-    self.c.execute("begin transaction")
+    self.c.execute("begin immediate transaction")
     self.c.execute("delete from links where subject1=? and subject2=?",(subject1,subject2))
+    self.changed(("link",subject1,subject2))
+    self.authz.removeLink(subject1,subject2)
     self.c.execute("end transaction")
 
   def insertFilter(self,type1,type2,ticket):
@@ -143,11 +436,13 @@ class Database:
       ticket = Ticket.convert_ticket(ticket)
     except AssertionError:
       raise DatabaseError("Not a vaild ticket")
-    self.c.execute("begin transaction")
-    if self.getFilter(type1,type2,ticket):
+    self.c.execute("begin immediate transaction")
+    if self.selectFilter(type1,type2,ticket):
       self.c.execute("end transaction")
       raise DatabaseError("Filter already exists")
     self.c.execute("insert into filters values(?,?,?)",(type1,type2,ticket))
+    self.changed(("filter",type1,type2,repr(ticket)))
+    self.authz.addFilter(type1,type2,ticket)
     self.c.execute("end transaction")
 
   def getFilter(self,type1,type2,ticket):
@@ -160,6 +455,10 @@ class Database:
       ticket = Ticket.convert_ticket(ticket)
     except AssertionError:
       raise DatabaseError("Not a vaild ticket")
+    return self.cached(("filter",type1,type2,repr(ticket)),self.selectFilter,type1,type2,ticket)
+
+  def selectFilter(self,type1,type2,ticket):
+    """Look for a filter in the filters table, bypassing the cache"""
     self.c.execute("select * from filters where type1=? and type2=? and ticket=?",
 	(type1,type2,ticket))
     t = self.c.fetchone()
@@ -177,9 +476,11 @@ class Database:
       ticket = Ticket.convert_ticket(ticket)
     except AssertionError:
       raise DatabaseError("Not a vaild ticket")
-    self.c.execute("begin transaction")
+    self.c.execute("begin immediate transaction")
     self.c.execute("delete from filters where type1=? and type2=? and ticket=?",
 	(type1,type2,ticket))
+    self.changed(("filter",type1,type2,repr(ticket)))
+    self.authz.removeFilter(type1,type2,ticket)
     self.c.execute("end transaction")
 
   def insertRight(self,subject,ticket,target,isobject=False):
@@ -204,11 +505,101 @@ class Database:
       raise DatabaseError("Not a vaild ticket")
     if self.getRight(subject,ticket,target,isobject):
       return
-    self.c.execute("begin transaction")
+    self.c.execute("begin immediate transaction")
     if self.getRight(subject,ticket,target,isobject):
       self.c.execute("end transaction")
       raise DatabaseError("Right already exists for this subject")
-    self.c.execute("insert into rights values(?,?,?,?)",(subject,ticket,target,isobject))
+    self.c.execute("insert into rights values(?,?,?,?) on conflict(subject,target,isobject) do update set mask=mask|excluded.mask",
+	(subject,target,isobject,ticket.mask()))
+    self.c.execute("end transaction")
+
+  def insertRights(self,records):
+    """Insert many (subject,ticket,target,isobject) rights in one transaction, returning None or an error per right"""
+    results = [None]*len(records)
+    rows = []
+    for i,(subject,ticket,target,isobject) in enumerate(records):
+      if not subject:
+        results[i] = "Subject cannot be empty"
+      elif not target:
+        results[i] = "Target cannot be empty"
+      elif not ticket:
+        results[i] = "No ticket provided"
+      else:
+        try:
+          rows.append((i,subject,Ticket.convert_ticket(ticket),target,bool(isobject)))
+        except (AssertionError,BadTicketError,KeyError):
+          results[i] = "Not a vaild ticket"
+    self.c.execute("begin immediate transaction")
+    subjects = self.existing("subjects","subject",
+                             [r[1] for r in rows]+[r[3] for r in rows if not r[4]])
+    objects = self.existing("objects","localpath",[r[3] for r in rows if r[4]])
+    valid = []
+    for i,subject,ticket,target,isobject in rows:
+      if subject not in subjects:
+        results[i] = "Subject must exist"
+      elif isobject and target not in objects:
+        results[i] = "Target object does not exist in database"
+      elif not isobject and target not in subjects:
+        results[i] = "Target subject does not exist in the database"
+      else:
+        valid.append((subject,ticket,target,isobject))
+    self.c.executemany("insert into rights values(?,?,?,?) on conflict(subject,target,isobject) do update set mask=mask|excluded.mask",
+                       [(subject,target,isobject,ticket.mask()) for subject,ticket,target,isobject in valid])
+    self.c.execute("end transaction")
+    return results
+
+  def mayTransfer(self,subject1,subject2,ticket,requester=None):
+    """Check that links and filters let subject1 pass a ticket to subject2, or that the requester is super"""
+    if not subject1 or not subject2:
+      raise DatabaseError("Subject cannot be empty")
+    if not ticket:
+      raise DatabaseError("No ticket provided")
+    try:
+      ticket = Ticket.convert_ticket(ticket)
+    except (AssertionError,BadTicketError,KeyError):
+      raise DatabaseError("Not a vaild ticket")
+    self.refresh()
+    if requester and self.authz.isSuper(requester):
+      return True
+    return self.authz.mayTransfer(subject1,subject2,ticket)
+
+  def canShare(self,subject1,subject2,ticket):
+    """Check whether a ticket could ever flow from subject1 to subject2 through chains of links and filters"""
+    if not subject1 or not subject2:
+      raise DatabaseError("Subject cannot be empty")
+    if not ticket:
+      raise DatabaseError("No ticket provided")
+    try:
+      ticket = Ticket.convert_ticket(ticket)
+    except (AssertionError,BadTicketError,KeyError):
+      raise DatabaseError("Not a vaild ticket")
+    self.refresh()
+    return self.authz.canShare(subject1,subject2,ticket)
+
+  def transferRight(self,subject1,subject2,ticket,target,isobject=False):
+    """Move a rights ticket from one subject to another in one transaction"""
+    if not subject1 or not subject2:
+      raise DatabaseError("Subject cannot be empty")
+    if subject1 == subject2:
+      raise DatabaseError("Subject already holds the ticket")
+    if not target:
+      raise DatabaseError("Target cannot be empty")
+    if not ticket:
+      raise DatabaseError("No ticket provided")
+    try:
+      ticket = Ticket.convert_ticket(ticket)
+    except (AssertionError,BadTicketError,KeyError):
+      raise DatabaseError("Not a vaild ticket")
+    self.c.execute("begin immediate transaction")
+    if not self.getRight(subject1,ticket,target,isobject):
+      self.c.execute("end transaction")
+      raise DatabaseError("Subject does not hold the ticket")
+    if not self.selectSubject(subject2):
+      self.c.execute("end transaction")
+      raise DatabaseError("Subject must exist")
+    self.c.execute("insert into rights values(?,?,?,?) on conflict(subject,target,isobject) do update set mask=mask|excluded.mask",
+	(subject2,target,isobject,ticket.mask()))
+    self.removeRight(subject1,ticket,target,isobject)
     self.c.execute("end transaction")
 
   def getRight(self,subject,ticket,target,isobject=False):
@@ -219,13 +610,39 @@ class Database:
       raise DatabaseError("Target cannot be empty")
     if not ticket:
       raise DatabaseError("No ticket provided")
-    self.c.execute("select subject,ticket,target,isobject from rights where subject=? and ticket=? and target=? and isobject=?",
-	(subject,ticket,target,isobject))
+    try:
+      ticket = Ticket.convert_ticket(ticket)
+    except (AssertionError,BadTicketError,KeyError):
+      raise DatabaseError("Not a vaild ticket")
+    self.c.execute("select mask from rights where subject=? and target=? and isobject=?",
+	(subject,target,isobject))
     t = self.c.fetchone()
-    if t:
-      return Right(*t)
+    if t and t[0] & ticket.mask():
+      return Right(subject,ticket,target,bool(isobject))
     return None
 
+  def getRightsHeld(self,subject,after=("",False),limit=-1):
+    """List (target,isobject,mask) for every target a subject holds rights over, ordered after a (target,isobject) cursor"""
+    if not subject:
+      raise DatabaseError("Subject cannot be empty")
+    self.c.execute("select target,isobject,mask from rights where subject=? and (target,isobject)>(?,?) order by target,isobject limit ?",
+	(subject,after[0],after[1],limit))
+    return [(target,bool(isobject),mask) for target,isobject,mask in self.c.fetchall()]
+
+  def getRightHolders(self,ticket,target,isobject=False,after="",limit=-1):
+    """List (subject,mask) for every subject holding a ticket over a target, ordered after a subject cursor"""
+    if not target:
+      raise DatabaseError("Target cannot be empty")
+    if not ticket:
+      raise DatabaseError("No ticket provided")
+    try:
+      ticket = Ticket.convert_ticket(ticket)
+    except (AssertionError,BadTicketError,KeyError):
+      raise DatabaseError("Not a vaild ticket")
+    self.c.execute("select subject,mask from rights where target=? and isobject=? and subject>? and mask&?!=0 order by subject limit ?",
+	(target,isobject,after,ticket.mask(),limit))
+    return self.c.fetchall()
+
   def deleteRight(self,subject,ticket,target,isobject=False):
     """Drop a rights ticket from the database"""
     if not subject:
@@ -238,30 +655,45 @@ class Database:
       ticket = Ticket.convert_ticket(ticket)
     except AssertionError:
       raise DatabaseError("Not a vaild ticket")
-    self.c.execute("begin transaction")
-    self.c.execute("delete from rights where subject=? and ticket=? and target=? and isobject=?",
-	(subject,ticket,target,isobject))
+    self.c.execute("begin immediate transaction")
+    self.removeRight(subject,ticket,target,isobject)
     self.c.execute("end transaction")
 
+  def removeRight(self,subject,ticket,target,isobject):
+    """Within a write transaction, clear one right and drop the row once none are left"""
+    self.c.execute("update rights set mask=mask&~? where subject=? and target=? and isobject=?",
+	(ticket.mask(),subject,target,isobject))
+    self.c.execute("delete from rights where subject=? and target=? and isobject=? and mask=0",
+	(subject,target,isobject))
+
+  def isReserved(self,localpath):
+    """Check whether a path falls in the staging directory or chunk store, which clients may not reach"""
+    localpath = os.path.normpath(localpath)
+    return any(reserved and (localpath == reserved or localpath.startswith(reserved + "/"))
+               for reserved in self.reserved)
+
   def insertObject(self,localpath,isdir=False):
     """Declare a new data object or folder in the database"""
     if not localpath:
       raise DatabaseError("A path is required")
     if localpath[0] != "/":
       raise DatabaseError("The path is invalid")
+    if self.isReserved(localpath):
+      raise DatabaseError("The path is reserved")
     path_so_far = self.root
     for folder in localpath.split(os.sep):
       if folder and (not folder == os.path.basename(localpath)):
         path_so_far = os.path.join(path_so_far,folder)
         if not os.path.isdir(path_so_far):
           raise DatabaseError("A parent directory is missing from the filesystem")
-    self.c.execute("begin transaction")
+    self.c.execute("begin immediate transaction")
     if self.getObject(localpath):
       self.c.execute("end transaction")
       raise DatabaseError("The object already exists in the database")
     if isdir:
       os.mkdir(expandPath(self.root,"",localpath))
-    self.c.execute("insert into objects values(?,?)",(localpath,isdir))
+    self.c.execute("insert into objects(localpath,dir,parent) values(?,?,?)",
+                   (localpath,isdir,os.path.dirname(localpath)))
     self.c.execute("end transaction")
 
   def getObject(self,localpath):
@@ -276,18 +708,104 @@ class Database:
       return t[0]
     return None
 
+  def getObjectInfo(self,localpath):
+    """Fetch an object with its size, modification time and MD5 digest, which are None until known"""
+    if not localpath:
+      raise DatabaseError("A path is required")
+    if localpath[0] != "/":
+      raise DatabaseError("The path is invalid")
+    self.c.execute("select localpath,dir,size,mtime,hash from objects where localpath=?",(localpath,))
+    t = self.c.fetchone()
+    if t:
+      return Object(t[0],bool(t[1]),*t[2:])
+    return None
+
+  def getObjectDetails(self,cd,after="",limit=-1):
+    """List the objects from the current path with their metadata, ordered after a name cursor"""
+    if not cd:
+      raise DatabaseError("A current directory is required")
+    if cd[0] != "/":
+      raise DatabaseError("The path is invalid")
+    cd = os.path.normpath(cd)
+    after = os.path.join(cd,after) if after else ""
+    self.c.execute("select localpath,dir,size,mtime,hash from objects where parent=? and localpath>? and localpath not in (?,?) order by localpath limit ?",
+	(cd,after,*self.reserved,limit))
+    return [Object(t[0],bool(t[1]),*t[2:]) for t in self.c.fetchall()]
+
+  def updateObject(self,localpath,size,mtime,digest,chunks=None):
+    """Record the size, modification time and MD5 digest of an object's new content
+
+    Chunks is the (SHA-256, size) list holding the content when it went to the
+      chunk store, and None when it went to the file under the root. Either way
+      the chunks the object held before are released"""
+    if not localpath:
+      raise DatabaseError("A path is required")
+    self.c.execute("begin immediate transaction")
+    try:
+      self.linkChunks(localpath,chunks or [])
+    except DatabaseError:
+      self.c.execute("rollback transaction")
+      raise
+    self.c.execute("update objects set size=?,mtime=?,hash=?,chunked=? where localpath=?",
+	(size,mtime,digest,chunks is not None,localpath))
+    self.c.execute("end transaction")
+    if chunks is not None:
+      #The content now lives in the store, drop any file written before
+      realpath = os.path.join(self.root,localpath[1:])
+      if os.path.isfile(realpath):
+        os.remove(realpath)
+
+  def linkChunks(self,localpath,chunks):
+    """Within a write transaction, replace the chunk list of an object and count the references"""
+    old = Counter(h for (h,) in self.c.execute("select hash from object_chunks where localpath=?",(localpath,)))
+    new = Counter(h for h,size in chunks)
+    stored = self.existing("chunks","hash",new)
+    for h in new:
+      if h not in stored and not os.path.isfile(chunk_path(self.store,h)):
+        raise DatabaseError("A chunk of the object is missing from the store")
+    self.c.execute("delete from object_chunks where localpath=?",(localpath,))
+    self.c.executemany("insert into object_chunks values(?,?,?)",
+	[(localpath,seq,h) for seq,(h,size) in enumerate(chunks)])
+    sizes = dict(chunks)
+    deltas = [(h,sizes.get(h,0),new[h]-old[h]) for h in old.keys() | new.keys() if new[h] != old[h]]
+    self.c.executemany("insert into chunks values(?,?,?) on conflict(hash) do update set refs=refs+excluded.refs",deltas)
+    self.c.executemany("delete from chunks where hash=? and refs<=0",[(h,) for h,size,delta in deltas if delta < 0])
+
+  def releaseChunks(self,localpath,low,high):
+    """Within a write transaction, drop the chunk lists of an object and everything below it"""
+    self.c.execute("update chunks set refs=refs-used.n from (select hash,count(*) as n from object_chunks where localpath=? or (localpath>=? and localpath<?) group by hash) as used where chunks.hash=used.hash",
+	(localpath,low,high))
+    self.c.execute("delete from chunks where refs<=0 and hash in (select hash from object_chunks where localpath=? or (localpath>=? and localpath<?))",
+	(localpath,low,high))
+    self.c.execute("delete from object_chunks where localpath=? or (localpath>=? and localpath<?)",
+	(localpath,low,high))
+
+  def collectChunks(self,grace=_chunk_grace):
+    """Remove stored chunks no object refers to, once untouched for grace seconds
+
+    Writers store chunks before the object is linked to them, so the grace
+      period must outlast the longest upload. Returns the number of files and
+      bytes removed"""
+    return collect_chunks(self.store,lambda digests: self.existing("chunks","hash",digests),grace)
+
+  def storeStats(self):
+    """Sizes of the chunk store: chunks kept, bytes stored and the bytes of the objects they hold"""
+    chunks, stored = self.c.execute("select count(*),coalesce(sum(size),0) from chunks").fetchone()
+    logical, = self.c.execute("select coalesce(sum(size*refs),0) from chunks").fetchone()
+    return {"chunks": chunks, "stored": stored, "logical": logical,
+            "ratio": logical/stored if stored else 1.0}
+
   def getObjectNames(self,cd):
     """List the objects from the current path"""
     if not cd:
       raise DatabaseError("A current directory is required")
     if cd[0] != "/":
       raise DatabaseError("The path is invalid")
-    cd_e = cd.replace("_","\\_").replace("%","\\%") + "%"
     objects = []
-    for object in self.c.execute("select localpath from objects where localpath like ? escape ?",(cd_e,"\\")):
-      if len(object[0].split(os.sep)) == len(cd.split(os.sep)):
-        objects.append(object[0])
-    return objects                                 
+    for object in self.c.execute("select localpath from objects where parent=? and localpath not in (?,?) order by localpath",
+                                 (os.path.normpath(cd),*self.reserved)):
+      objects.append(object[0])
+    return objects
 
   def readObject(self,localpath):
     """Open a database object for reading"""
@@ -295,8 +813,13 @@ class Database:
       raise DatabaseError("A path to an object is required")
     if localpath[0] != "/":
       raise DatabaseError("The path is invalid")
-    if not self.getObject(localpath):
+    self.c.execute("select chunked from objects where localpath=?",(localpath,))
+    t = self.c.fetchone()
+    if not t:
       raise DatabaseError("The path is not in the database")
+    if t[0]:
+      self.c.execute("select hash from object_chunks where localpath=? order by seq",(localpath,))
+      return ChunkReader([chunk_path(self.store,h) for (h,) in self.c.fetchall()])
     realpath = os.path.join(self.root,localpath[1:])
     if not os.path.isfile(realpath):
       raise DatabaseError("Object does not exist for reading")
@@ -310,11 +833,19 @@ class Database:
       raise DatabaseError("The path is invalid")
     if not self.getObject(localpath):
       raise DatabaseError("The path is not in the database")
+    if self.chunked:
+      #The object keeps its old content until the writer is closed
+      return ChunkWriter(self.store,lambda w: self.updateObject(localpath,None,None,None,w.chunks))
     realpath = os.path.join(self.root,localpath[1:])
+    #The content is about to change under us, so its metadata is no longer known
+    self.updateObject(localpath,None,None,None)
     return open(realpath,'wb')
 
-  def deleteObject(self,localpath):
-    """Drop an object from the database"""
+  def stageObject(self,localpath):
+    """Open a staging file for a database object, returning it with the staging and real paths
+
+    With the chunk store the staging file is a chunk writer and there is no
+      staging path; the caller links its chunks through updateObject"""
     if not localpath:
       raise DatabaseError("A path to an object is required")
     if localpath[0] != "/":
@@ -322,12 +853,140 @@ class Database:
     if not self.getObject(localpath):
       raise DatabaseError("The path is not in the database")
     realpath = os.path.join(self.root,localpath[1:])
-    if os.path.isdir(realpath):
-      shutil.rmtree(realpath)
-    else:
-      os.remove(realpath)
-    self.c.execute("begin transaction")
-    self.c.execute("delete from objects where localpath=?",(localpath,))
+    if self.chunked:
+      return ChunkWriter(self.store), None, realpath
+    stagepath = os.path.join(self.staging,os.urandom(16).hex())
+    return open(stagepath,'xb'), stagepath, realpath
+
+  def subtree(self,localpath):
+    """Bounds of the paths below an object, so a subtree is one range on the path index"""
+    prefix = localpath.rstrip("/") + "/"
+    return prefix, prefix[:-1] + chr(ord("/")+1)
+
+  def checkDestination(self,localpath,newpath):
+    """Check that an object may be moved or copied to a new path, returning both real paths"""
+    if not localpath or not newpath:
+      raise DatabaseError("A path to an object is required")
+    if localpath[0] != "/" or newpath[0] != "/":
+      raise DatabaseError("The path is invalid")
+    if self.isReserved(newpath):
+      raise DatabaseError("The path is reserved")
+    if not self.getObject(localpath):
+      raise DatabaseError("The path is not in the database")
+    low, high = self.subtree(localpath)
+    if newpath == localpath or low <= newpath < high:
+      raise DatabaseError("Cannot place an object inside itself")
+    if self.getObject(newpath):
+      raise DatabaseError("The destination already exists")
+    newreal = os.path.join(self.root,newpath[1:])
+    if not os.path.isdir(os.path.dirname(newreal)):
+      raise DatabaseError("A parent directory is missing from the filesystem")
+    return os.path.join(self.root,localpath[1:]), newreal
+
+  def deleteObject(self,localpath,defer=False):
+    """Drop an object and everything below it from the database
+
+    The files are moved into the staging directory within the transaction and
+      removed once it commits. With defer they are left there and the staged
+      path is returned for the caller to remove"""
+    if not localpath:
+      raise DatabaseError("A path to an object is required")
+    if localpath[0] != "/":
+      raise DatabaseError("The path is invalid")
+    if not self.getObject(localpath):
+      raise DatabaseError("The path is not in the database")
+    realpath = os.path.join(self.root,localpath[1:])
+    trash = os.path.join(self.staging,os.urandom(16).hex())
+    low, high = self.subtree(localpath)
+    self.c.execute("begin immediate transaction")
+    self.releaseChunks(localpath,low,high)
+    self.c.execute("delete from objects where localpath=? or (localpath>=? and localpath<?)",
+	(localpath,low,high))
+    self.c.execute("delete from rights where isobject=1 and (target=? or (target>=? and target<?))",
+	(localpath,low,high))
+    try:
+      if os.path.lexists(realpath): #Uploads only create the file once they finish
+        os.rename(realpath,trash)
+    except OSError as e:
+      self.c.execute("rollback transaction")
+      raise DatabaseError("Cannot remove the object: %s" % e.strerror)
+    self.c.execute("end transaction")
+    if defer:
+      return trash
+    remove_tree(trash)
+
+  def moveObject(self,localpath,newpath):
+    """Move or rename an object and everything below it"""
+    realpath, newreal = self.checkDestination(localpath,newpath)
+    low, high = self.subtree(localpath)
+    skip = len(localpath)+1
+    self.c.execute("begin immediate transaction")
+    try:
+      self.c.execute("update objects set localpath=?||substr(localpath,?), parent=case when localpath=? then ? else ?||substr(parent,?) end where localpath=? or (localpath>=? and localpath<?)",
+	(newpath,skip,localpath,os.path.dirname(newpath),newpath,skip,localpath,low,high))
+      self.c.execute("update rights set target=?||substr(target,?) where isobject=1 and (target=? or (target>=? and target<?))",
+	(newpath,skip,localpath,low,high))
+      self.c.execute("update object_chunks set localpath=?||substr(localpath,?) where localpath=? or (localpath>=? and localpath<?)",
+	(newpath,skip,localpath,low,high))
+      if os.path.lexists(realpath):
+        os.rename(realpath,newreal)
+    except sqlite3.IntegrityError:
+      self.c.execute("rollback transaction")
+      raise DatabaseError("The destination already exists")
+    except OSError as e:
+      self.c.execute("rollback transaction")
+      raise DatabaseError("Cannot move the object: %s" % e.strerror)
+    self.c.execute("end transaction")
+
+  def stageCopy(self,localpath,newpath):
+    """Check a copy and pick a staging path for it, returning the real source path and the staging path"""
+    realpath, newreal = self.checkDestination(localpath,newpath)
+    return realpath, os.path.join(self.staging,os.urandom(16).hex())
+
+  def copyObject(self,localpath,newpath,staged=None):
+    """Copy an object and everything below it, with its rights
+
+    The files are copied into a staging path first, by the caller when staged
+      is given, and renamed into place within the transaction. A staged copy
+      is removed if the copy cannot go ahead"""
+    try:
+      realpath, newreal = self.checkDestination(localpath,newpath)
+    except DatabaseError:
+      #The source or destination changed while the caller was copying
+      if staged:
+        remove_tree(staged)
+      raise
+    if not staged:
+      staged = os.path.join(self.staging,os.urandom(16).hex())
+      if os.path.lexists(realpath):
+        try:
+          copy_tree(realpath,staged)
+        except OSError as e:
+          remove_tree(staged)
+          raise DatabaseError("Cannot copy the object: %s" % e.strerror)
+    low, high = self.subtree(localpath)
+    skip = len(localpath)+1
+    self.c.execute("begin immediate transaction")
+    try:
+      self.c.execute("insert into objects(localpath,dir,parent,size,mtime,hash,chunked) select ?||substr(localpath,?),dir,case when localpath=? then ? else ?||substr(parent,?) end,size,mtime,hash,chunked from objects where localpath=? or (localpath>=? and localpath<?)",
+	(newpath,skip,localpath,os.path.dirname(newpath),newpath,skip,localpath,low,high))
+      #Chunked content is shared by the copy, which only costs references
+      self.c.execute("insert into object_chunks select ?||substr(localpath,?),seq,hash from object_chunks where localpath=? or (localpath>=? and localpath<?)",
+	(newpath,skip,localpath,low,high))
+      self.c.execute("update chunks set refs=refs+used.n from (select hash,count(*) as n from object_chunks where localpath=? or (localpath>=? and localpath<?) group by hash) as used where chunks.hash=used.hash",
+	(localpath,low,high))
+      self.c.execute("insert into rights select subject,?||substr(target,?),isobject,mask from rights where isobject=1 and (target=? or (target>=? and target<?))",
+	(newpath,skip,localpath,low,high))
+      if os.path.lexists(staged):
+        os.rename(staged,newreal)
+    except sqlite3.IntegrityError:
+      self.c.execute("rollback transaction")
+      remove_tree(staged)
+      raise DatabaseError("The destination already exists")
+    except OSError as e:
+      self.c.execute("rollback transaction")
+      remove_tree(staged)
+      raise DatabaseError("Cannot copy the object: %s" % e.strerror)
     self.c.execute("end transaction")
 
   def __exit__(self,exc_type,exc_value,traceback):
@@ -338,3 +997,103 @@ class Database:
     """Close the database connection"""
     self.conn.close()
     
+
+class AsyncDatabase:
+  """Awaitable facade running a Database on its own thread
+
+  Every call is queued to one worker thread that owns the SQLite connection,
+    so transactions never interleave and slow queries never stall the event
+    loop. Identical reads waiting at the same time share one result unless a
+    write was queued between them"""
+
+  #Calls that only read and may share a result
+  reads = frozenset(["getSubject","getSubjectNames","getLink","getFilter","getRight",
+                     "getObject","getObjectNames","getObjectInfo","getObjectDetails",
+                     "mayTransfer","getRightsHeld","getRightHolders","canShare","storeStats",
+                     "isReserved"])
+
+  def __init__(self,db="./sys.db",root="./fileroot",staging=None,profile=PROFILE_DEFAULT,
+               cache_size=0,chunked=False):
+    self.executor = ThreadPoolExecutor(1,thread_name_prefix="db")
+    self.db = self.executor.submit(Database,db,root,staging,profile,cache_size,chunked).result()
+    self.root = self.db.root
+    self.staging = self.db.staging
+    self.inflight = dict()
+    self.epoch = 0
+    self.calls = 0
+    self.coalesced = 0
+    self.peak_queued = 0
+    self.queued = 0
+
+  def __getattr__(self,name):
+    """Wrap a Database method in a coroutine that runs it on the worker"""
+    if name.startswith("_") or not callable(getattr(Database,name,None)):
+      raise AttributeError(name)
+    async def call(*args):
+      return await self.call(name,*args)
+    call.__name__ = name
+    return call
+
+  async def call(self,name,*args):
+    """Coroutine to run a Database method on the worker thread"""
+    self.calls += 1
+    if name in AsyncDatabase.reads:
+      key = (self.epoch,name,args)
+      future = self.inflight.get(key)
+      if future:
+        self.coalesced += 1
+        return await asyncio.shield(future)
+      future = self.submit(name,args)
+      self.inflight[key] = future
+      future.add_done_callback(lambda f: self.inflight.pop(key,None))
+      return await asyncio.shield(future)
+    #Later reads must not share a result fetched before this write
+    self.epoch += 1
+    return await self.submit(name,args)
+
+  async def writeObject(self,localpath):
+    """Coroutine to open a database object for writing
+
+    A chunk writer links its chunks to the object when it is closed, which
+      must happen on the worker that owns the connection; closing it blocks
+      until the worker has done so, as closing a file blocks on the disk"""
+    fd = await self.call("writeObject",localpath)
+    if isinstance(fd,ChunkWriter):
+      link = fd.on_close
+      def on_close(writer):
+        self.epoch += 1
+        self.executor.submit(link,writer).result()
+      fd.on_close = on_close
+    return fd
+
+  async def collectChunks(self,grace=_chunk_grace):
+    """Coroutine to sweep the chunk store
+
+    The store is scanned on a thread of its own and only the lookups of which
+      chunks are still referenced are queued on the worker, so a large store
+      does not hold up other calls"""
+    referenced = lambda digests: self.executor.submit(self.db.existing,"chunks","hash",digests).result()
+    return await asyncio.get_running_loop().run_in_executor(None,collect_chunks,self.db.store,referenced,grace)
+
+  def submit(self,name,args):
+    """Queue a call on the worker, returning an asyncio future for its result"""
+    self.queued += 1
+    self.peak_queued = max(self.peak_queued,self.queued)
+    future = asyncio.wrap_future(self.executor.submit(getattr(self.db,name),*args))
+    future.add_done_callback(self.done)
+    return future
+
+  def done(self,future):
+    """Count a finished call"""
+    self.queued -= 1
+
+  def stats(self):
+    """Snapshot of the worker counters"""
+    return {"calls": self.calls, "coalesced": self.coalesced, "queued": self.queued,
+            "peak_queued": self.peak_queued, "cache": self.db.cacheStats(),
+            "authorization": self.db.authzStats()}
+
+  def close(self):
+    """Close the connection on its own thread and stop the worker"""
+    self.executor.submit(self.db.close).result()
+    self.executor.shutdown(wait=True)
@@ -0,0 +1,81 @@
+
+import asyncio
+import hashlib
+import hmac
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from . import _hash_rounds, _kdf_workers
+from SPM.Util import log
+
+#Key Derivation
+#
+#PBKDF2 is deliberately slow. Running it on the event loop stalls every other
+#  connection, so the server hands derivations to a pool and awaits the result
+
+def derive_key(password,salt):
+  """Derive the 256 byte session key from a shared secret and a salt"""
+  return hashlib.pbkdf2_hmac("sha1",password.encode("UTF-8",errors="ignore"),
+                             salt,_hash_rounds,dklen=256)
+
+def derive_resume_secret(key):
+  """Derive the session resumption secret from a session key"""
+  return hmac.new(bytes(key),b"SPM session resumption",hashlib.sha256).digest()
+
+def derive_resumed_key(secret,nonce):
+  """Expand a resumption secret and a fresh nonce into a 256 byte session key"""
+  return b"".join(hmac.new(bytes(secret),bytes(nonce)+bytes([i]),hashlib.sha256).digest()
+                  for i in range(8))
+
+class DerivationPool:
+  """Bounded executor pool for key derivations"""
+
+  def __init__(self,workers=_kdf_workers,processes=False,limit=None):
+    assert workers > 0
+    self.workers = workers
+    self.limit = limit or workers
+    self.processes = processes
+    if processes:
+      self.executor = ProcessPoolExecutor(workers)
+    else:
+      self.executor = ThreadPoolExecutor(workers,thread_name_prefix="kdf")
+    self.slots = None
+    self.waiting = 0
+    self.running = 0
+    self.completed = 0
+    self.peak_waiting = 0
+
+  async def derive(self,password,salt):
+    """Coroutine to derive a key without blocking the event loop"""
+    if not self.slots:
+      self.slots = asyncio.Semaphore(self.limit)
+    self.waiting += 1
+    self.peak_waiting = max(self.peak_waiting,self.waiting)
+    if self.running >= self.limit:
+      log("Key derivation queue depth: %s" % self.waiting)
+    try:
+      await self.slots.acquire()
+    finally:
+      self.waiting -= 1
+    self.running += 1
+    try:
+      return await asyncio.get_running_loop().run_in_executor(
+        self.executor,derive_key,password,salt)
+    finally:
+      self.running -= 1
+      self.completed += 1
+      self.slots.release()
+
+  def depth(self):
+    """Number of derivations waiting for a free slot"""
+    return self.waiting
+
+  def stats(self):
+    """Snapshot of the pool counters"""
+    return {"workers": self.workers, "limit": self.limit, "processes": self.processes,
+            "running": self.running, "waiting": self.waiting,
+            "peak_waiting": self.peak_waiting, "completed": self.completed}
+
+  def close(self):
+    """Shut the pool down, waiting for running derivations"""
+    self.executor.shutdown(wait=True)
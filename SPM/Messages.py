@@ -10,10 +10,33 @@ from SPM.Util import log
 from . import _msg_size, _subject_size, _password_size, _lss_count
 from . import _file_size, _hash_size, _ticket_size, _ls_count, _type_size
 from . import _error_msg_size, _salt_size, _data_size, _file_path_size
+from . import _suite_list_size, _session_ticket_size, _compact_buckets
+from . import _bulk_bucket, _bulk_block_max, _recv_compact_size
+from . import _batch_subjects, _batch_links, _batch_rights, _batch_error_size
+from . import _rights_page, _lsd_count
 
 #Messages
 
 #Message Format: MessageClass(byte) MessageType(byte)...
+#
+#Compact framing keeps the same layout but trims each frame to the smallest size in
+#  _compact_buckets that holds the type and non-zero arguments. The bucket index is
+#  stored in the high nibble of the class byte. Bucket zero is a full frame, so a
+#  full compact frame is identical to a fixed frame
+#
+#Bulk framing adds XFER_BLOCK frames for file data. Their class byte carries
+#  _bulk_bucket in the high nibble and is followed by a 4 byte data length, the
+#  encrypted type byte and data, and a single tag covering the length and data
+#
+#Acknowledged uploads have the server answer the OKAY that ends an upload with
+#  OKAY or ERROR_SERVER once the object is in place, so the client learns when
+#  an upload failed. Older clients do not offer it and get no answer
+FRAMING_FIXED = 0
+FRAMING_COMPACT = 1
+FRAMING_BULK = 2
+FRAMING_ACKED = 4
+FRAMING_DEFAULT = FRAMING_COMPACT | FRAMING_BULK | FRAMING_ACKED
+
 TypeInfo = namedtuple("TypeInfo",["bc","fmt","args","codec"])
 Codec = namedtuple("Codec",["enc","dec"])
 
@@ -21,6 +44,19 @@ Codec = namedtuple("Codec",["enc","dec"])
 utf_enc = lambda a: str(a).encode(encoding="UTF-8",errors="ignore")
 utf_dec = lambda a: (a.decode(encoding="UTF-8",errors="ignore")).strip("\0")
 
+#Batch messages carry a record count and a more-frames-follow flag, then a fixed
+#  number of record slots
+text = (utf_enc,utf_dec)
+number = (int,int)
+real = (float,float)
+raw = (bytes,bytes)
+
+def batch_codec(*fields):
+  """Codec for a count and flag followed by repeated records, one (enc,dec) pair per record field"""
+  n = len(fields)
+  return Codec(lambda a: (int(a[0]),int(a[1]))+tuple(fields[i%n][0](v) for i,v in enumerate(a[2:])),
+               lambda a: (int(a[0]),int(a[1]))+tuple(fields[i%n][1](v) for i,v in enumerate(a[2:])))
+
 class BadMessageError(RuntimeError):
   """Wrapper around RuntimeError for catching exceptions for bad messages"""
   def __init__(self,message):
@@ -28,12 +64,12 @@ class BadMessageError(RuntimeError):
     log("BadMessageError: " + message)
 
 class MessageType(Enum):
-  HELLO_SERVER          = TypeInfo(bytes([0]),"!I",("Version",),
-                            Codec(lambda a: map(int,a),
-                                  lambda a: map(int,a)))
-  HELLO_CLIENT          = TypeInfo(bytes([1]),"!I",("Version",),
-                            Codec(lambda a: map(int,a),
-                                  lambda a: map(int,a)))
+  HELLO_SERVER          = TypeInfo(bytes([0]),"!I{}sB".format(_suite_list_size),("Version","Suites","Framing"),
+                            Codec(lambda a: (int(a[0]),bytes(a[1]),int(a[2])),
+                                  lambda a: (int(a[0]),bytes(a[1]).rstrip(bytes([0])),int(a[2]))))
+  HELLO_CLIENT          = TypeInfo(bytes([1]),"!I{}sB".format(_suite_list_size),("Version","Suites","Framing"),
+                            Codec(lambda a: (int(a[0]),bytes(a[1]),int(a[2])),
+                                  lambda a: (int(a[0]),bytes(a[1]).rstrip(bytes([0])),int(a[2]))))
   DIE                   = TypeInfo(bytes([2]),None,None,
                             Codec(None,None))
   PULL_FILE             = TypeInfo(bytes([3]),"!{}s".format(_file_path_size),("File Name",),
@@ -100,18 +136,72 @@ class MessageType(Enum):
                                   lambda a: map(utf_dec,a)))
   XFER_TICKET           = TypeInfo(bytes([24]),"!{0}s{0}s{1}s{0}sB".format(_subject_size,_ticket_size),
                                    ("Subject1","Subject2","Ticket","Target","IsObject"),
-                            Codec(lambda a: map(utf_enc,a),
-                                  lambda a: map(utf_dec,a)))
+                            Codec(lambda a: tuple(map(utf_enc,a[:4]))+(int(a[4]),),
+                                  lambda a: tuple(map(utf_dec,a[:4]))+(int(a[4]),)))
   GET_CD                = TypeInfo(bytes([25]),None,None,
                             Codec(None,None))
   DELETE_FILTER         = TypeInfo(bytes([26]),"!{0}s{0}s{1}s".format(_type_size,_ticket_size),("Type1","Type2","Ticket"),
                             Codec(lambda a: map(utf_enc,a),
                                   lambda a: map(utf_dec,a)))
+  GET_SESSION_TICKET    = TypeInfo(bytes([27]),None,None,
+                            Codec(None,None))
+  SESSION_TICKET        = TypeInfo(bytes([28]),"!{}sI".format(_session_ticket_size),("Ticket","Lifetime"),
+                            Codec(lambda a: (bytes(a[0]),int(a[1])),
+                                  lambda a: (bytes(a[0]),int(a[1]))))
+  RESUME_SUBJECT        = TypeInfo(bytes([29]),"!{}s{}s".format(_session_ticket_size,_salt_size),("Ticket","Nonce"),
+                            Codec(lambda a: (bytes(a[0]),bytes(a[1])),
+                                  lambda a: (bytes(a[0]),bytes(a[1]))))
+  XFER_BLOCK            = TypeInfo(bytes([30]),None,None, #Raw data, see BlockStrategy
+                            Codec(None,None))
+  MAKE_SUBJECTS         = TypeInfo(bytes([31]),"!BB"+"{}s{}s{}s".format(_subject_size,_type_size,_password_size)*_batch_subjects,
+                                   ("Count","More")+("Subject","Type","Password")*_batch_subjects,
+                            batch_codec(text,text,text))
+  MAKE_LINKS            = TypeInfo(bytes([32]),"!BB"+"{0}s{0}s".format(_subject_size)*_batch_links,
+                                   ("Count","More")+("Subject1","Subject2")*_batch_links,
+                            batch_codec(text,text))
+  GIVE_TICKETS          = TypeInfo(bytes([33]),"!BB"+"{0}s{1}s{0}sB".format(_subject_size,_ticket_size)*_batch_rights,
+                                   ("Count","More")+("Subject","Ticket","Target","IsObject")*_batch_rights,
+                            batch_codec(text,text,text,number))
+  BATCH_RESULT          = TypeInfo(bytes([34]),"!BB"+"B{}s".format(_batch_error_size)*max(_batch_subjects,_batch_links,_batch_rights),
+                                   ("Count","More")+("Status","Error Message")*max(_batch_subjects,_batch_links,_batch_rights),
+                            batch_codec(number,text))
+  RIGHTS_HELD           = TypeInfo(bytes([35]),"!{0}s{0}sB".format(_subject_size),("Subject","After","AfterIsObject"),
+                            Codec(lambda a: (utf_enc(a[0]),utf_enc(a[1]),int(a[2])),
+                                  lambda a: (utf_dec(a[0]),utf_dec(a[1]),int(a[2]))))
+  RIGHT_HOLDERS         = TypeInfo(bytes([36]),"!{1}s{0}sB{0}s".format(_subject_size,_ticket_size),
+                                   ("Ticket","Target","IsObject","After"),
+                            Codec(lambda a: (utf_enc(a[0]),utf_enc(a[1]),int(a[2]),utf_enc(a[3])),
+                                  lambda a: (utf_dec(a[0]),utf_dec(a[1]),int(a[2]),utf_dec(a[3]))))
+  RIGHTS_PAGE           = TypeInfo(bytes([37]),"!BB"+"{}sBB".format(_subject_size)*_rights_page,
+                                   ("Count","More")+("Name","IsObject","Rights")*_rights_page,
+                            batch_codec(text,number,number))
+  CAN_SHARE             = TypeInfo(bytes([38]),"!{1}s{0}s{0}s".format(_subject_size,_ticket_size),
+                                   ("Ticket","Subject1","Subject2"),
+                            Codec(lambda a: map(utf_enc,a),
+                                  lambda a: map(utf_dec,a)))
+  SHARE_RESULT          = TypeInfo(bytes([39]),"!B",("Result",),
+                            Codec(lambda a: (int(a[0]),),
+                                  lambda a: (int(a[0]),)))
+  MOVE_PATH             = TypeInfo(bytes([40]),"!{0}s{0}s".format(_file_size),("Source","Destination"),
+                            Codec(lambda a: map(utf_enc,a),
+                                  lambda a: map(utf_dec,a)))
+  COPY_PATH             = TypeInfo(bytes([41]),"!{0}s{0}s".format(_file_size),("Source","Destination"),
+                            Codec(lambda a: map(utf_enc,a),
+                                  lambda a: map(utf_dec,a)))
+  LIST_DETAILED         = TypeInfo(bytes([42]),"!{}s".format(_file_size),("After",),
+                            Codec(lambda a: map(utf_enc,a),
+                                  lambda a: map(utf_dec,a)))
+  STAT_PATH             = TypeInfo(bytes([43]),"!{}s".format(_file_path_size),("Path",),
+                            Codec(lambda a: map(utf_enc,a),
+                                  lambda a: map(utf_dec,a)))
+  OBJECT_PAGE           = TypeInfo(bytes([44]),"!BB"+"{}sBQd16s".format(_file_size)*_lsd_count,
+                                   ("Count","More")+("Name","Dir","Size","Mtime","Hash")*_lsd_count,
+                            batch_codec(text,number,number,real,raw))
 
 class MessageClass(Enum):
   PUBLIC_MSG = bytes([0])
   PRIVATE_MSG = bytes([1])
-  
+
 
 class MessageStrategy:
 
@@ -119,6 +209,15 @@ class MessageStrategy:
 
   fmt_h = "!1s1s"
   fmt_t = "!{}s".format(_hash_size)
+  head = struct.Struct(fmt_h)
+  tail = struct.Struct(fmt_t)
+  bulk = struct.Struct("!I")
+
+  #Lookup tables indexed by header byte, filled in as types and strategies are declared
+  class_table = [None]*256
+  type_table = [None]*256
+  table = {msg_class: [None]*256 for msg_class in MessageClass}
+  buckets = sorted(enumerate(_compact_buckets),key=lambda bucket: bucket[1])
 
   def __init__(self,msg_class,msg_type):
     self.msg_class = msg_class
@@ -126,26 +225,53 @@ class MessageStrategy:
     self.arg_count = 0 if msg_type.value.args is None else len(msg_type.value.args)
     self.parms_info = msg_type.value.args
     self.fmt_b = self.msg_type.value.fmt
+    self.body = struct.Struct(self.fmt_b) if self.fmt_b else None
+    #Every frame starts as a copy of the header followed by zero padding
+    self.template = MessageStrategy.head.pack(msg_class.value,msg_type.value.bc) + bytes(_msg_size-2)
     MessageStrategy.strategies[(msg_class,msg_type)] = self
+    MessageStrategy.table[msg_class][msg_type.value.bc[0]] = (msg_type,self)
+
+  @staticmethod
+  def is_bulk(msg_buf,framing=FRAMING_FIXED):
+    """Check whether a frame header marks a bulk frame"""
+    return bool(framing & FRAMING_BULK) and msg_buf[0] >> 4 == _bulk_bucket
+
+  @staticmethod
+  def frame_size(msg_buf,framing=FRAMING_FIXED):
+    """Length of the frame at the start of a buffer, or zero if its header is incomplete"""
+    if not msg_buf:
+      return 0
+    if MessageStrategy.is_bulk(msg_buf,framing):
+      if len(msg_buf) < 1+MessageStrategy.bulk.size:
+        return 0
+      length = MessageStrategy.bulk.unpack_from(msg_buf,1)[0]
+      if length > _bulk_block_max:
+        raise BadMessageError("Bulk frame is too large")
+      return 1 + MessageStrategy.bulk.size + 1 + length + _hash_size
+    if not framing & FRAMING_COMPACT:
+      return _msg_size
+    bucket = msg_buf[0] >> 4
+    if bucket >= len(_compact_buckets):
+      raise BadMessageError("Invalid frame bucket")
+    return _compact_buckets[bucket]
 
   @staticmethod
-  def detect_class(msg_buf):
+  def detect_class(msg_buf,framing=FRAMING_FIXED):
     """Determine the message class from the block header"""
-    if msg_buf[0:1] == MessageClass.PUBLIC_MSG.value:
-      return MessageClass.PUBLIC_MSG
-    elif msg_buf[0:1] == MessageClass.PRIVATE_MSG.value:
-      return MessageClass.PRIVATE_MSG
-    raise BadMessageError("Invalid message class")
+    msg_class = MessageStrategy.class_table[msg_buf[0] & 0x0F if framing else msg_buf[0]]
+    if not msg_class:
+      raise BadMessageError("Invalid message class")
+    return msg_class
 
   @staticmethod
-  def detect_type(msg_buf):
-    for msg_type in MessageType:
-      """Detect the message type of a decrypted message"""
-      if msg_buf[1:2] == msg_type.value.bc:
-        return msg_type
-    raise BadMessageError("Failed to detect message type")
+  def detect_type(msg_buf,offset=1):
+    """Detect the message type of a decrypted message"""
+    msg_type = MessageStrategy.type_table[msg_buf[offset]]
+    if not msg_type:
+      raise BadMessageError("Failed to detect message type")
+    return msg_type
       
-  def build(self,args=None,stream=None,hmacf=None):
+  def build(self,args=None,stream=None,hmacf=None,framing=FRAMING_FIXED):
     """Assemble a message of this type, encrypting if possible"""
     if self.arg_count:
       assert len(args)==self.arg_count
@@ -153,46 +279,61 @@ class MessageStrategy:
       assert not args
     assert bool(stream) == bool(hmacf)
     assert self.msg_class != MessageClass.PRIVATE_MSG or (stream and hmacf)
-    header_buf = struct.pack(MessageStrategy.fmt_h,self.msg_class.value,
-                                self.msg_type.value.bc)
+    msg_buf = bytearray(self.template)
     if args:
-      args = tuple(self.msg_type.value.codec.enc(args))
-      body_buf = struct.pack(self.fmt_b,*args)
-    else:
-      body_buf = bytes([0])
-    body_buf += bytes([0])*(_msg_size-(len(body_buf)+len(header_buf)+_hash_size))
-    msg_buf = header_buf[1:2] + body_buf
+      self.body.pack_into(msg_buf,2,*self.msg_type.value.codec.enc(args))
+    if framing & FRAMING_COMPACT:
+      self.trim(msg_buf)
     if self.msg_class == MessageClass.PRIVATE_MSG:
-      msg_buf = stream.xor(msg_buf)
-      msg_buf += struct.pack(MessageStrategy.fmt_t,hmacf(msg_buf))
-    else:
-      msg_buf += bytes([0])*_hash_size
-    msg_buf = header_buf[0:1] + msg_buf
-    assert len(msg_buf) == _msg_size
+      view = memoryview(msg_buf)
+      view[1:-_hash_size] = stream.xor(view[1:-_hash_size])
+      MessageStrategy.tail.pack_into(msg_buf,len(msg_buf)-_hash_size,hmacf(view[1:-_hash_size]))
+      view.release()
     return msg_buf
 
+  def trim(self,msg_buf):
+    """Cut an unencrypted frame down to the smallest bucket holding its contents"""
+    used = 2 + (len(bytes(msg_buf[2:2+self.body.size]).rstrip(bytes([0]))) if self.body else 0)
+    for bucket,size in MessageStrategy.buckets:
+      if used <= size-_hash_size:
+        del msg_buf[size:]
+        msg_buf[0] |= bucket << 4
+        return
+
   @staticmethod
-  def parse(msg_buf,stream=None,hmacf=None):
+  def parse(msg_buf,stream=None,hmacf=None,framing=FRAMING_FIXED):
     """Parse a potentially-encrypted message into an argument dictionary"""
     assert msg_buf
     assert bool(stream) == bool(hmacf)
-    assert len(msg_buf) == _msg_size
-    msg_class = MessageStrategy.detect_class(msg_buf)
+    assert len(msg_buf) == MessageStrategy.frame_size(msg_buf,framing)
+    view = memoryview(msg_buf)
+    msg_class = MessageStrategy.detect_class(view,framing)
+    bulk = MessageStrategy.is_bulk(view,framing)
+    #The body holds the type byte followed by the arguments
+    body = view[1+MessageStrategy.bulk.size if bulk else 1:-_hash_size]
     if msg_class == MessageClass.PRIVATE_MSG:
       assert stream
       assert hmacf
-      if compare_digest(hmacf(msg_buf[1:-_hash_size]),msg_buf[-_hash_size:]):
-        msg_buf = msg_buf[0:1] + stream.xor(msg_buf[1:-_hash_size])
+      if compare_digest(hmacf(view[1:-_hash_size]),view[-_hash_size:]):
+        body = stream.xor(body)
       else:
-        stream.xor(msg_buf[1:-_hash_size]) #Spend RC4 to keep sync in case of corruption
+        stream.xor(body) #Spend RC4 to keep sync in case of corruption
         raise BadMessageError("Message integrity check failure")
-    msg_type = MessageStrategy.detect_type(msg_buf)
-    if not (msg_class,msg_type) in strategies:
+    entry = MessageStrategy.table[msg_class][body[0]]
+    if not entry:
+      MessageStrategy.detect_type(body,0)
       raise BadMessageError("Bad msg_class,msg_type combination")
-    fmt_b = msg_type.value.fmt
+    msg_type, strategy = entry
     msg_dict = dict()
-    if fmt_b:
-      contents = struct.unpack_from(fmt_b,msg_buf,2)
+    if bulk != isinstance(strategy,BlockStrategy):
+      raise BadMessageError("Message type does not match the frame")
+    if bulk:
+      msg_dict["Data"] = memoryview(body)[1:]
+      msg_dict["BSize"] = len(body)-1
+    elif strategy.body:
+      if len(body) <= strategy.body.size:
+        body = bytes(body) + bytes(strategy.body.size+1-len(body)) #Restore trimmed zeros
+      contents = strategy.body.unpack_from(body,1)
       contents = tuple(msg_type.value.codec.dec(contents))
       arg_count = len(msg_type.value.args)
       assert len(contents) == len(msg_type.value.args)
@@ -215,12 +356,75 @@ class MessageStrategy:
     """String representation of the message strategy"""
     return str(self.__class__) + ": " + str(self.__dict__)
 
+for msg_class in MessageClass:
+  MessageStrategy.class_table[msg_class.value[0]] = msg_class
+for msg_type in MessageType:
+  assert not MessageStrategy.type_table[msg_type.value.bc[0]], "Duplicate type byte"
+  MessageStrategy.type_table[msg_type.value.bc[0]] = msg_type
+
+class BlockStrategy(MessageStrategy):
+  """Strategy for bulk frames, which carry raw data outside the fixed frame layout"""
+
+  def __init__(self,msg_class,msg_type):
+    super().__init__(msg_class,msg_type)
+    self.arg_count = 1
+
+  def build(self,args=None,stream=None,hmacf=None,framing=FRAMING_BULK):
+    """Assemble and encrypt a bulk frame around a block of data"""
+    assert len(args) == 1
+    assert framing & FRAMING_BULK
+    assert stream and hmacf
+    data = args[0]
+    assert len(data) <= _bulk_block_max
+    start = 1 + MessageStrategy.bulk.size
+    msg_buf = bytearray(start+1+len(data)+_hash_size)
+    msg_buf[0] = self.msg_class.value[0] | (_bulk_bucket << 4)
+    MessageStrategy.bulk.pack_into(msg_buf,1,len(data))
+    msg_buf[start] = self.msg_type.value.bc[0]
+    msg_buf[start+1:start+1+len(data)] = data
+    view = memoryview(msg_buf)
+    view[start:-_hash_size] = stream.xor(view[start:-_hash_size])
+    MessageStrategy.tail.pack_into(msg_buf,len(msg_buf)-_hash_size,hmacf(view[1:-_hash_size]))
+    view.release()
+    return msg_buf
+
+class FrameBuffer:
+  """Receive buffer that hands out whole frames by advancing a read offset"""
+
+  def __init__(self):
+    self.buf = bytearray()
+    self.offset = 0
+
+  def __len__(self):
+    return len(self.buf) - self.offset
+
+  def extend(self,data):
+    """Append received data, reclaiming consumed space only when it is worthwhile"""
+    if self.offset == len(self.buf):
+      self.buf.clear()
+      self.offset = 0
+    elif self.offset >= _recv_compact_size and self.offset*2 >= len(self.buf):
+      del self.buf[0:self.offset]
+      self.offset = 0
+    self.buf.extend(data)
+
+  def nextFrame(self,framing=FRAMING_FIXED):
+    """Pop the next complete frame, or None if more data is needed"""
+    with memoryview(self.buf) as view, view[self.offset:] as pending:
+      size = MessageStrategy.frame_size(pending,framing)
+      if not size or len(pending) < size:
+        return None
+      frame = bytes(pending[0:size])
+    self.offset += size
+    return frame
+
 #Public messages
 MessageStrategy(MessageClass.PUBLIC_MSG,MessageType.HELLO_SERVER)
 MessageStrategy(MessageClass.PUBLIC_MSG,MessageType.HELLO_CLIENT)
 MessageStrategy(MessageClass.PUBLIC_MSG,MessageType.DIE)
 MessageStrategy(MessageClass.PUBLIC_MSG,MessageType.ERROR_SERVER)
 MessageStrategy(MessageClass.PUBLIC_MSG,MessageType.AUTH_SUBJECT)
+MessageStrategy(MessageClass.PUBLIC_MSG,MessageType.RESUME_SUBJECT)
 
 #Private messages
 MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.DIE)
@@ -229,6 +433,7 @@ MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.AUTH_SUBJECT)
 MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.PULL_FILE)
 MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.PUSH_FILE)
 MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.XFER_FILE)
+BlockStrategy(MessageClass.PRIVATE_MSG,MessageType.XFER_BLOCK)
 MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.OKAY)
 MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.CONFIRM_AUTH)
 MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.LIST_SUBJECT_CLIENT)
@@ -248,6 +453,22 @@ MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.GET_CD)
 MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.DELETE_PATH)
 MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.CLEAR_LINKS)
 MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.DELETE_SUBJECT)
+MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.GET_SESSION_TICKET)
+MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.SESSION_TICKET)
+MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.MAKE_SUBJECTS)
+MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.MAKE_LINKS)
+MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.GIVE_TICKETS)
+MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.BATCH_RESULT)
+MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.RIGHTS_HELD)
+MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.RIGHT_HOLDERS)
+MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.RIGHTS_PAGE)
+MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.CAN_SHARE)
+MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.SHARE_RESULT)
+MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.MOVE_PATH)
+MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.COPY_PATH)
+MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.LIST_DETAILED)
+MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.STAT_PATH)
+MessageStrategy(MessageClass.PRIVATE_MSG,MessageType.OBJECT_PAGE)
 
 #Table of strategies for building messages
 strategies = MessageStrategy.strategies
@@ -267,3 +488,21 @@ for msg_type in MessageType:
 #Neither links nor filters are bidirectional
 #Super subjects exist that can create and destroy links and filters
 #Some commands allow longer subject names than others
+#HELLO messages carry cipher suite ids: the client lists the suites it supports in
+#  order of preference and the server answers with the single suite it chose.
+#  Older peers send no suites and are answered with RC4
+#Batch messages carry up to a fixed number of records each, the rest of the slots
+#  zeroed. Both directions share one keystream, so a batch runs in two phases: the
+#  client sends every frame, flagging all but the last with More, then the server
+#  applies the records in one transaction and answers with BATCH_RESULT frames
+#  holding a status and error message per record, in order
+#Rights queries answer one RIGHTS_PAGE per request, each record a name, an object
+#  flag and a bitmask of the rights held. More is set when rows remain, and the
+#  client asks again with the last name (and object flag) of the page as its cursor
+#LIST_DETAILED pages through the current directory like the rights queries, and
+#  STAT_PATH is answered with a single record page. Each record carries the size,
+#  modification time and MD5 digest recorded when the object was last uploaded,
+#  or zeros when they are not known
+#DELETE_PATH, MOVE_PATH and COPY_PATH act on a directory and everything below it
+#Session tickets are opaque to the client. A resumed connection derives its keys
+#  from the cached secret and the new nonce, so no ticket is ever tied to one key
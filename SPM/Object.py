@@ -0,0 +1,5 @@
+from collections import namedtuple
+
+#Object
+
+Object = namedtuple("Object",["localpath","dir","size","mtime","hash"])
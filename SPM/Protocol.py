@@ -1,22 +1,31 @@
 
 import asyncio
-import hashlib
 import random
 import os
 
-from . import __version__, _msg_size, _hash_rounds, _data_size
-from . import _base_login_delay, _lss_count, _ls_count, _login_delay_spread
+from . import __version__, _data_size, _bulk_block_size, _dispatch_depth
+from . import _write_high_water, _write_low_water
+from . import _base_login_delay, _lss_count, _ls_count, _lsd_count, _login_delay_spread
+from . import _batch_subjects, _batch_links, _batch_rights, _batch_max, _rights_page
 from SPM.Util import log, chunks, expandPath
 
 from SPM.Messages import MessageStrategy, MessageClass, MessageType
-from SPM.Messages import BadMessageError
+from SPM.Messages import FrameBuffer, BadMessageError, FRAMING_FIXED, FRAMING_BULK, FRAMING_ACKED, FRAMING_DEFAULT
 from SPM.Database import DatabaseError
-from SPM.Stream import getBestCipherObject, make_hmacf
+from SPM.Stream import getCipherObject, make_hmacf, suites
+from SPM.Derivation import derive_resume_secret, derive_resumed_key
 from SPM.Status import Status
 
 strategies = MessageStrategy.strategies
 
 db = None #Initialized before server
+kdf = None #Initialized before server
+sessions = None #Initialized before server when resumption is enabled
+xfers = None #Initialized before server
+framing = FRAMING_DEFAULT #Framing modes the server will agree to
+block_size = _bulk_block_size #Data carried by each bulk frame sent
+dispatch_depth = _dispatch_depth #Frames queued per connection before reading pauses
+write_limits = (_write_high_water,_write_low_water) #Output buffer water marks
 
 class Protocol(asyncio.Protocol):
 
@@ -25,36 +34,50 @@ class Protocol(asyncio.Protocol):
     self.peerinfo = None
     self.transport = None
     self.status = Status.NORMAL
-    self.buf = bytearray()
+    self.inbox = FrameBuffer()
+    self.queue = asyncio.Queue(dispatch_depth)
+    self.dispatcher = None
+    self.reading = True
     self.subject = None
     self.stream = None
     self.hmacf = None
+    self.suite = suites.default
+    self.session_secret = None
+    self.framing = FRAMING_FIXED
     self.fd = None
+    self.upload = None
+    self.batch_type = None
+    self.batch = []
+    self.batch_error = None
     self.cd = "/"
     self.pwd = os.path.join(os.getcwd(),db.root)
     self.write_lock = asyncio.Lock()
+    self.write_enable = asyncio.Event()
+    self.write_enable.set()
 
   def pause_writing(self):
     """Handle request to stop filling the output buffer"""
-    self.loop.create_task(self.write_enable.acquire())
+    self.write_enable.clear()
 
   def resume_writing(self):
     """Handle request to resume writing to the output buffer"""
-    self.write_enable.release()
+    self.write_enable.set()
 
   async def sendall(self,data):
-    """Coroutine to send a block of data to the output buffer if we may write"""
-    await self.write_lock.acquire()
-    self.transport.write(data)
-    self.write_lock.release()
+    """Coroutine to send a block of data, suspending while the output buffer drains"""
+    async with self.write_lock:
+      await self.write_enable.wait()
+      if self.transport.is_closing():
+        raise ConnectionResetError("Connection closed while sending")
+      self.transport.write(data)
 
   async def sendError(self,msg):
     """Coroutine to send an error message safely"""
     if self.stream:
       msg = strategies[(MessageClass.PRIVATE_MSG,MessageType.ERROR_SERVER)].build(
-                            [msg],self.stream,self.hmacf)
+                            [msg],self.stream,self.hmacf,self.framing)
     else:
-      msg = strategies[(MessageClass.PUBLIC_MSG,MessageType.ERROR_SERVER)].build([msg])
+      msg = strategies[(MessageClass.PUBLIC_MSG,MessageType.ERROR_SERVER)].build([msg],framing=self.framing)
     try:
       await self.sendall(msg)
     except IOError:
@@ -63,9 +86,10 @@ class Protocol(asyncio.Protocol):
   def connection_made(self,transport):
     """Handle the new connection event"""
     self.transport = transport
-    self.transport.set_write_buffer_limits(10000,0)
+    self.transport.set_write_buffer_limits(*write_limits)
     self.peerinfo = transport.get_extra_info("peername")
     log("Connection from %s:%s" % self.peerinfo)
+    self.dispatcher = self.loop.create_task(self.dispatch_loop())
 
   def connection_lost(self,exc):
     """Handle both unexpected and normal connection loss"""
@@ -73,18 +97,128 @@ class Protocol(asyncio.Protocol):
       log("Lost connection with %s" % self.peerinfo[0])
     else:
       log("%s connection closed" % self.peerinfo[0])
+    if self.dispatcher:
+      self.dispatcher.cancel()
+    #Wake any sender still waiting for the buffer to drain
+    self.write_enable.set()
+    if self.upload:
+      self.loop.create_task(self.upload.abort())
+      self.upload = None
 
   async def sendOkay(self):
     """Coroutine to send a confirmation message"""
     await self.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.OKAY)].build(
-                                None,self.stream,self.hmacf))
+                                None,self.stream,self.hmacf,self.framing))
+
+  async def sendBatchResults(self,results):
+    """Coroutine to report the outcome of each record in a batch, in as many frames as needed"""
+    slots = max(_batch_subjects,_batch_links,_batch_rights)
+    frames = chunks(results,slots) or [[]]
+    for i,frame in enumerate(frames):
+      fields = [len(frame),int(i < len(frames)-1)]
+      for result in frame:
+        fields += [1 if result else 0, result or ""]
+      fields += [0,""]*(slots-len(frame))
+      await self.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.BATCH_RESULT)].build(
+                                  fields,self.stream,self.hmacf,self.framing))
+
+  async def sendRightsPage(self,rows):
+    """Coroutine to send one page of (name,isobject,mask) rows, flagging More if a further row was fetched"""
+    page = rows[:_rights_page]
+    fields = [len(page),int(len(rows) > _rights_page)]
+    for name,isobject,mask in page:
+      fields += [name,int(isobject),mask]
+    fields += ["",0,0]*(_rights_page-len(page))
+    await self.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.RIGHTS_PAGE)].build(
+                                fields,self.stream,self.hmacf,self.framing))
+
+  async def sendObjectPage(self,objects,more=False):
+    """Coroutine to send one page of objects by name with their metadata"""
+    fields = [len(objects),int(more)]
+    for obj in objects:
+      fields += [os.path.basename(obj.localpath),int(obj.dir),obj.size or 0,obj.mtime or 0.0,
+                 obj.hash or bytes(16)]
+    fields += ["",0,0,0.0,bytes(16)]*(_lsd_count-len(objects))
+    await self.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.OBJECT_PAGE)].build(
+                                fields,self.stream,self.hmacf,self.framing))
+
+  async def gatherBatch(self,msg_type,msg_dict):
+    """Coroutine to collect the records of a batch, applying them all after its final frame"""
+    if self.batch_type not in (None,msg_type):
+      self.batch_error = "Batch message types do not match"
+    self.batch_type = msg_type
+    if msg_type == MessageType.MAKE_SUBJECTS:
+      count = min(msg_dict["Count"],_batch_subjects)
+      records = tuple(zip(msg_dict["Subject"],msg_dict["Type"],msg_dict["Password"]))[:count]
+    elif msg_type == MessageType.MAKE_LINKS:
+      count = min(msg_dict["Count"],_batch_links)
+      records = tuple(zip(msg_dict["Subject1"],msg_dict["Subject2"]))[:count]
+    else:
+      count = min(msg_dict["Count"],_batch_rights)
+      records = []
+      for subject,ticket,target,isObject in tuple(zip(msg_dict["Subject"],msg_dict["Ticket"],
+                                                      msg_dict["Target"],msg_dict["IsObject"]))[:count]:
+        if isObject:
+          target = expandPath("/",self.cd,target)
+        records.append((subject,ticket,target,bool(isObject)))
+    if len(self.batch)+len(records) > _batch_max:
+      self.batch_error = "Batch is too large"
+    if not self.batch_error:
+      self.batch.extend(records)
+    #Nothing may be sent until the client has finished sending, see Messages
+    if msg_dict["More"]:
+      return
+    batch, error = self.batch, self.batch_error
+    self.batch_type, self.batch, self.batch_error = None, [], None
+    if error:
+      await self.sendError(error)
+      return
+    try:
+      if msg_type == MessageType.MAKE_SUBJECTS:
+        results = await db.insertSubjects(batch)
+      elif msg_type == MessageType.MAKE_LINKS:
+        results = await db.insertLinks(batch)
+      else:
+        results = await db.insertRights(batch)
+    except DatabaseError as e:
+      await self.sendError("DatabaseError: %s" % str(e))
+      return
+    await self.sendBatchResults(results)
 
   def data_received(self,data):
     """Handle new block of data received"""
-    self.buf.extend(data)
-    while len(self.buf) >= _msg_size:
-      self.loop.create_task(self.dispatch_msg_block(self.buf[0:_msg_size]))
-      self.buf = self.buf[_msg_size:]
+    self.inbox.extend(data)
+    self.queueFrames()
+
+  def queueFrames(self):
+    """Move complete frames from the receive buffer to the dispatch queue"""
+    while not self.queue.full():
+      try:
+        msg_block = self.inbox.nextFrame(self.framing)
+      except BadMessageError:
+        self.transport.close()
+        return
+      if not msg_block:
+        break
+      self.queue.put_nowait(msg_block)
+    #Stop reading while the queue is full so a fast sender cannot grow our memory
+    if self.queue.full() and self.reading:
+      self.transport.pause_reading()
+      self.reading = False
+
+  async def dispatch_loop(self):
+    """Coroutine to handle queued frames one at a time in arrival order"""
+    while True:
+      msg_block = await self.queue.get()
+      try:
+        await self.dispatch_msg_block(msg_block)
+      except Exception as e:
+        log("Error handling message from %s: %s" % (self.peerinfo[0],repr(e)))
+      if not self.reading and self.queue.qsize() <= self.queue.maxsize//2:
+        self.queueFrames()
+        if not self.queue.full() and not self.transport.is_closing():
+          self.transport.resume_reading()
+          self.reading = True
 
   async def dispatch_msg_block(self,msg_block):
     """Handle a message block"""
@@ -93,7 +227,7 @@ class Protocol(asyncio.Protocol):
       return
     #Try to parse the (possibly evil) message
     try:
-      msg_dict = MessageStrategy.parse(msg_block,self.stream,self.hmacf)
+      msg_dict = MessageStrategy.parse(msg_block,self.stream,self.hmacf,self.framing)
     except BadMessageError:
       await self.sendError("BadMessageError")
       return
@@ -106,7 +240,12 @@ class Protocol(asyncio.Protocol):
       if __version__ != msg_dict["Version"]:
         await self.sendError("Version Mismatch")
       else:
-        out_data = strategies[(MessageClass.PUBLIC_MSG,MessageType.HELLO_SERVER)].build([__version__])
+        self.suite = suites.choose(msg_dict["Suites"])
+        #Every frame after this greeting uses the agreed framing
+        self.framing = msg_dict["Framing"] & framing
+        log("Cipher suite %s chosen for %s" % (suites.name(self.suite),self.peerinfo[0]))
+        out_data = strategies[(MessageClass.PUBLIC_MSG,MessageType.HELLO_SERVER)].build(
+          [__version__,bytes([self.suite]),self.framing])
         await self.sendall(out_data)
     elif msg_type == MessageType.DIE:
       #Immidiately close the connection
@@ -120,33 +259,64 @@ class Protocol(asyncio.Protocol):
       #Resist timing attacks on the login process
       await asyncio.sleep(_base_login_delay + random.random()*_login_delay_spread)
       try:
-        target_entry = db.getSubject(target)
+        target_entry = await db.getSubject(target)
         if target_entry:
-          key = hashlib.pbkdf2_hmac("sha1",target_entry.password.encode(
-            "UTF-8",errors="ignore"),salt,_hash_rounds, dklen=256)
-          self.stream = getBestCipherObject(key)
+          key = await kdf.derive(target_entry.password,salt)
+          self.stream = getCipherObject(self.suite,key)
           self.hmacf = make_hmacf(key)
           out_data = strategies[(MessageClass.PRIVATE_MSG,MessageType.CONFIRM_AUTH)].build([
-            target_entry.subject],self.stream,self.hmacf)
+            target_entry.subject],self.stream,self.hmacf,self.framing)
           self.subject = target_entry.subject
+          self.session_secret = derive_resume_secret(key)
         else: #This is our way of rejecting the login
           key = os.urandom(256)
-          self.stream = RC4(key)
+          self.stream = getCipherObject(self.suite,key)
           self.hmacf = make_hmacf(key)
           out_data = strategies[(MessageClass.PRIVATE_MSG,MessageType.CONFIRM_AUTH)].build([
-            target],self.stream,self.hmacf)
+            target],self.stream,self.hmacf,self.framing)
           self.subject = None
         await self.sendall(out_data)
       except DatabaseError as e:
         await self.sendError("DatabaseError: %s" % str(e))
+    elif msg_type == MessageType.RESUME_SUBJECT:
+      ticket = msg_dict["Ticket"]
+      nonce = msg_dict["Nonce"]
+      if not any(ticket) or not any(nonce):
+        await self.sendError("Missing ticket or nonce")
+        return
+      try:
+        session = sessions.lookup(ticket) if sessions else None
+        if session and await db.getSubject(session.subject):
+          key = derive_resumed_key(session.secret,nonce)
+          self.subject = session.subject
+          self.session_secret = derive_resume_secret(key)
+        else: #Reject exactly as a failed login does
+          key = os.urandom(256)
+          self.subject = None
+        self.stream = getCipherObject(self.suite,key)
+        self.hmacf = make_hmacf(key)
+        out_data = strategies[(MessageClass.PRIVATE_MSG,MessageType.CONFIRM_AUTH)].build([
+          self.subject or ""],self.stream,self.hmacf,self.framing)
+        await self.sendall(out_data)
+      except DatabaseError as e:
+        await self.sendError("DatabaseError: %s" % str(e))
+    elif msg_type == MessageType.GET_SESSION_TICKET:
+      if not sessions:
+        await self.sendError("Session resumption is disabled")
+      elif not self.subject:
+        await self.sendError("Must be authenticated")
+      else:
+        ticket = sessions.issue(self.subject,self.session_secret)
+        await self.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.SESSION_TICKET)].build(
+          [ticket,sessions.lifetime],self.stream,self.hmacf,self.framing))
     elif msg_type == MessageType.PUSH_FILE:
       filename = msg_dict["File Name"]
       localpath = expandPath("/",self.cd,filename)
       try:
-        db.insertObject(localpath)
-        if self.fd:
-          self.fd.close()
-        self.fd = db.writeObject(localpath)
+        await db.insertObject(localpath)
+        if self.upload:
+          await self.upload.abort()
+        self.upload = xfers.upload(*(await db.stageObject(localpath)),localpath)
       except DatabaseError as e:
         await self.sendError("DatabaseError: %s" % str(e))
         return
@@ -154,7 +324,7 @@ class Protocol(asyncio.Protocol):
         await self.sendError("IOError")
         return
       await self.sendOkay()
-      log("Opened '{}' for writing after object insertion".format(localpath))
+      log("Staged '{}' for writing after object insertion".format(localpath))
       self.status = Status.PULLING
     elif msg_type == MessageType.PULL_FILE:
       filename = msg_dict["File Name"]
@@ -163,7 +333,7 @@ class Protocol(asyncio.Protocol):
       try:
         if self.fd:
           self.fd.close()
-        self.fd = db.readObject(localpath)
+        self.fd = await db.readObject(localpath)
       except DatabaseError as e:
         await self.sendError("DatabaseError: %s" % str(e))
         return
@@ -173,18 +343,28 @@ class Protocol(asyncio.Protocol):
       log("Opened '{}' for reading".format(localpath))
       self.status = Status.PUSHING
       await self.sendOkay()
-      data = self.fd.read(_data_size)
-      while data:
-        out_data = strategies[(MessageClass.PRIVATE_MSG,MessageType.XFER_FILE)].build(
-                                [data,len(data)],self.stream,self.hmacf)
-        await self.sendall(out_data)
-        data = self.fd.read(_data_size)
+      if self.framing & FRAMING_BULK:
+        frame_size = block_size
+        strategy = strategies[(MessageClass.PRIVATE_MSG,MessageType.XFER_BLOCK)]
+        build = lambda data: strategy.build([data],self.stream,self.hmacf,self.framing)
+      else:
+        frame_size = _data_size
+        strategy = strategies[(MessageClass.PRIVATE_MSG,MessageType.XFER_FILE)]
+        build = lambda data: strategy.build([bytes(data),len(data)],
+                                            self.stream,self.hmacf,self.framing)
+      await xfers.download(self.fd,frame_size,build,self.sendall)
       await self.sendOkay()
       self.status = Status.NORMAL
-    elif msg_type == MessageType.XFER_FILE:
+    elif msg_type == MessageType.XFER_FILE or msg_type == MessageType.XFER_BLOCK:
       if self.status == Status.PULLING:
-        assert(self.fd)
-        self.fd.write(msg_dict["Data"][:msg_dict["BSize"]])
+        assert(self.upload)
+        try:
+          await self.upload.write(msg_dict["Data"][:msg_dict["BSize"]])
+        except IOError:
+          await self.upload.abort()
+          self.upload = None
+          self.status = Status.NORMAL
+          await self.sendError("IOError")
       else:
         await self.sendError("Ambiguous message sequence")
     elif msg_type == MessageType.OKAY:
@@ -193,28 +373,62 @@ class Protocol(asyncio.Protocol):
           self.fd.close()
         self.fd = None
         self.status = Status.NORMAL
+      if self.upload:
+        upload = self.upload
+        self.upload = None
+        try:
+          await xfers.finish(upload)
+          await db.updateObject(upload.localpath,upload.bytes,upload.mtime,upload.hash.digest(),
+                                upload.fd.chunks if upload.chunked else None)
+        except (IOError,DatabaseError) as e:
+          log("Upload from %s failed: %s" % (self.peerinfo[0],repr(e)))
+          #Only clients that agreed to acknowledged uploads wait for a reply
+          if self.framing & FRAMING_ACKED:
+            await self.sendError("DatabaseError: %s" % str(e) if isinstance(e,DatabaseError) else "IOError")
+          return
+        if self.framing & FRAMING_ACKED:
+          await self.sendOkay()
     elif msg_type == MessageType.LIST_SUBJECT_CLIENT:
-      subjects = db.getSubjectNames()
+      subjects = await db.getSubjectNames()
       s_lists = chunks(subjects,_lss_count)
       for list in s_lists:
         while len(list) < _lss_count:
           list.append("")
       msgs = map(lambda s_list: strategies[(MessageClass.PRIVATE_MSG,MessageType.LIST_SUBJECT_SERVER)]
-                 .build(s_list,self.stream,self.hmacf),s_lists)
+                 .build(s_list,self.stream,self.hmacf,self.framing),s_lists)
       for msg_block in msgs:
         await self.sendall(msg_block)
       await self.sendOkay()
     elif msg_type == MessageType.LIST_OBJECT_CLIENT:
-      objects = os.listdir(expandPath(self.pwd,self.cd,""))
+      try:
+        objects = [os.path.basename(path) for path in await db.getObjectNames(self.cd)]
+      except DatabaseError as e:
+        await self.sendError("DatabaseError: %s" % str(e))
+        return
       s_lists = chunks(objects,_ls_count)
       for list in s_lists:
         while len(list) < _ls_count:
           list.append("")
       msgs = map(lambda s_list: strategies[(MessageClass.PRIVATE_MSG,MessageType.LIST_OBJECT_SERVER)]
-                 .build(s_list,self.stream,self.hmacf),s_lists)
+                 .build(s_list,self.stream,self.hmacf,self.framing),s_lists)
       for msg_block in msgs:
         await self.sendall(msg_block)
       await self.sendOkay()
+    elif msg_type == MessageType.LIST_DETAILED:
+      try:
+        objects = await db.getObjectDetails(self.cd,msg_dict["After"],_lsd_count+1)
+        await self.sendObjectPage(objects[:_lsd_count],len(objects) > _lsd_count)
+      except DatabaseError as e:
+        await self.sendError("DatabaseError: %s" % str(e))
+    elif msg_type == MessageType.STAT_PATH:
+      try:
+        obj = await db.getObjectInfo(expandPath("/",self.cd,msg_dict["Path"]))
+        if not obj:
+          await self.sendError("DatabaseError: The path is not in the database")
+          return
+        await self.sendObjectPage([obj])
+      except DatabaseError as e:
+        await self.sendError("DatabaseError: %s" % str(e))
     elif msg_type == MessageType.GIVE_TICKET_SUBJECT:
       try:
         subject = msg_dict["Subject"]
@@ -224,7 +438,7 @@ class Protocol(asyncio.Protocol):
           target = expandPath("/",self.cd,msg_dict["Target"])
         else:
           target = msg_dict["Target"]
-        db.insertRight(subject,ticket,target,isObject)
+        await db.insertRight(subject,ticket,target,isObject)
         await self.sendOkay()
       except DatabaseError as e:
         await self.sendError("DatabaseError: %s" % str(e))
@@ -238,11 +452,37 @@ class Protocol(asyncio.Protocol):
           target = expandPath("/",self.cd,msg_dict["Target"])
         else:
           target = msg_dict["Target"]
-        db.deleteRight(subject,ticket,target,isObject)
+        await db.deleteRight(subject,ticket,target,isObject)
         await self.sendOkay()
       except DatabaseError as e:
         await self.sendError("DatabaseError: %s" % str(e))
         return
+    elif msg_type == MessageType.RIGHTS_HELD:
+      try:
+        after = (msg_dict["After"],bool(msg_dict["AfterIsObject"]))
+        rows = await db.getRightsHeld(msg_dict["Subject"],after,_rights_page+1)
+        await self.sendRightsPage(rows)
+      except DatabaseError as e:
+        await self.sendError("DatabaseError: %s" % str(e))
+    elif msg_type == MessageType.RIGHT_HOLDERS:
+      try:
+        isObject = bool(msg_dict["IsObject"])
+        if isObject:
+          target = expandPath("/",self.cd,msg_dict["Target"])
+        else:
+          target = msg_dict["Target"]
+        rows = await db.getRightHolders(msg_dict["Ticket"],target,isObject,msg_dict["After"],
+                                        _rights_page+1)
+        await self.sendRightsPage([(subject,False,mask) for subject,mask in rows])
+      except DatabaseError as e:
+        await self.sendError("DatabaseError: %s" % str(e))
+    elif msg_type == MessageType.CAN_SHARE:
+      try:
+        result = await db.canShare(msg_dict["Subject1"],msg_dict["Subject2"],msg_dict["Ticket"])
+        await self.sendall(strategies[(MessageClass.PRIVATE_MSG,MessageType.SHARE_RESULT)].build(
+                                    [int(result)],self.stream,self.hmacf,self.framing))
+      except DatabaseError as e:
+        await self.sendError("DatabaseError: %s" % str(e))
     elif msg_type == MessageType.XFER_TICKET:
       try:
         subject1 = msg_dict["Subject1"]
@@ -253,8 +493,10 @@ class Protocol(asyncio.Protocol):
           target = expandPath("/",self.cd,msg_dict["Target"])
         else:
           target = msg_dict["Target"]
-        db.insertRight(subject2,ticket,target,isObject)
-        db.deleteRight(subject1,ticket,target,isObject)
+        if not await db.mayTransfer(subject1,subject2,ticket,self.subject):
+          await self.sendError("Transfer not permitted by links and filters")
+          return
+        await db.transferRight(subject1,subject2,ticket,target,isObject)
         await self.sendOkay()
       except DatabaseError as e:
         await self.sendError("DatabaseError: %s" % str(e))
@@ -262,7 +504,7 @@ class Protocol(asyncio.Protocol):
       directory = msg_dict["Directory"]
       rel_path = expandPath("/",self.cd,directory)
       try:
-        db.insertObject(rel_path,True)
+        await db.insertObject(rel_path,True)
         await self.sendOkay()
       except DatabaseError as e:
         await self.sendError("DatabaseError: %s" % str(e))
@@ -271,7 +513,7 @@ class Protocol(asyncio.Protocol):
         subject = msg_dict["Subject"]
         stype = msg_dict["Type"]
         password = msg_dict["Password"]
-        db.insertSubject(subject,stype,password,False)
+        await db.insertSubject(subject,stype,password,False)
         await self.sendOkay()
       except DatabaseError as e:
         await self.sendError("DatabaseError: %s" % str(e))
@@ -279,21 +521,22 @@ class Protocol(asyncio.Protocol):
       path = msg_dict["Path"]
       abs_path = expandPath(self.pwd,self.cd,path)
       rel_path = expandPath("/",self.cd,path)
-      if os.path.isdir(abs_path):
+      #Directories made straight in the root have no row, so ask the filesystem
+      if os.path.isdir(abs_path) and not await db.isReserved(rel_path):
         self.cd = rel_path
         await self.sendOkay()
       else:
         await self.sendError("Path does not appear to exist")
     elif msg_type == MessageType.GET_CD:
       msg_encoded = strategies[(MessageClass.PRIVATE_MSG,MessageType.CD)].build([self.cd],
-                                                          self.stream,self.hmacf)
+                                                          self.stream,self.hmacf,self.framing)
       await self.sendall(msg_encoded)
     elif msg_type == MessageType.MAKE_FILTER:
       type1 = msg_dict["Type1"]
       type2 = msg_dict["Type2"]
       ticket = msg_dict["Ticket"]
       try:
-        db.insertFilter(type1,type2,ticket)
+        await db.insertFilter(type1,type2,ticket)
         await self.sendOkay()
       except DatabaseError as e:
         await self.sendError("DatabaseError: %s" % str(e))
@@ -302,7 +545,7 @@ class Protocol(asyncio.Protocol):
       type2 = msg_dict["Type2"]
       ticket = msg_dict["Ticket"]
       try:
-        db.deleteFilter(type1,type2,ticket)
+        await db.deleteFilter(type1,type2,ticket)
         await self.sendOkay()
       except DatabaseError as e:
         await self.sendError("DatabaseError: %s" % str(e))
@@ -310,28 +553,56 @@ class Protocol(asyncio.Protocol):
       try:
         subject1 = msg_dict["Subject1"]
         subject2 = msg_dict["Subject2"]
-        db.insertLink(subject1,subject2)
+        await db.insertLink(subject1,subject2)
         await self.sendOkay()
       except DatabaseError as e:
         await self.sendError("DatabaseError: %s" % str(e))
     elif msg_type == MessageType.DELETE_PATH:
       path = msg_dict["Path"]
       try:
-        db.deleteObject(expandPath("/",self.cd,path))
+        trash = await db.deleteObject(expandPath("/",self.cd,path),True)
+        await self.sendOkay()
+      except DatabaseError as e:
+        await self.sendError("DatabaseError: %s" % str(e))
+        return
+      try:
+        await xfers.remove(trash)
+      except OSError as e:
+        log("Removing %s failed: %s" % (trash,repr(e)))
+    elif msg_type == MessageType.MOVE_PATH:
+      try:
+        await db.moveObject(expandPath("/",self.cd,msg_dict["Source"]),
+                            expandPath("/",self.cd,msg_dict["Destination"]))
+        await self.sendOkay()
+      except DatabaseError as e:
+        await self.sendError("DatabaseError: %s" % str(e))
+    elif msg_type == MessageType.COPY_PATH:
+      source = expandPath("/",self.cd,msg_dict["Source"])
+      destination = expandPath("/",self.cd,msg_dict["Destination"])
+      try:
+        realpath, stagepath = await db.stageCopy(source,destination)
+        await xfers.copy(realpath,stagepath)
+        await db.copyObject(source,destination,stagepath)
         await self.sendOkay()
       except DatabaseError as e:
         await self.sendError("DatabaseError: %s" % str(e))
+      except OSError as e:
+        await self.sendError("Copy failed: %s" % e.strerror)
     elif msg_type == MessageType.CLEAR_LINKS:
       subject = msg_dict["Subject"]
       try:
-        db.clearLinks(subject)
+        await db.clearLinks(subject)
         await self.sendOkay()
       except DatabaseError as e:
         await self.sendError("DatabaseError: %s" % str(e))
+    elif msg_type in (MessageType.MAKE_SUBJECTS,MessageType.MAKE_LINKS,MessageType.GIVE_TICKETS):
+      await self.gatherBatch(msg_type,msg_dict)
     elif msg_type == MessageType.DELETE_SUBJECT:
       subject = msg_dict["Subject"]
       try:
-        db.deleteSubject(subject)
+        await db.deleteSubject(subject)
+        if sessions:
+          sessions.revoke(subject)
         await self.sendOkay()
       except DatabaseError as e:
         await self.sendError("DatabaseError: %s" % str(e))
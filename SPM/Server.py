@@ -1,31 +1,241 @@
 
 import asyncio
+import multiprocessing
+import multiprocessing.connection
+import os
+import socket
+import time
 
 import SPM.Protocol
 
-from SPM.Database import Database
+from . import _kdf_workers, _session_lifetime, _session_cache_size, _bulk_block_size
+from . import _dispatch_depth, _write_high_water, _write_low_water
+from . import _xfer_workers, _read_ahead_size, _xfer_window
+from . import _write_workers, _write_behind_size, _sync_interval
+from . import _stats_interval, _restart_delay, _db_cache_size, _chunk_sweep_interval
+
+from SPM.Database import AsyncDatabase, PROFILE_DEFAULT
+from SPM.Derivation import DerivationPool
+from SPM.Messages import FRAMING_DEFAULT
+from SPM.Session import SessionCache
+from SPM.Transfer import TransferPool, DURABILITY_FINAL
 from SPM.Util import log
 
 #Server
+#
+#With processes > 1 the server binds one listening socket and forks that many
+#  workers onto it, each running its own event loop, pools and database
+#  connection. The parent only supervises: it restarts workers that die and
+#  sums the statistics they report
+
+#Stats entries that are configuration, identical in every worker
+settings = frozenset(["workers","limit","processes","read_size","window","write_workers",
+                      "durability"])
+
+def add_stats(total,stats):
+  """Add the counters of a stats snapshot into a running total, keeping the largest peaks"""
+  for key,value in stats.items():
+    if isinstance(value,dict):
+      add_stats(total.setdefault(key,dict()),value)
+    elif key in settings or isinstance(value,bool):
+      total[key] = value
+    elif key.startswith("peak_"):
+      total[key] = max(total.get(key,0),value)
+    else:
+      total[key] = total.get(key,0) + value
+  return total
 
 class Server():
   """Server object encapsulates a server instance and its data"""
 
-  def __init__(self,bind,port):
-    if not SPM.Protocol.db:
-      SPM.Protocol.db = Database()
+  def __init__(self,bind,port,kdf_workers=_kdf_workers,kdf_processes=False,kdf_limit=None,
+               resumption=False,session_lifetime=_session_lifetime,
+               session_cache_size=_session_cache_size,framing=FRAMING_DEFAULT,
+               block_size=_bulk_block_size,dispatch_depth=_dispatch_depth,
+               write_high_water=_write_high_water,write_low_water=_write_low_water,
+               xfer_workers=_xfer_workers,read_ahead_size=_read_ahead_size,
+               xfer_window=_xfer_window,write_workers=_write_workers,
+               durability=DURABILITY_FINAL,write_behind_size=_write_behind_size,
+               sync_interval=_sync_interval,processes=1,stats_interval=_stats_interval,
+               db_profile=PROFILE_DEFAULT,db_cache_size=_db_cache_size,db_chunked=False,
+               chunk_sweep_interval=_chunk_sweep_interval):
+    assert processes > 0
+    self.kdf_args = (kdf_workers,kdf_processes,kdf_limit)
+    self.session_args = (session_lifetime,session_cache_size) if resumption else None
+    self.xfer_args = (xfer_workers,read_ahead_size,xfer_window,write_workers,
+                      durability,write_behind_size,sync_interval)
+    SPM.Protocol.framing = framing
+    SPM.Protocol.block_size = block_size
+    SPM.Protocol.dispatch_depth = dispatch_depth
+    SPM.Protocol.write_limits = (write_high_water,write_low_water)
+    self.db_profile = db_profile
+    self.db_cache_size = db_cache_size
+    self.db_chunked = db_chunked
+    self.chunk_sweep_interval = chunk_sweep_interval
+    self.sweeper = None
     self.port = port
     self.bind = bind
-    self.loop = asyncio.get_event_loop()
-    self.server = self.loop.run_until_complete(self.loop.create_server(
-		lambda: SPM.Protocol.Protocol(self.loop),self.bind,self.port))
+    self.processes = processes
+    self.stats_interval = stats_interval
+    self.workers = []
+    self.retired = dict()
+    self.restarts = 0
+    if processes == 1:
+      self.start()
+      self.loop.run_until_complete(self.listen())
+    else:
+      #Bind before forking so every worker accepts from the same socket
+      self.sock = socket.create_server((bind,port))
+      self.sock.setblocking(False)
+
+  def start(self,sweeper=True):
+    """Create the event loop and the pools it serves connections with
+
+    Workers share one chunk store, so only the one started with sweeper sweeps it"""
+    self.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self.loop)
+    if not SPM.Protocol.db:
+      SPM.Protocol.db = AsyncDatabase(profile=self.db_profile,cache_size=self.db_cache_size,
+                                      chunked=self.db_chunked)
+    if not SPM.Protocol.kdf:
+      SPM.Protocol.kdf = DerivationPool(*self.kdf_args)
+    if not SPM.Protocol.xfers:
+      SPM.Protocol.xfers = TransferPool(*self.xfer_args)
+    if self.session_args and not SPM.Protocol.sessions:
+      SPM.Protocol.sessions = SessionCache(*self.session_args)
+    if sweeper and self.db_chunked and self.chunk_sweep_interval:
+      self.sweeper = self.loop.create_task(self.sweep())
+
+  async def sweep(self):
+    """Coroutine to remove chunks no object refers to any more, now and then"""
+    while True:
+      await asyncio.sleep(self.chunk_sweep_interval)
+      try:
+        swept = await SPM.Protocol.db.collectChunks()
+      except OSError as e:
+        log("Chunk sweep failed: %s" % repr(e))
+        continue
+      if swept["removed"]:
+        log("Swept {removed} chunks, freeing {freed} bytes".format(**swept))
+
+  async def listen(self):
+    """Coroutine to start accepting connections"""
+    factory = lambda: SPM.Protocol.Protocol(self.loop)
+    if self.processes == 1:
+      self.server = await self.loop.create_server(factory,self.bind,self.port)
+    else:
+      self.server = await self.loop.create_server(factory,sock=self.sock)
+
+  def stop(self):
+    """Close the listener, the event loop and every pool"""
+    self.server.close()
+    if self.sweeper:
+      self.sweeper.cancel()
+    self.loop.run_until_complete(self.server.wait_closed())
+    self.loop.close()
+    SPM.Protocol.kdf.close()
+    SPM.Protocol.xfers.close()
+    SPM.Protocol.db.close()
+
+  def local_stats(self):
+    """Snapshot of the counters kept by this process"""
+    stats = {"kdf": SPM.Protocol.kdf.stats(), "xfers": SPM.Protocol.xfers.stats(),
+             "db": SPM.Protocol.db.stats()}
+    if SPM.Protocol.sessions:
+      stats["sessions"] = SPM.Protocol.sessions.stats()
+    return stats
+
+  def stats(self):
+    """Counters summed over every worker, including ones that have been replaced"""
+    if self.processes == 1:
+      return self.local_stats()
+    total = add_stats(dict(),self.retired)
+    for worker in self.workers:
+      add_stats(total,worker["stats"])
+    total["workers"] = len(self.workers)
+    total["restarts"] = self.restarts
+    return total
 
   def mainloop(self):
+    if self.processes > 1:
+      self.supervise()
+      return
     log("Entering the event loop...")
     try:
       self.loop.run_forever()
     finally:
-      self.server.close()
-      self.loop.run_until_complete(self.server.wait_closed())
-      self.loop.close()
+      self.stop()
+
+  def serve(self,conn,slot):
+    """Worker process: serve connections from the shared socket, reporting stats"""
+    self.start(sweeper=slot == 0)
+    self.loop.run_until_complete(self.listen())
+    async def report():
+      while True:
+        await asyncio.sleep(self.stats_interval)
+        conn.send(self.local_stats())
+    self.loop.create_task(report())
+    log("Worker %s entering the event loop..." % os.getpid())
+    try:
+      self.loop.run_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      conn.send(self.local_stats())
+      self.stop()
 
+  def spawn(self,slot):
+    """Fork a worker into a slot of the worker table"""
+    reader, writer = multiprocessing.Pipe(False)
+    process = multiprocessing.get_context("fork").Process(target=self.serve,args=(writer,slot),
+                                                          name="spm-worker-%d" % slot)
+    process.start()
+    writer.close()
+    worker = {"process": process, "conn": reader, "stats": dict(), "started": time.monotonic()}
+    if slot < len(self.workers):
+      self.workers[slot] = worker
+    else:
+      self.workers.append(worker)
+
+  def collect(self,worker):
+    """Read every stats report a worker has sent"""
+    try:
+      while worker["conn"].poll():
+        worker["stats"] = worker["conn"].recv()
+    except (EOFError,OSError):
+      pass
+
+  def supervise(self):
+    """Start the workers and replace any that exit until interrupted"""
+    for slot in range(self.processes):
+      self.spawn(slot)
+    log("Supervising %s workers on %s:%s" % (self.processes,self.bind,self.port))
+    try:
+      while True:
+        waits = [w["process"].sentinel for w in self.workers] + [w["conn"] for w in self.workers]
+        ready = multiprocessing.connection.wait(waits)
+        for slot,worker in enumerate(self.workers):
+          if worker["conn"] in ready:
+            self.collect(worker)
+          if worker["process"].sentinel in ready:
+            worker["process"].join()
+            self.collect(worker)
+            worker["conn"].close()
+            add_stats(self.retired,worker["stats"])
+            log("Worker %s exited with code %s, restarting" % (worker["process"].pid,
+                                                                worker["process"].exitcode))
+            #Do not spin when a worker dies as soon as it starts
+            if time.monotonic()-worker["started"] < _restart_delay:
+              time.sleep(_restart_delay)
+            self.restarts += 1
+            self.spawn(slot)
+    except KeyboardInterrupt:
+      pass
+    finally:
+      for worker in self.workers:
+        worker["process"].terminate()
+      for worker in self.workers:
+        worker["process"].join()
+        self.collect(worker)
+      log("Worker totals: %s" % self.stats())
+      self.sock.close()
@@ -0,0 +1,70 @@
+
+import os
+import time
+
+from collections import namedtuple, OrderedDict
+
+from . import _session_lifetime, _session_cache_size, _session_ticket_size
+
+#Session Resumption
+#
+#After a full login the server may hand out an opaque ticket naming a cached
+#  resumption secret. Both ends derive the secret from the session key, so the
+#  secret itself never crosses the wire. A later connection presents the ticket
+#  with a fresh nonce and both ends derive new keys without running PBKDF2
+
+Session = namedtuple("Session",["subject","secret","expires"])
+SessionTicket = namedtuple("SessionTicket",["subject","ticket","secret","expires"])
+
+class SessionCache:
+  """Bounded cache of resumable sessions, evicting the oldest first"""
+
+  def __init__(self,lifetime=_session_lifetime,size=_session_cache_size):
+    assert lifetime > 0
+    assert size > 0
+    self.lifetime = lifetime
+    self.size = size
+    self.sessions = OrderedDict()
+    self.issued = 0
+    self.resumed = 0
+    self.rejected = 0
+
+  def issue(self,subject,secret):
+    """Cache a session secret and return the ticket that names it"""
+    self.expire()
+    while len(self.sessions) >= self.size:
+      self.sessions.popitem(last=False)
+    ticket = os.urandom(_session_ticket_size)
+    self.sessions[ticket] = Session(subject,secret,time.time()+self.lifetime)
+    self.issued += 1
+    return ticket
+
+  def lookup(self,ticket):
+    """Find the live session for a ticket, if any"""
+    session = self.sessions.get(bytes(ticket))
+    if session and session.expires > time.time():
+      self.resumed += 1
+      return session
+    if session:
+      del self.sessions[bytes(ticket)]
+    self.rejected += 1
+    return None
+
+  def revoke(self,subject):
+    """Forget every session belonging to a subject"""
+    for ticket in [t for t,s in self.sessions.items() if s.subject == subject]:
+      del self.sessions[ticket]
+
+  def expire(self):
+    """Drop sessions that have outlived the ticket lifetime"""
+    now = time.time()
+    while self.sessions:
+      ticket, session = next(iter(self.sessions.items()))
+      if session.expires > now:
+        break
+      del self.sessions[ticket]
+
+  def stats(self):
+    """Snapshot of the cache counters"""
+    return {"cached": len(self.sessions), "issued": self.issued,
+            "resumed": self.resumed, "rejected": self.rejected}
@@ -1,11 +1,17 @@
 
 import hmac
 
+from collections import namedtuple
+from itertools import cycle, islice
+
 #Stream
 
 class RC4:
   """Implementation of RC4-DROP-2048 stream cipher"""
 
+  #PRGA index sequence. The i index restarts from zero for every block
+  _index = bytes((k + 1) & 0xFF for k in range(256))
+
   def __init__(self,key):
     self.key = bytearray(key)
     assert len(key)==256
@@ -17,48 +23,133 @@ class RC4:
     self.getBytes(2048)
 
   def getBytes(self,bs):
-    """Read bytes from the keystream"""
-    i = 0
+    """Read a block of bytes from the keystream"""
+    s = self.s
     j = 0
-    stream = bytearray()
-    for _ in range(bs):
-      i = (i + 1) % 256
-      j = (j + self.s[i]) % 256
-      self.s[i], self.s[j] = self.s[j], self.s[i]
-      stream.append(self.s[(self.s[i]+self.s[j]) % 256])
-    return stream
+    stream = []
+    append = stream.append
+    for i in islice(cycle(RC4._index),bs):
+      si = s[i]
+      j = (j + si) & 0xFF
+      sj = s[j]
+      s[i] = sj
+      s[j] = si
+      append(s[(si + sj) & 0xFF])
+    return bytes(stream)
 
   def xor(self,data):
     """XOR a block of data with fresh bytes from the keystream"""
-    data = bytearray(data)
-    stream = self.getBytes(len(data))
-    return bytearray(map(lambda b: b[0]^b[1],zip(data,stream)))
+    return xor_bytes(data,self.getBytes(len(data)))
 
 class AES:
-  """Use PyCrypto implementation of AES in counter mode"""
+  """Use PyCrypto implementation of AES-256 in counter mode"""
 
   def __init__(self,key):
     from Crypto.Cipher import AES
+    from Crypto.Util import Counter
     self.key = bytearray(key)
     assert len(key)==256
-    self.impl = AES.new(key,AES.MODE_CTR)
+    #The first 32 bytes key the cipher, the next 8 prefix the block counter
+    counter = Counter.new(64,prefix=bytes(self.key[32:40]),initial_value=0)
+    self.impl = AES.new(bytes(self.key[0:32]),AES.MODE_CTR,counter=counter)
 
   def getBytes(self,bs):
-    data = bytes(bs)
-    return AES.encrypt(data)
+    """Read bytes from the keystream"""
+    return self.impl.encrypt(bytes(bs))
 
   def xor(self,data):
     """XOR (encrypt) a block of data"""
-    data = bytearray(data)
-    stream = self.getBytes(len(data))
-    return bytearray(map(lambda b: b[0]^b[1],zip(data,stream)))
+    return bytearray(self.impl.encrypt(bytes(data)))
 
-def getBestCipherObject(key):
+def xor_bytes(data,stream):
+  """XOR a buffer with an equal length of keystream as whole integers"""
+  n = len(data)
+  data = int.from_bytes(data,"little")
+  stream = int.from_bytes(stream[:n],"little")
+  return bytearray((data ^ stream).to_bytes(n,"little"))
+
+#Cipher suites
+#
+#Suites are listed in order of preference. Each end advertises the suite ids it
+#  can run during the HELLO exchange and the server picks the first of its own
+#  suites that the client also offered. Peers that advertise nothing get RC4
+
+CipherSuite = namedtuple("CipherSuite",["sid","name","factory","available"])
+
+def has_pycrypto():
+  """Check whether PyCrypto (or a compatible package) can be imported"""
   try:
     from Crypto.Cipher import AES
-    return AES(key)
+    from Crypto.Util import Counter
   except ImportError:
-    return RC4(key)
+    return False
+  return True
+
+class SuiteRegistry:
+  """Ordered registry of cipher suites and the connections that use them"""
+
+  def __init__(self,default):
+    self.suites = []
+    self.default = default
+    self.usage = dict()
+
+  def register(self,sid,name,factory,available=lambda: True):
+    """Add a suite at the lowest preference"""
+    assert 0 < sid < 256
+    assert not self.lookup(sid)
+    self.suites.append(CipherSuite(sid,name,factory,available))
+    self.usage[name] = 0
+
+  def lookup(self,sid):
+    """Find a registered suite by id"""
+    for suite in self.suites:
+      if suite.sid == sid:
+        return suite
+    return None
+
+  def offer(self):
+    """Ids of the usable suites in order of preference"""
+    return bytes(suite.sid for suite in self.suites if suite.available())
+
+  def choose(self,offered):
+    """Pick the most preferred usable suite also present in a peer offer"""
+    offered = bytes(offered or b"")
+    for sid in self.offer():
+      if sid in offered:
+        return sid
+    return self.default
+
+  def name(self,sid):
+    """Describe a suite id for logging"""
+    suite = self.lookup(sid)
+    return suite.name if suite else "unknown"
+
+  def getCipherObject(self,sid,key):
+    """Build the cipher for a negotiated suite, counting the connection"""
+    suite = self.lookup(sid)
+    if not suite or not suite.available():
+      raise ValueError("Cipher suite %s is not available" % sid)
+    self.usage[suite.name] += 1
+    return suite.factory(key)
+
+  def report(self):
+    """Number of connections established with each suite"""
+    return dict(self.usage)
+
+SUITE_AES_CTR = 2
+SUITE_RC4 = 1
+
+suites = SuiteRegistry(SUITE_RC4)
+suites.register(SUITE_AES_CTR,"AES-256-CTR",AES,has_pycrypto)
+suites.register(SUITE_RC4,"RC4-DROP-2048",RC4)
+
+def getCipherObject(sid,key):
+  """Build a cipher object for a negotiated suite"""
+  return suites.getCipherObject(sid,key)
+
+def getBestCipherObject(key):
+  """Build a cipher object for the most preferred locally available suite"""
+  return suites.getCipherObject(suites.offer()[0],key)
 
 def make_hmacf(key):
   """Build a function for message signing"""
@@ -36,6 +36,15 @@ class Ticket:
       string = string.decode(encoding="UTF-8",errors="ignore")
     return Ticket(string)
 
+  def mask(self):
+    return 1 << (self.right.value-1)
+
   def __repr__(self):
     return "T/%s" % str(self.right.name)
 
+#Every right a subject holds over one target packs into a single bitmask,
+#  bit (value-1) for each member of Right
+
+def unpack_rights(mask):
+  return [Ticket(right) for right in Right if mask & 1 << (right.value-1)]
+
@@ -0,0 +1,370 @@
+
+import asyncio
+import hashlib
+import os
+import queue
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import _read_ahead_size, _xfer_window, _xfer_workers
+from . import _write_behind_size, _write_workers, _sync_interval
+from SPM.Util import log, copy_tree, remove_tree
+
+#Download Pipeline
+#
+#Serving PULL_FILE inline reads the object and encrypts every frame on the
+#  event loop. Instead a reader thread fills a bounded queue with large blocks,
+#  a pool worker frames and encrypts one block at a time so the keystream stays
+#  in order, and the loop only writes the finished buffers to the transport
+#
+#Uploads run the other way. Incoming chunks gather in a buffer on the loop and
+#  leave in large aligned writes on a writer thread, one write in flight per
+#  upload. Data lands in a staging file that is renamed over the object once the
+#  client finishes, so readers never see a partial upload. The writer hashes
+#  each block as it writes it, so the content hash costs no second read. With
+#  the chunk store the staging file is a chunk writer instead, and the object
+#  changes over when the database links it to the new chunks
+#
+#Copies and removals of whole subtrees also run on the writer threads, so the
+#  database thread only holds its transaction for the final rename
+
+#Durability policies for uploads
+DURABILITY_NONE = 0 #Leave flushing to the operating system
+DURABILITY_FINAL = 1 #Sync the file and its directory before the final OKAY completes
+DURABILITY_PERIODIC = 2 #Sync while writing at most every sync interval
+
+class Download:
+  """One object being read, framed and sent through the pipeline"""
+
+  def __init__(self,fd,frame_size,build,read_size=_read_ahead_size,window=_xfer_window):
+    assert frame_size > 0
+    assert window > 0
+    self.fd = fd
+    self.frame_size = frame_size
+    self.build = build
+    self.read_size = max(read_size//frame_size,1)*frame_size
+    self.blocks = queue.Queue(window)
+    self.stopped = threading.Event()
+    self.reader = threading.Thread(target=self.read_ahead,name="xfer-read",daemon=True)
+    self.bytes = 0
+    self.frames = 0
+    self.read_wait = 0.0
+    self.encode_time = 0.0
+    self.send_wait = 0.0
+    self.started = None
+    self.finished = None
+
+  def read_ahead(self):
+    """Reader thread: queue blocks from the object until end of file"""
+    try:
+      while not self.stopped.is_set():
+        data = self.fd.read(self.read_size)
+        self.put(data)
+        if not data:
+          return
+    except Exception as e:
+      self.put(e)
+
+  def put(self,item):
+    """Queue an item for the encoder unless the transfer has been stopped"""
+    while not self.stopped.is_set():
+      try:
+        self.blocks.put(item,timeout=0.1)
+        return
+      except queue.Full:
+        continue
+
+  def get(self):
+    """Take the next block from the reader, empty once finished or stopped"""
+    while not self.stopped.is_set():
+      try:
+        item = self.blocks.get(timeout=0.1)
+      except queue.Empty:
+        continue
+      if isinstance(item,Exception):
+        raise item
+      return item
+    return b""
+
+  def encode(self):
+    """Worker: frame and encrypt the next block, returning the wire bytes"""
+    start = time.perf_counter()
+    data = self.get()
+    got = time.perf_counter()
+    self.read_wait += got-start
+    if not data:
+      return None
+    view = memoryview(data)
+    frames = [self.build(view[i:i+self.frame_size]) for i in range(0,len(data),self.frame_size)]
+    self.encode_time += time.perf_counter()-got
+    self.bytes += len(data)
+    self.frames += len(frames)
+    return b"".join(frames)
+
+  async def run(self,executor,sendall):
+    """Coroutine to stream the whole object, keeping one block encoding ahead"""
+    loop = asyncio.get_running_loop()
+    self.started = time.perf_counter()
+    self.reader.start()
+    pending = None
+    try:
+      pending = loop.run_in_executor(executor,self.encode)
+      while True:
+        out_data = await pending
+        if out_data is None:
+          break
+        #Only one encode runs at a time so frames use the keystream in order
+        pending = loop.run_in_executor(executor,self.encode)
+        start = time.perf_counter()
+        await sendall(out_data)
+        self.send_wait += time.perf_counter()-start
+    except BaseException:
+      #Let a running encode notice the stop before the caller closes the object
+      self.stopped.set()
+      if pending and not pending.done():
+        await asyncio.wait([pending])
+      raise
+    finally:
+      self.stopped.set()
+      self.finished = time.perf_counter()
+    await loop.run_in_executor(None,self.reader.join)
+
+  def stats(self):
+    """Snapshot of the transfer counters"""
+    elapsed = ((self.finished or time.perf_counter())-self.started) if self.started else 0.0
+    return {"bytes": self.bytes, "frames": self.frames, "seconds": elapsed,
+            "mbps": self.bytes/elapsed/2**20 if elapsed else 0.0,
+            "read_wait": self.read_wait, "encode_time": self.encode_time,
+            "send_wait": self.send_wait}
+
+class Upload:
+  """One object being received into a staging file through the writer pool"""
+
+  def __init__(self,executor,fd,stagepath,realpath,durability=DURABILITY_FINAL,
+               write_size=_write_behind_size,sync_interval=_sync_interval,localpath=None):
+    assert write_size > 0
+    self.executor = executor
+    self.fd = fd
+    self.stagepath = stagepath
+    self.realpath = realpath
+    self.localpath = localpath
+    self.chunked = stagepath is None
+    self.hash = hashlib.md5()
+    self.mtime = None
+    self.durability = durability
+    self.write_size = write_size
+    self.sync_interval = sync_interval
+    self.buffer = bytearray()
+    self.pending = None
+    self.closed = False
+    self.bytes = 0
+    self.writes = 0
+    self.syncs = 0
+    self.write_wait = 0.0
+    self.last_sync = time.perf_counter()
+    self.started = time.perf_counter()
+    self.finished = None
+
+  async def submit(self,fn,*args):
+    """Coroutine to queue work on the writer, waiting for the previous write first"""
+    loop = asyncio.get_running_loop()
+    if self.pending:
+      start = time.perf_counter()
+      try:
+        await self.pending
+      finally:
+        self.write_wait += time.perf_counter()-start
+    self.pending = loop.run_in_executor(self.executor,fn,*args)
+
+  async def write(self,data):
+    """Coroutine to buffer received data, handing full aligned blocks to the writer"""
+    assert not self.closed
+    self.buffer += data
+    if len(self.buffer) >= self.write_size:
+      size = len(self.buffer)//self.write_size*self.write_size
+      block = bytes(self.buffer[:size])
+      del self.buffer[:size]
+      await self.submit(self.write_block,block)
+
+  def write_block(self,block):
+    """Writer: write a block, syncing if the periodic policy asks for it"""
+    self.fd.write(block)
+    self.hash.update(block)
+    self.bytes += len(block)
+    self.writes += 1
+    if self.durability == DURABILITY_PERIODIC:
+      now = time.perf_counter()
+      if now-self.last_sync >= self.sync_interval:
+        if self.chunked:
+          self.fd.sync()
+        else:
+          self.fd.flush()
+          os.fsync(self.fd.fileno())
+        self.syncs += 1
+        self.last_sync = now
+
+  def commit(self):
+    """Writer: close the staging file and rename it over the object"""
+    if self.chunked:
+      self.fd.close()
+      if self.durability == DURABILITY_FINAL:
+        self.fd.sync()
+        self.syncs += 1
+      self.mtime = time.time()
+      return
+    self.fd.flush()
+    if self.durability == DURABILITY_FINAL:
+      os.fsync(self.fd.fileno())
+      self.syncs += 1
+    self.fd.close()
+    os.replace(self.stagepath,self.realpath)
+    self.mtime = os.stat(self.realpath).st_mtime
+    if self.durability == DURABILITY_FINAL:
+      dirfd = os.open(os.path.dirname(self.realpath) or ".",os.O_RDONLY)
+      try:
+        os.fsync(dirfd)
+      finally:
+        os.close(dirfd)
+
+  def discard(self):
+    """Writer: close and remove the staging file"""
+    if self.chunked:
+      #Chunks already stored are left for the store's sweep
+      self.fd.abort()
+      return
+    self.fd.close()
+    if os.path.exists(self.stagepath):
+      os.remove(self.stagepath)
+
+  async def finish(self):
+    """Coroutine to write what remains and move the upload into place"""
+    assert not self.closed
+    self.closed = True
+    try:
+      if self.buffer:
+        block = bytes(self.buffer)
+        self.buffer = bytearray()
+        await self.submit(self.write_block,block)
+      await self.submit(self.commit)
+      await self.pending
+    except BaseException:
+      await self.cleanup()
+      raise
+    finally:
+      self.finished = time.perf_counter()
+
+  async def abort(self):
+    """Coroutine to drop the upload, leaving any existing object untouched"""
+    if self.closed:
+      return
+    self.closed = True
+    self.buffer = bytearray()
+    self.finished = time.perf_counter()
+    await self.cleanup()
+
+  async def cleanup(self):
+    """Coroutine to remove the staging file once any write in flight is done"""
+    if self.pending and not self.pending.done():
+      await asyncio.wait([self.pending])
+    await asyncio.get_running_loop().run_in_executor(self.executor,self.discard)
+
+  def stats(self):
+    """Snapshot of the upload counters"""
+    elapsed = (self.finished or time.perf_counter())-self.started
+    return {"bytes": self.bytes, "writes": self.writes, "syncs": self.syncs,
+            "seconds": elapsed, "mbps": self.bytes/elapsed/2**20 if elapsed else 0.0,
+            "write_wait": self.write_wait}
+
+class TransferPool:
+  """Executor pools shared by every download pipeline and upload"""
+
+  def __init__(self,workers=_xfer_workers,read_size=_read_ahead_size,window=_xfer_window,
+               write_workers=_write_workers,durability=DURABILITY_FINAL,
+               write_size=_write_behind_size,sync_interval=_sync_interval):
+    assert workers > 0
+    assert write_workers > 0
+    assert durability in (DURABILITY_NONE,DURABILITY_FINAL,DURABILITY_PERIODIC)
+    self.workers = workers
+    self.read_size = read_size
+    self.window = window
+    self.write_workers = write_workers
+    self.durability = durability
+    self.write_size = write_size
+    self.sync_interval = sync_interval
+    self.executor = ThreadPoolExecutor(workers,thread_name_prefix="xfer")
+    #Writers get their own threads so a slow disk cannot hold up downloads
+    self.writer = ThreadPoolExecutor(write_workers,thread_name_prefix="xfer-write")
+    self.running = 0
+    self.completed = 0
+    self.failed = 0
+    self.bytes = 0
+    self.uploads = 0
+    self.uploaded = 0
+    self.copies = 0
+    self.removals = 0
+
+  async def download(self,fd,frame_size,build,sendall):
+    """Coroutine to send an object as frames built by build(data), returning its stats"""
+    xfer = Download(fd,frame_size,build,self.read_size,self.window)
+    self.running += 1
+    try:
+      await xfer.run(self.executor,sendall)
+      self.completed += 1
+    except BaseException:
+      self.failed += 1
+      raise
+    finally:
+      self.running -= 1
+      self.bytes += xfer.bytes
+    stats = xfer.stats()
+    log("Sent {bytes} bytes in {frames} frames over {seconds:.2f}s ({mbps:.1f} MB/s)".format(**stats))
+    return stats
+
+  def upload(self,fd,stagepath,realpath,localpath=None):
+    """Start an upload into an open staging file that replaces realpath when finished
+
+    Without a stagepath fd is a chunk writer, whose chunks the caller links to the object"""
+    self.uploads += 1
+    return Upload(self.writer,fd,stagepath,realpath,self.durability,
+                  self.write_size,self.sync_interval,localpath)
+
+  async def finish(self,upload):
+    """Coroutine to complete an upload, returning its stats"""
+    await upload.finish()
+    self.uploaded += upload.bytes
+    stats = upload.stats()
+    log("Received {bytes} bytes in {writes} writes over {seconds:.2f}s ({mbps:.1f} MB/s)".format(**stats))
+    return stats
+
+  async def copy(self,src,dst):
+    """Coroutine to copy a file or directory tree on a writer, removing any partial copy on failure"""
+    def run():
+      if not os.path.lexists(src): #Uploads only create the file once they finish
+        return
+      try:
+        copy_tree(src,dst)
+      except BaseException:
+        remove_tree(dst)
+        raise
+    await asyncio.get_running_loop().run_in_executor(self.writer,run)
+    self.copies += 1
+
+  async def remove(self,path):
+    """Coroutine to remove a file or directory tree on a writer"""
+    await asyncio.get_running_loop().run_in_executor(self.writer,remove_tree,path)
+    self.removals += 1
+
+  def stats(self):
+    """Snapshot of the pool counters"""
+    return {"workers": self.workers, "read_size": self.read_size, "window": self.window,
+            "running": self.running, "completed": self.completed, "failed": self.failed,
+            "bytes": self.bytes, "write_workers": self.write_workers,
+            "durability": self.durability, "uploads": self.uploads, "uploaded": self.uploaded,
+            "copies": self.copies, "removals": self.removals}
+
+  def close(self):
+    """Shut the pools down, waiting for running encodes and writes"""
+    self.executor.shutdown(wait=True)
+    self.writer.shutdown(wait=True)
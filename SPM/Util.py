@@ -1,9 +1,17 @@
 #Assorted utilities
 
 import os
+import shutil
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 from . import _debug, _debug_width
 
+_FICLONE = 0x40049409 #Linux ioctl sharing the blocks of one file with another
+
 def log(msg):
   """Log a message if the _debug flag has been set"""
   if not _debug:
@@ -28,3 +36,52 @@ def expandPath(root,cd,local):
     cd = cd.strip(os.sep)
   local = local.strip(os.sep)
   return os.path.normpath(os.path.join(root,cd,local))
+
+def copy_file(src,dst):
+  """Copy a file, sharing its blocks or copying within the kernel where the system allows"""
+  with open(src,'rb',buffering=0) as fsrc, open(dst,'xb',buffering=0) as fdst:
+    copy_data(fsrc.fileno(),fdst.fileno())
+  #Keep the modification time so the copy matches the metadata copied with it
+  stat = os.stat(src)
+  os.utime(dst,ns=(stat.st_atime_ns,stat.st_mtime_ns))
+
+def copy_data(src,dst):
+  """Copy everything from one open file descriptor to another"""
+  if fcntl:
+    try:
+      fcntl.ioctl(dst,_FICLONE,src)
+      return
+    except OSError:
+      pass
+  if hasattr(os,"copy_file_range"):
+    try:
+      while os.copy_file_range(src,dst,2**30):
+        pass
+      return
+    except OSError:
+      pass #Not supported here, copy the rest from the current offsets
+  while True:
+    data = os.read(src,2**20)
+    if not data:
+      return
+    os.write(dst,data)
+
+def copy_tree(src,dst):
+  """Copy a file or directory tree to a path that does not exist yet"""
+  if not os.path.isdir(src):
+    copy_file(src,dst)
+    return
+  os.mkdir(dst)
+  for folder,dirs,files in os.walk(src):
+    target = os.path.join(dst,os.path.relpath(folder,src))
+    for name in dirs:
+      os.mkdir(os.path.join(target,name))
+    for name in files:
+      copy_file(os.path.join(folder,name),os.path.join(target,name))
+
+def remove_tree(path):
+  """Remove a file or directory tree if it exists"""
+  if os.path.isdir(path) and not os.path.islink(path):
+    shutil.rmtree(path)
+  elif os.path.lexists(path):
+    os.remove(path)
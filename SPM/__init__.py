@@ -18,17 +18,63 @@ _password_size = 64
 _salt_size = 32
 _file_size = 256
 _file_path_size = 1024
+_suite_list_size = 16
 _data_size = (_msg_size-(2+2+_hash_size))
 _error_msg_size = (_msg_size-(2+_hash_size))
+_compact_buckets = (_msg_size,64,256)
+_bulk_bucket = 0x0F
+_bulk_block_size = 2**18
+_bulk_block_max = 2**20
+_recv_compact_size = 2**16
+_dispatch_depth = 64
+_write_high_water = 2**18
+_write_low_water = 2**16
+_read_ahead_size = 2**20
+_xfer_window = 4
+_xfer_workers = 4
+_write_behind_size = 2**20
+_write_workers = 4
+_sync_interval = 1.0
+_stats_interval = 10
+_restart_delay = 1
+_db_cache_size = 4096
+_share_cache_size = 2**20
+_chunk_min = 2**14
+_chunk_max = 2**18
+_chunk_bits = 16
+_chunk_grace = 3600
+_chunk_sweep_interval = 3600
 _hash_rounds = 2**14
+_kdf_workers = 4
+_session_lifetime = 3600
+_session_cache_size = 10000
+_session_ticket_size = 32
 _debug = True
 _debug_width = 300
 
 _lss_count = 31
 _ls_count = 7
+_lsd_count = 7
+_batch_subjects = 10
+_batch_links = 15
+_batch_rights = 15
+_batch_error_size = 120
+_batch_max = 4096
+_rights_page = 30
 
 assert _msg_size / _subject_size >= _lss_count
 assert _msg_size / _file_size >= _ls_count
+assert 2 + _lsd_count*(_file_size+1+8+8+16) <= _msg_size-2-_hash_size
+assert 2 + _batch_subjects*(_subject_size+_type_size+_password_size) <= _msg_size-2-_hash_size
+assert 2 + _batch_links*2*_subject_size <= _msg_size-2-_hash_size
+assert 2 + _batch_rights*(2*_subject_size+_ticket_size+1) <= _msg_size-2-_hash_size
+assert 2 + max(_batch_subjects,_batch_links,_batch_rights)*(1+_batch_error_size) <= _msg_size-2-_hash_size
+assert 2 + _rights_page*(_subject_size+2) <= _msg_size-2-_hash_size
+assert _compact_buckets[0] == _msg_size and len(_compact_buckets) <= _bulk_bucket
+assert _bulk_block_size <= _bulk_block_max
+assert _write_low_water <= _write_high_water
+assert _chunk_bits % 2 == 0 and _chunk_bits <= 32 and _chunk_bits <= _chunk_min <= _chunk_max
+assert _read_ahead_size >= _bulk_block_size
 
 #Take care when tuning these parameters so that all messages, including
 # authentication tags, will fit within the allowed message size
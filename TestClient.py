@@ -27,6 +27,7 @@ def main():
   list(map(lambda subject: print(subject), subjects))
   print("Sending file...")
   client.sendFile("test.bin","test.bin")
+  assert client.stat("test.bin").hash == test_md5
   os.remove("test.bin")
   print("Getting file...")
   client.getFile("test.bin","test.bin")
@@ -3,6 +3,7 @@ import os
 import random
 import readline
 import subprocess
+import time
 import traceback
 from cmd import Cmd
 
@@ -131,6 +132,30 @@ class SpicyTerminal(Cmd):
       print("Available Objects:")
       [print(object) for object in objects]
 
+  def do_ll(self,line):
+    """[ll] list objects in the working directory on the server with their size, time and MD5"""
+    if not self.client or not self.client.connected:
+      print("No active connection")
+    else:
+      for object in self.client.listDetailed():
+        print(self.describe(object))
+
+  def do_stat(self,path):
+    """[stat path] show the size, time and MD5 of an object on the server"""
+    if not self.client or not self.client.connected:
+      print("No active connection")
+    else:
+      print(self.describe(self.client.stat(path)))
+
+  def describe(self,object):
+    """Format an object with its metadata for display"""
+    if object.dir:
+      return "%s/" % object.localpath
+    if object.hash is None:
+      return "%-32s %12s %19s %s" % (object.localpath,"?","?","?")
+    return "%-32s %12d %19s %s" % (object.localpath,object.size,
+      time.strftime("%Y-%m-%d %H:%M:%S",time.localtime(object.mtime)),object.hash)
+
   def do_cd(self,line):
     """[cd] change object directory on the server"""
     if not self.client or not self.client.connected:
@@ -166,12 +191,32 @@ class SpicyTerminal(Cmd):
     os.remove(file)
 
   def do_rm(self,file):
-    """[rm file] delete a single file from the remote directory"""
+    """[rm path] delete a file or directory tree from the remote directory"""
     if not self.client or not self.client.connected:
       print("No active connection")
     else:
       self.client.deleteFile(file)
 
+  def do_mv(self,line):
+    """[mv source destination] move or rename a remote file or directory tree"""
+    args = line.split()
+    if not self.client or not self.client.connected:
+      print("No active connection")
+    elif len(args) != 2:
+      print("Not enough arguments")
+    else:
+      self.client.movePath(args[0],args[1])
+
+  def do_cp(self,line):
+    """[cp source destination] copy a remote file or directory tree on the server"""
+    args = line.split()
+    if not self.client or not self.client.connected:
+      print("No active connection")
+    elif len(args) != 2:
+      print("Not enough arguments")
+    else:
+      self.client.copyPath(args[0],args[1])
+
   def do_gt(self,line):
     """[gt subject target ticket isobject] grant a rights ticket"""
     args = line.split()
@@ -218,6 +263,40 @@ class SpicyTerminal(Cmd):
       isobject = args[4].lower() == "true"
       self.client.xfterTicketSubject(subject1,subject2,ticket,target,isobject)
 
+  def do_rights(self,subject):
+    """[rights subject] list the rights tickets held by a subject"""
+    if not self.client or not self.client.connected:
+      print("No active connection")
+    else:
+      for target,isobject,tickets in self.client.listRightsHeld(subject):
+        print("%s%s: %s" % (target,"" if isobject else " (subject)"," ".join(map(repr,tickets))))
+
+  def do_holders(self,line):
+    """[holders target ticket isobject] list the subjects holding a rights ticket"""
+    args = line.split()
+    if not self.client or not self.client.connected:
+      print("No active connection")
+      return
+    if len(args) != 3:
+      print("Not enough arguments")
+    else:
+      target = args[0]
+      ticket = args[1]
+      isobject = args[2].lower() == "true"
+      for subject,tickets in self.client.listRightHolders(ticket,target,isobject):
+        print("%s: %s" % (subject," ".join(map(repr,tickets))))
+
+  def do_canshare(self,line):
+    """[canshare subject1 subject2 ticket] check whether a ticket can ever flow from subject1 to subject2"""
+    args = line.split()
+    if not self.client or not self.client.connected:
+      print("No active connection")
+      return
+    if len(args) != 3:
+      print("Not enough arguments")
+    else:
+      print("yes" if self.client.canShare(args[2],args[0],args[1]) else "no")
+
   def do_mkdir(self,directory):
     """[mkdir dir] make a new directory on the server"""
     if not self.client or not self.client.connected: